@@ -1,24 +1,59 @@
 __author__ = 'leonardtruong'
 from ctree.cpp.nodes import CppDefine
-from ctypes import POINTER, c_float
+from ctypes import POINTER, c_double
+from ctree.c.codegen import CCodeGen
+from ctree.types import codegen_type
+from stencil_code.halo_enumerator import HaloEnumerator
 from stencil_code.stencil_exception import StencilException
 from stencil_code.backend.stencil_backend import *
 
 
+class RestrictParam(SymbolRef):
+    """a pointer parameter qualified restrict, it aliases no other one"""
+    def codegen(self, indent=0):
+        return "%s restrict %s" % (codegen_type(self.type), self.name)
+
+
+class TargetClonesFunctionDecl(FunctionDecl):
+    """
+    a function compiled once for each of targets and for the default
+    target, the clone for the best isa the cpu supports is picked when the
+    library is loaded
+    """
+    def __init__(self, return_type=None, name=None, params=None, defn=None,
+                 targets=()):
+        super(TargetClonesFunctionDecl, self).__init__(return_type, name,
+                                                       params, defn)
+        self.targets = targets
+
+    def codegen(self, indent=0):
+        clones = ", ".join('"%s"' % target
+                           for target in tuple(self.targets) + ('default',))
+        return "__attribute__((target_clones(%s)))\n%s" % (
+            clones, CCodeGen(indent).visit_FunctionDecl(self))
+
+
 class StencilCTransformer(StencilBackend):
+    # how the grid reads being generated treat indexes beyond the edges of
+    # the grids, None when they never go beyond them, 'clamp' or 'wrap'
+    edge_reads = None
+    # the local the output point is accumulated in, None to accumulate in
+    # the output grid
+    accumulator = None
+
     def visit_FunctionDecl(self, node):
         super(StencilCTransformer, self).visit_FunctionDecl(node)
-        for index, arg in enumerate(self.input_grids + (self.output_grid,)):
-            defname = "_%s_array_macro" % node.params[index].name
-            # params = ','.join(["_d"+str(x) for x in range(arg.ndim)])
-            # params = "(%s)" % params
-            calc = "((_d%d)" % (arg.ndim - 1)
-            for x in range(arg.ndim - 1):
-                ndim = str(int(arg.strides[x]/arg.itemsize))
-                calc += "+((_d%s) * %s)" % (str(x), ndim)
-            calc += ")"
-            params = ["_d"+str(x) for x in range(arg.ndim)]
-            node.defn.insert(0, CppDefine(defname, params, calc))
+        defn = []
+        for statement in node.defn:
+            # a loop nest may come back with the pragmas in front of it
+            if isinstance(statement, list):
+                defn.extend(statement)
+            else:
+                defn.append(statement)
+        node.defn = defn
+        node.defn[0:0] = self.neighbor_tables
+        for definition in self.gen_array_macro_definitions(node):
+            node.defn.insert(0, definition)
         abs_decl = FunctionDecl(
             c_int(), SymbolRef('abs'), [SymbolRef('n', c_int())]
         )
@@ -29,57 +64,162 @@ class StencilCTransformer(StencilBackend):
             "clamp", [SymbolRef('_a'), SymbolRef('_min_a'), SymbolRef('_max_a')],
             StringTemplate("(_a>_max_a?_max_a:_a)<_min_a?_min_a:(_a>_max_a?_max_a:_a)"),
         )
-        node.params.append(SymbolRef('duration', POINTER(c_float)))
+        wrap_macro = CppDefine(
+            "wrap", [SymbolRef('_a'), SymbolRef('_n')],
+            StringTemplate("((((_a) % (_n)) + (_n)) % (_n))"),
+        )
+        node.params.extend(self.shape_params())
+        node.params.append(SymbolRef('duration', POINTER(c_double)))
+        start_time, end_time = self.gen_timer()
+        node.defn.insert(0, start_time)
+        node.defn.append(end_time)
+        return [
+            self.gen_vector_hints(statement)
+            if isinstance(statement, FunctionDecl) and
+            statement.name in ('stencil_kernel', 'stencil_kernel_rows')
+            else statement
+            for statement in self.gen_headers() + self.gen_type_definitions() +
+            [abs_decl, min_macro, clamp_macro, wrap_macro, node] +
+            self.gen_run_steps(node)]
+
+    def gen_vector_hints(self, function):
+        """
+        qualifies the grid parameters of function restrict, tells the
+        compiler they are aligned to kernel.alignment bytes and has the
+        function compiled for each isa in kernel.cpu_dispatch
+        :return: function or its TargetClonesFunctionDecl
+        """
+        kernel = self.kernel
+        grids = function.params[:len(self.input_grids) + 1]
+        if kernel.restrict:
+            grids = [RestrictParam(param.name, param.type) for param in grids]
+            function.params[:len(grids)] = grids
+        if kernel.alignment:
+            function.defn[0:0] = [
+                Assign(SymbolRef(param.name), FunctionCall(
+                    SymbolRef('__builtin_assume_aligned'),
+                    [SymbolRef(param.name), Constant(kernel.alignment)]))
+                for param in grids]
+        if kernel.cpu_dispatch:
+            function = TargetClonesFunctionDecl(
+                function.return_type, function.name, function.params,
+                function.defn, kernel.cpu_dispatch)
+        return function
+
+    def gen_headers(self):
+        return [StringTemplate("#include <time.h>")]
+
+    def gen_type_definitions(self):
+        """
+        the c name of the element types that have none, float16 is the
+        _Float16 extension of gcc and clang
+        """
+        if np.dtype(np.float16) in self.grid_dtypes():
+            return [StringTemplate("typedef _Float16 half;")]
+        return []
+
+    def gen_timer(self):
+        """
+        :return: the statements that start the clock and that store the
+            elapsed seconds in *duration
+        """
         start_time = Assign(StringTemplate('clock_t start_time'), FunctionCall(
             SymbolRef('clock')))
-        node.defn.insert(0, start_time)
         end_time = Assign(Deref(SymbolRef('duration')),
-                          Div(Sub(FunctionCall(SymbolRef('clock')), SymbolRef(
-                              'start_time')), SymbolRef('CLOCKS_PER_SEC')))
-        node.defn.append(end_time)
-        return [StringTemplate("#include <time.h>"), abs_decl, min_macro, clamp_macro, node]
+                          Div(Cast(c_double(), Sub(
+                              FunctionCall(SymbolRef('clock')),
+                              SymbolRef('start_time'))),
+                              SymbolRef('CLOCKS_PER_SEC')))
+        return start_time, end_time
 
     def visit_InteriorPointsLoop(self, node):
         """
         generate the c for loops necessary to represent the interior points iteration
         for boundary_handling
-        if clamped then, iterate over all points and use clamping in the
-            input array references on the kernel code
-        if copied then
-            insert an if before the unrolled neighbor stuff to do a direct copy from
-            the original input_grid
+        the points at least the ghost depth away from the edges are computed
+        by a loop nest free of boundary tests, for clamp, wrap and copy the
+        remaining points are covered by thin boundary slabs, enumerated the
+        way HaloEnumerator does
+        if clamped then, the slabs run the kernel with clamping in the input
+            array references
+        if wrapped then, the slabs run the kernel with the input array
+            references taken modulo the grid size
+        if copied then, the slabs copy straight from the input grid
         :param node:
-        :return:
+        :return: a loop nest, or a list of them
         """
         dim = len(self.output_grid.shape)
         self.kernel_target = node.target
+        interior = [(Constant(self.ghost_depth[d]),
+                     self.grid_size(d, self.ghost_depth[d] + 1))
+                    for d in range(dim)]
+        loop_nests = self.gen_loop_nest(interior, node)
+        if self.is_clamped or self.is_wrapped or self.is_copied:
+            loop_nests = [loop_nests]
+            self.edge_reads = self.kernel.boundary_handling
+            loop_nests.extend(
+                self.gen_loop_nest(bounds, None if self.is_copied else node)
+                for bounds in self.boundary_slabs())
+            self.edge_reads = None
+        self.kernel_target = None
+        return loop_nests
+
+    def boundary_slabs(self):
+        """
+        the bounds of the slabs covering the points within the ghost depth
+        of the edges, see HaloEnumerator.slabs, as expressions of the
+        _shape parameters for shape generic kernels
+        :return: a list of [(first, last)] per dimension, inclusive
+        """
+        if not self.shape_generic:
+            shape = self.output_grid.shape
+            return [[(Constant(start), Constant(stop - 1))
+                     for start, stop in slab]
+                    for slab in HaloEnumerator(
+                        self.ghost_depth[:len(shape)], shape).slabs()]
+        dim = len(self.output_grid.shape)
+        slabs = []
+        for d in range(dim):
+            depth = self.ghost_depth[d]
+            if depth == 0:
+                continue
+            bounds = [(Constant(self.ghost_depth[e]),
+                       self.grid_size(e, self.ghost_depth[e] + 1))
+                      for e in range(d)]
+            bounds += [None] + [(Constant(0), self.grid_size(e, 1))
+                                for e in range(d + 1, dim)]
+            # the high slab starts after the low one on narrow grids
+            ends = [
+                (Constant(0), Sub(FunctionCall(
+                    SymbolRef("min"), [Constant(depth),
+                                       SymbolRef("_shape%d" % d)]),
+                    Constant(1))),
+                (TernaryOp(Gt(self.grid_size(d, depth), Constant(depth)),
+                           self.grid_size(d, depth), Constant(depth)),
+                 self.grid_size(d, 1))]
+            for end in ends:
+                slabs.append(bounds[:d] + [end] + deepcopy(bounds[d + 1:]))
+        return slabs
+
+    def gen_loop_nest(self, bounds, node=None):
+        """
+        a loop nest over the points within bounds
+        :param bounds: the first and last index of each dimension
+        :param node: the InteriorPointsLoop whose body is run at each
+            point, None to copy the input grid to the output grid
+        :return: the outermost For node
+        """
+        self.var_list = []
         curr_node = None
         ret_node = None
-        for d in range(dim):
+        for d, (first, last) in enumerate(bounds):
             target = self.gen_fresh_var()
             self.var_list.append(target)
-            if self.is_clamped or self.is_copied:
-                for_loop = For(
-                    Assign(SymbolRef(target, c_int()),
-                           Constant(0)),
-                    LtE(SymbolRef(target),
-                        Constant(
-                            self.output_grid.shape[d] - 1)
-                        ),
-                    PostInc(SymbolRef(target)),
-                    [])
-            else:
-                for_loop = For(
-                    Assign(SymbolRef(target, c_int()),
-                           Constant(self.ghost_depth[d])),
-                    LtE(SymbolRef(target),
-                        Constant(
-                            self.output_grid.shape[d] -
-                            self.ghost_depth[d] - 1)
-                        ),
-                    PostInc(SymbolRef(target)),
-                    [])
-
+            for_loop = For(
+                Assign(SymbolRef(target, c_int()), first),
+                LtE(SymbolRef(target), last),
+                PostInc(SymbolRef(target)),
+                [])
             if d == 0:
                 ret_node = for_loop
             else:
@@ -90,95 +230,66 @@ class StencilCTransformer(StencilBackend):
         macro = self.gen_array_macro(self.output_grid_name, pt)
         curr_node.body = [Assign(SymbolRef(self.output_index, c_int()),
                                  macro)]
-
-        if self.is_copied:
-            # this a little hokey but if we are in boundary copy mode
-            # we change the for loops above to visit everything and
-            # then we test to see if the any of the values are in the halo zone
-            # and if so we just copy straight from in_grid, otherwise we
-            # do the neighborhood unrolling
-            def test_index_in_halo(index):
-                return Or(
-                    Lt(SymbolRef(self.var_list[index]), Constant(self.ghost_depth[index])),
-                    Gt(SymbolRef(self.var_list[index]),
-                       Constant(self.output_grid.shape[index] - (self.ghost_depth[index] + 1))),
-                )
-
-            def boundary_or(index):
-                if index < len(self.var_list) - 1:
-                    return Or(test_index_in_halo(index), boundary_or(index+1))
-                else:
-                    return test_index_in_halo(index)
-
-            then_block = Assign(
-                ArrayRef(SymbolRef(self.output_grid_name), SymbolRef(self.output_index)),
-                ArrayRef(SymbolRef(self.input_names[0]), SymbolRef(self.output_index)),
-            )
-            else_block = []
-            for elem in map(self.visit, node.body):
-                if type(elem) == list:
-                    else_block.extend(elem)
-                else:  # pragma no cover
-                    else_block.append(elem)
-            if_boundary_block = If(
-                boundary_or(0),
-                then_block,
-                else_block
-            )
-            curr_node.body.append(if_boundary_block)
-        else:
-            for elem in map(self.visit, node.body):
-                if type(elem) == list:
-                    curr_node.body.extend(elem)
-                else:
-                    curr_node.body.append(elem)
-
-        self.kernel_target = None
+        output = ArrayRef(SymbolRef(self.output_grid_name),
+                          SymbolRef(self.output_index))
+        if node is None:
+            curr_node.body.append(Assign(
+                output, ArrayRef(SymbolRef(self.input_names[0]),
+                                 SymbolRef(self.output_index))))
+            return ret_node
+        if self.kernel.accumulator_dtype:
+            # the point is computed in a local of the accumulator type and
+            # rounded to the type of the output once, when it is stored
+            self.accumulator = self.gen_fresh_var()
+            curr_node.body.append(Assign(
+                SymbolRef(self.accumulator, self.value_type()),
+                deepcopy(output)))
+        for elem in map(self.visit, deepcopy(node.body)):
+            if type(elem) == list:
+                curr_node.body.extend(elem)
+            else:
+                curr_node.body.append(elem)
+        if self.accumulator is not None:
+            curr_node.body.append(Assign(output,
+                                         SymbolRef(self.accumulator)))
+            self.accumulator = None
         return ret_node
 
     def visit_GridElement(self, node):
         """
-        handles array references to input_grids, understands clamping
-        on input_grids by looking at the kernel of the current specializer
+        handles array references to input_grids, clamps or wraps the
+        indexes of reads made from the boundary slabs
         :param node:
         :return:
         """
 
-        def gen_clamped_index(symbol_ref, max_index):
-            return FunctionCall('clamp', [symbol_ref, Constant(0), Constant(max_index)])
+        def gen_edge_index(symbol_ref, grid, d):
+            if self.edge_reads == 'wrap':
+                return FunctionCall('wrap', [symbol_ref, size(grid, d)])
+            return FunctionCall('clamp', [symbol_ref, Constant(0),
+                                          size(grid, d, 1)])
+
+        def size(grid, d, minus=0):
+            if self.shape_generic:
+                return self.grid_size(d, minus)
+            return Constant(grid.shape[d] - minus)
 
         grid_name = node.grid_name
         target = node.target
         if isinstance(target, SymbolRef):
             target = target.name
-            if target == self.kernel_target:
-                if grid_name is self.output_grid_name:
-                    return ArrayRef(SymbolRef(self.output_grid_name),
-                                    SymbolRef(self.output_index))
-                elif grid_name in self.input_dict:
-                    # grid = self.input_dict[grid_name]
-                    if self.is_clamped:
-                        grid = self.input_dict[grid_name]
-                        pt = list(
-                            map(lambda d: gen_clamped_index(
-                                self.var_list[d], grid.shape[d]-1), range(len(self.var_list))))
-                    else:  # pragma no cover
-                        pt = list(map(lambda x: SymbolRef(x), self.var_list))
-
-                    index = self.gen_array_macro(grid_name, pt)
-                    return ArrayRef(SymbolRef(grid_name), index)
-            # elif grid_name == self.neighbor_grid_name:
-            else:
-                if self.is_clamped:
+            if target == self.kernel_target and \
+                    grid_name is self.output_grid_name:
+                if self.accumulator is not None:
+                    return SymbolRef(self.accumulator)
+                return ArrayRef(SymbolRef(self.output_grid_name),
+                                SymbolRef(self.output_index))
+            if target != self.kernel_target or grid_name in self.input_dict:
+                pt = self.read_point(target == self.kernel_target)
+                if self.edge_reads:
                     grid = self.input_dict[grid_name]
-                    pt = list(map(
-                        lambda d, y: gen_clamped_index(
-                            Add(SymbolRef(self.var_list[d]), Constant(y)),
-                            grid.shape[d]-1), range(len(self.var_list)), self.offset_list
-                    ))
-                else:
-                    pt = list(map(lambda x, y: Add(SymbolRef(x), Constant(y)),
-                              self.var_list, self.offset_list))
+                    pt = [gen_edge_index(index, grid, d)
+                          for d, index in enumerate(pt)]
                 index = self.gen_array_macro(grid_name, pt)
                 return ArrayRef(SymbolRef(grid_name), index)
         elif isinstance(target, FunctionCall) or \
@@ -166,6 +166,31 @@ class LocalSizeComputer(object):
             best_local_size = [min(self.shape[dim], value) for dim, value in enumerate(best_local_size)]
         return tuple(best_local_size)
 
+    def compute_local_size_candidates(self, count=4):
+        """
+        a short list of local sizes worth timing, the bulky choice first,
+        followed by the other sizes that divide shape exactly, best surface
+        area to volume ratio first
+        :param count: maximum number of candidates
+        :return: a list of tuples of the same cardinality as self.shape
+        """
+        candidates = [self.compute_local_size_bulky()]
+        ranked = sorted(
+            set(
+                tuple(min(self.shape[dim], value) for dim, value in enumerate(candidate))
+                for candidate in self.get_local_size(0, self.max_work_group_size, perfect_fit_only=True)
+                if product(candidate) <= self.max_work_group_size
+            ),
+            key=lambda candidate: -LocalSizeComputer.volume(candidate) /
+            float(LocalSizeComputer.surface_area(candidate))
+        )
+        for candidate in ranked:
+            if len(candidates) >= count:
+                break
+            if candidate not in candidates:
+                candidates.append(candidate)
+        return candidates
+
     def get_work_group_for_divisor(self, dim_divisor):
         """
         generated a legal work group size when dividing up the right most dimension
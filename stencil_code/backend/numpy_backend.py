@@ -0,0 +1,372 @@
+"""
+A backend that needs no compiler, the stencil model of the kernel is
+evaluated with whole array numpy operations.
+
+Every statement of the interior points loop is applied to all the interior
+points at once.  A grid read at the current point is a view of the grid
+over the interior, a read at a neighbor is the same view shifted by the
+offset of the neighbor, so the neighbor points loop costs one array
+operation per neighbor and statement.  Grids are padded by the ghost depth
+for clamp and wrap boundary handling, for which every point of the grid is
+computed, zero and copy boundary handling only compute the points farther
+than the ghost depth from the edges.
+"""
+from __future__ import print_function
+import copy
+import time
+
+import numpy as np
+from ctree.c.nodes import (
+    AugAssign, BinaryOp, Block, Cast, Constant, FunctionCall, FunctionDecl, Op,
+    SymbolRef, TernaryOp, UnaryOp
+)
+from ctree.frontend import get_ast
+
+from stencil_code.device_array import DeviceArray
+from stencil_code.stencil_exception import StencilException
+from stencil_code.stencil_future import StencilFuture
+from stencil_code.stencil_model import (
+    GridElement, InteriorPointsLoop, MathFunction, NeighborPointsLoop,
+    StageBlock, StageElement
+)
+
+
+BINARY_OPERATORS = {
+    Op.Add: np.add,
+    Op.Sub: np.subtract,
+    Op.Mul: np.multiply,
+    Op.Div: np.true_divide,
+    Op.Mod: np.mod,
+    Op.Lt: np.less,
+    Op.Gt: np.greater,
+    Op.LtE: np.less_equal,
+    Op.GtE: np.greater_equal,
+    Op.Eq: np.equal,
+    Op.NotEq: np.not_equal,
+    Op.And: np.logical_and,
+    Op.Or: np.logical_or,
+    Op.BitAnd: np.bitwise_and,
+    Op.BitOr: np.bitwise_or,
+    Op.BitXor: np.bitwise_xor,
+}
+
+UNARY_OPERATORS = {
+    Op.Sub: np.negative,
+    Op.SubUnary: np.negative,
+    Op.Add: np.positive,
+    Op.AddUnary: np.positive,
+    Op.Not: np.logical_not,
+    Op.BitNot: np.invert,
+}
+
+# functions a kernel may call that are not numpy functions of the same name
+FUNCTIONS = {
+    'abs': np.abs,
+    'min': np.minimum,
+    'max': np.maximum,
+    'fabs': np.abs,
+    'pow': np.power,
+}
+
+
+def to_int(value):
+    """
+    int() of a scalar or of every element of an array
+    """
+    if isinstance(value, np.ndarray):
+        return value.astype(np.intp)
+    return int(value)
+
+
+class NumpyStencil(object):
+    """
+    Applies a stencil to numpy grids by evaluating its stencil model with
+    array operations over the interior of the grids
+    """
+    def __init__(self, stencil):
+        """
+        :param stencil: the Stencil whose kernel is evaluated
+        """
+        self.stencil = stencil
+        tree = stencil.stencil_model(get_ast(stencil.kernel))
+        self.decl = tree.find(FunctionDecl)
+        self.param_names = [param.name for param in self.decl.params]
+        self.last_duration = None
+
+    def __call__(self, *args, **kwargs):
+        """
+        :param args: the input grids, numpy arrays or DeviceArrays
+        :param n_steps: Optional keyword, number of times to apply the
+            stencil, feeding each output back in as the first input grid
+        :param out: Optional keyword, a preallocated array the result is
+            written to and returned
+        :param blocking: Optional keyword, if False the result is returned
+            in a StencilFuture that is already done
+        :return: the output grid
+        """
+        from stencil_code.stencil_kernel import check_output
+        n_steps = kwargs.get('n_steps', 1)
+        out = kwargs.get('out')
+        start_time = time.time()
+        args = [arg.get() if isinstance(arg, DeviceArray) else
+                np.asarray(arg) for arg in args]
+        if len(args) != len(self.param_names) - 1:
+            raise StencilException(
+                "Error: {} takes {} grids, got {}".format(
+                    type(self.stencil).__name__, len(self.param_names) - 1,
+                    len(args)))
+        if out is not None:
+            check_output(out, args[0])
+        grid = args[0]
+        for step in range(n_steps):
+            if out is not None and step == n_steps - 1:
+                output = out
+                output.fill(0)
+            else:
+                output = np.zeros_like(grid)
+            accumulator_dtype = self.stencil.accumulator_dtype
+            accumulated = output if accumulator_dtype is None else \
+                np.zeros(output.shape, accumulator_dtype)
+            # the evaluation state lives on a copy so that calls from
+            # several threads do not share it
+            copy.copy(self).apply([grid] + args[1:], accumulated)
+            if accumulated is not output:
+                output[...] = accumulated
+            grid = output
+        self.last_duration = time.time() - start_time
+        if not kwargs.get('blocking', True):
+            return StencilFuture.completed(grid)
+        return grid
+
+    def apply(self, grids, output):
+        """
+        one application of the stencil
+        :param grids: the input grids, in the order of the kernel parameters
+        :param output: the zeroed output grid
+        """
+        stencil = self.stencil
+        self.output = output
+        self.output_name = self.param_names[-1]
+        self.grids = dict(zip(self.param_names, grids))
+        self.padded = {}
+        self.whole_grid = stencil.is_clamped or stencil.is_wrapped
+        self.shape = output.shape
+        self.ghost_depth = stencil.ghost_depth
+        if not self.whole_grid and any(
+                size <= 2 * depth
+                for size, depth in zip(self.shape, self.ghost_depth)):
+            # no interior points
+            self.copy_boundary(grids[0], output)
+            return
+
+        self.stage = stencil
+        self.point_offset = (0,) * len(self.shape)
+        self.neighbor_offset = None
+        self.interior_target = None
+        self.neighbor_target = None
+        self.locals = {}
+        for statement in self.decl.defn:
+            if not isinstance(statement, InteriorPointsLoop):
+                raise StencilException(
+                    "Error: the numpy backend only supports statements "
+                    "within interior points loops")
+            self.interior_target = statement.target
+            self.execute(statement.body)
+        self.copy_boundary(grids[0], output)
+
+    def copy_boundary(self, grid, output):
+        if self.stencil.is_copied:
+            border = np.ones(self.shape, dtype=bool)
+            border[self.region()] = False
+            output[border] = grid[border]
+
+    def region(self):
+        """
+        the slices selecting the computed points of the output
+        """
+        if self.whole_grid:
+            return tuple(slice(None) for _ in self.shape)
+        return self.window((0,) * len(self.shape))
+
+    def window(self, offset):
+        """
+        the slices selecting the grid values read at offset from each of
+        the computed points
+        """
+        if self.whole_grid:
+            return tuple(slice(depth + o, depth + o + size) for depth, o, size
+                         in zip(self.ghost_depth, offset, self.shape))
+        return tuple(slice(depth + o, size - depth + o) for depth, o, size
+                     in zip(self.ghost_depth, offset, self.shape))
+
+    def source(self, grid_name):
+        """
+        the array windows of grid_name are taken from, padded by the ghost
+        depth when every point of the grid is computed
+        """
+        grid = self.grids[grid_name]
+        if grid.shape != self.shape:
+            raise StencilException(
+                "Error: grid {} of shape {} is read at the current point of "
+                "a grid of shape {}".format(grid_name, grid.shape,
+                                            self.shape))
+        if not self.whole_grid:
+            return grid
+        if grid_name not in self.padded:
+            mode = 'edge' if self.stencil.is_clamped else 'wrap'
+            self.padded[grid_name] = np.pad(
+                grid, [(depth, depth) for depth in self.ghost_depth],
+                mode=mode)
+        return self.padded[grid_name]
+
+    def read_offset(self, target):
+        """
+        the offset from the computed points of a read at target, None if
+        target is not the current point or a neighbor
+        """
+        name = getattr(target, 'name', None)
+        if name == self.interior_target:
+            return self.point_offset
+        if name is not None and name == self.neighbor_target:
+            return tuple(a + b for a, b in zip(self.point_offset,
+                                               self.neighbor_offset))
+        return None
+
+    def execute(self, statements):
+        for statement in statements:
+            self.execute_statement(statement)
+
+    def execute_statement(self, node):
+        if isinstance(node, NeighborPointsLoop):
+            try:
+                offsets = self.stage.neighborhood_definition[node.neighbor_id]
+            except IndexError:
+                raise StencilException(
+                    "Error: undefined neighborhood identifier {}".format(
+                        node.neighbor_id))
+            saved = self.neighbor_target, self.neighbor_offset
+            self.neighbor_target = node.neighbor_target
+            for offset in offsets:
+                self.neighbor_offset = tuple(offset)
+                self.execute(node.body)
+            self.neighbor_target, self.neighbor_offset = saved
+        elif isinstance(node, StageBlock):
+            saved = self.stage, self.point_offset
+            self.stage, self.point_offset = node.stage, tuple(node.offset)
+            self.execute(node.body)
+            self.stage, self.point_offset = saved
+        elif isinstance(node, Block):
+            self.execute(node.body)
+        elif isinstance(node, BinaryOp) and isinstance(node.op, Op.Assign):
+            self.store(node.left, None, self.evaluate(node.right))
+        elif isinstance(node, AugAssign):
+            self.store(node.target, BINARY_OPERATORS[type(node.op)],
+                       self.evaluate(node.value))
+        elif isinstance(node, SymbolRef):
+            # a declaration without a value
+            self.locals[node.name] = 0
+        else:
+            raise StencilException(
+                "Error: the numpy backend does not support {}".format(
+                    type(node).__name__))
+
+    def store(self, target, operator, value):
+        if isinstance(target, GridElement):
+            if target.grid_name != self.output_name or \
+                    self.read_offset(target.target) != \
+                    (0,) * len(self.shape):
+                raise StencilException(
+                    "Error: the numpy backend only writes the output grid "
+                    "at the current point")
+            region = self.region()
+            if operator is None:
+                self.output[region] = value
+            else:
+                operator(self.output[region], value,
+                         out=self.output[region], casting='unsafe')
+        elif isinstance(target, SymbolRef):
+            if operator is not None:
+                # never in place, the variable may be a view of a grid
+                value = operator(self.locals[target.name], value)
+            if target.name.startswith("_stage"):
+                # the values of intermediate stages are rounded to the
+                # value type, as their output grid would be
+                value = np.asarray(value).astype(self.output.dtype)
+            self.locals[target.name] = value
+        else:
+            raise StencilException(
+                "Error: the numpy backend cannot assign to {}".format(
+                    type(target).__name__))
+
+    def evaluate(self, node):
+        if isinstance(node, Constant):
+            return node.value
+        if isinstance(node, SymbolRef):
+            if node.name in self.locals:
+                return self.locals[node.name]
+            if node.name in self.stencil.constants:
+                return self.stencil.constants[node.name]
+            raise StencilException(
+                "Error: unknown name {} in kernel".format(node.name))
+        if isinstance(node, GridElement):
+            return self.evaluate_grid_element(node)
+        if isinstance(node, StageElement):
+            return self.locals[node.values[self.read_offset(node.target)]]
+        if isinstance(node, MathFunction):
+            return self.evaluate_math_function(node)
+        if isinstance(node, BinaryOp):
+            operator = BINARY_OPERATORS.get(type(node.op))
+            if operator is None:
+                raise StencilException(
+                    "Error: the numpy backend does not support the operator "
+                    "{}".format(node.op))
+            return operator(self.evaluate(node.left),
+                            self.evaluate(node.right))
+        if isinstance(node, UnaryOp):
+            return UNARY_OPERATORS[type(node.op)](self.evaluate(node.arg))
+        if isinstance(node, TernaryOp):
+            return np.where(self.evaluate(node.cond), self.evaluate(node.then),
+                            self.evaluate(node.elze))
+        if isinstance(node, Cast):
+            return to_int(self.evaluate(node.value))
+        if isinstance(node, FunctionCall):
+            name = getattr(node.func, 'name', node.func)
+            function = FUNCTIONS.get(name, getattr(np, str(name), None))
+            if function is None:
+                raise StencilException(
+                    "Error: the numpy backend does not support the function "
+                    "{}".format(name))
+            return function(*[self.evaluate(arg) for arg in node.args])
+        raise StencilException(
+            "Error: the numpy backend does not support {}".format(
+                type(node).__name__))
+
+    def evaluate_grid_element(self, node):
+        offset = self.read_offset(node.target)
+        if offset is None:
+            # a computed index, typically into a lookup table
+            return self.grids[node.grid_name][self.evaluate(node.target)]
+        if node.grid_name == self.output_name:
+            if any(offset):
+                raise StencilException(
+                    "Error: the numpy backend only reads the output grid at "
+                    "the current point")
+            return self.output[self.region()]
+        return self.source(node.grid_name)[self.window(offset)]
+
+    def evaluate_math_function(self, node):
+        if str(node.func) == 'distance':
+            points = []
+            for arg in node.args:
+                offset = self.read_offset(arg)
+                if offset is None:
+                    raise StencilException(
+                        "Error: distance must be taken between the current "
+                        "point and its neighbors")
+                points.append(tuple(a - b for a, b in
+                                    zip(offset, self.point_offset)))
+            return self.stage.distance(*points)
+        if str(node.func) == 'int':
+            return to_int(self.evaluate(node.args[0]))
+        raise StencilException(
+            "Error: the numpy backend does not support {}".format(node.func))
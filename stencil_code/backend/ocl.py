@@ -1,4 +1,7 @@
 import ctypes as ct
+from copy import deepcopy
+
+import numpy as np
 
 from ctree.c.nodes import If, Lt, Constant, And, SymbolRef, Assign, Add, Mul, \
     Div, Mod, For, AddAssign, ArrayRef, FunctionCall, String, ArrayDef, Ref, \
@@ -53,9 +56,14 @@ def check_ocl_error(code_block, message="kernel"):
 
 
 class StencilOclTransformer(StencilBackend):
+    static_tables = False
+    # the private variable the output point is accumulated in, None to
+    # accumulate in the output grid
+    accumulator = None
+
     def __init__(self, input_grids=None, output_grid=None, kernel=None,
                  block_padding=None, arg_cfg=None, fusable_nodes=None,
-                 testing=False):
+                 testing=False, local_size=None):
         super(StencilOclTransformer, self).__init__(
             input_grids, output_grid, kernel, arg_cfg, fusable_nodes, testing)
         self.block_padding = block_padding
@@ -63,6 +71,8 @@ class StencilOclTransformer(StencilBackend):
         self.load_mem_block = []
         self.macro_defns = []
         self.project = None
+        # a work group shape chosen by the autotuner, otherwise computed
+        self.requested_local_size = local_size
         self.local_size = None
         self.global_size = None
         self.virtual_global_size = None
@@ -94,8 +104,30 @@ class StencilOclTransformer(StencilBackend):
         self.local_block = SymbolRef.unique()
         # generate the proper array macros.
         arg_cfg = self.arg_cfg
-
-        global_size = arg_cfg[0].shape
+        if self.shape_generic and self.is_copied:
+            raise StencilException(
+                "Error: the ocl backend cannot combine shape_generic with "
+                "copy boundary handling")
+        if self.is_wrapped and not self.shape_generic and any(
+                depth > size for depth, size in
+                zip(self.ghost_depth, self.output_grid.shape)):
+            raise StencilException(
+                "Error: the ocl backend wraps grids at least as wide as the "
+                "ghost depth {}, got {}".format(self.ghost_depth,
+                                               self.output_grid.shape))
+
+        missing = set(self.required_extensions()) - \
+            set(cl.clGetDeviceIDs()[-1].extensions)
+        if missing:
+            raise StencilException(
+                "Error: the ocl device lacks {} for the grid types {}".format(
+                    ", ".join(sorted(missing)),
+                    ", ".join(sorted(dtype.name
+                                     for dtype in self.grid_dtypes()))))
+
+        # a shape generic kernel gets its sizes at run time, these are
+        # only used for the kernels compiled for a single shape
+        global_size = self.output_grid.shape
 
         if self.testing:
             local_size = (1, 1, 1)
@@ -103,24 +135,30 @@ class StencilOclTransformer(StencilBackend):
             desired_device_number = -1
             device = cl.clGetDeviceIDs()[desired_device_number]
             lcs = LocalSizeComputer(global_size, device)
-            local_size = lcs.compute_local_size_bulky()
+            if self.requested_local_size is not None:
+                local_size = tuple(self.requested_local_size)
+            else:
+                local_size = lcs.compute_local_size_bulky()
             virtual_global_size = lcs.compute_virtual_global_size(local_size)
             self.global_size = global_size
             self.local_size = local_size
             self.virtual_global_size = virtual_global_size
 
         super(StencilOclTransformer, self).visit_FunctionDecl(node)
-        for index, param in enumerate(node.params[:-1]):
-            # TODO: Transform numpy type to ctype
-            param.type = ct.POINTER(ct.c_float)()
+        grids = list(self.input_grids) + [self.output_grid]
+        for param, grid in zip(node.params, grids):
+            param.type = np.ctypeslib.ndpointer(grid.dtype)()
             param.set_global()
+        for param in node.params[:-1]:
             param.set_const()
         node.set_kernel()
-        node.params[-1].set_global()
-        node.params[-1].type = ct.POINTER(ct.c_float)()
-        node.params.append(SymbolRef(self.local_block.name,
-                                     ct.POINTER(ct.c_float)()))
+        # the local block caches the first input grid
+        node.params.append(SymbolRef(
+            self.local_block.name,
+            np.ctypeslib.ndpointer(self.input_grids[0].dtype)()))
         node.params[-1].set_local()
+        shape_params = self.shape_params()
+        node.params.extend(shape_params)
         node.defn = node.defn[0]
 
         # if boundary handling is copy we have to generate a collection of
@@ -142,12 +180,14 @@ class StencilOclTransformer(StencilBackend):
                 for boundary_handler in self.boundary_handlers
             ]
 
-            self.project.files.append(OclFile('kernel', [node]))
+            self.project.files.append(OclFile(
+                'kernel', self.gen_extensions() + [node]))
 
             for dim, boundary_kernel in enumerate(boundary_kernels):
                 boundary_kernel.set_kernel()
-                self.project.files.append(OclFile(kernel_dim_name(dim),
-                                                  [boundary_kernel]))
+                self.project.files.append(OclFile(
+                    kernel_dim_name(dim),
+                    self.gen_extensions() + [boundary_kernel]))
 
             self.boundary_kernels = boundary_kernels
 
@@ -155,19 +195,27 @@ class StencilOclTransformer(StencilBackend):
             # import ctree
             # ctree.browser_show_ast(boundary_kernels[0])
         else:
-            self.project.files.append(OclFile('kernel', [node]))
+            self.project.files.append(OclFile(
+                'kernel', self.gen_extensions() + [node]))
 
         # print(self.project.files[0])
         # print(self.project.files[-1])
 
+        ndim = arg_cfg[0].ndim
+        if self.shape_generic:
+            global_values = [SymbolRef("_global_size%d" % d)
+                             for d in range(ndim)]
+            local_values = [SymbolRef("_local_size%d" % d)
+                            for d in range(ndim)]
+        else:
+            global_values = [Constant(d) for d in self.virtual_global_size]
+            local_values = [Constant(s) for s in local_size]
         defn = [
             ArrayDef(
-                SymbolRef('global', ct.c_ulong()), arg_cfg[0].ndim,
-                [Constant(d) for d in self.virtual_global_size]
+                SymbolRef('global', ct.c_ulong()), ndim, global_values
             ),
             ArrayDef(
-                SymbolRef('local', ct.c_ulong()), arg_cfg[0].ndim,
-                [Constant(s) for s in local_size]
+                SymbolRef('local', ct.c_ulong()), ndim, local_values
                 # [Constant(s) for s in [512, 512]]  # use this line to force a
                 # opencl local size error
             ),
@@ -180,12 +228,15 @@ class StencilOclTransformer(StencilBackend):
         ) for d in range(len(arg_cfg) + 1)]
         from functools import reduce
         import operator
-        local_mem_size = reduce(
-            operator.mul,
-            (size + 2 * self.kernel.ghost_depth[index]
-             for index, size in enumerate(local_size)),
-            ct.sizeof(cl.cl_float())
-        )
+        if self.shape_generic:
+            local_mem_size = SymbolRef("_local_mem_size")
+        else:
+            local_mem_size = reduce(
+                operator.mul,
+                (size + 2 * self.kernel.ghost_depth[index]
+                 for index, size in enumerate(local_size)),
+                self.input_grids[0].itemsize
+            )
         setargs.append(
             clSetKernelArg(
                 'kernel', len(arg_cfg) + 1,
@@ -193,6 +244,14 @@ class StencilOclTransformer(StencilBackend):
                 NULL()
             )
         )
+        setargs.extend(
+            clSetKernelArg(
+                'kernel', len(arg_cfg) + 2 + index,
+                FunctionCall(SymbolRef('sizeof'), [SymbolRef('int')]),
+                Ref(SymbolRef(param.name))
+            )
+            for index, param in enumerate(shape_params)
+        )
 
         defn.extend(setargs)
         enqueue_call = FunctionCall(SymbolRef('clEnqueueNDRangeKernel'), [
@@ -273,15 +332,24 @@ class StencilOclTransformer(StencilBackend):
         #     )
         # ]
 
-        finish_call = check_ocl_error(
-            FunctionCall(SymbolRef('clFinish'), [SymbolRef('queue')]),
-            "clFinish"
+        # submit the kernels without waiting for them, the caller decides
+        # when to block on the results
+        flush_call = check_ocl_error(
+            FunctionCall(SymbolRef('clFlush'), [SymbolRef('queue')]),
+            "clFlush"
         )
-        defn.extend(finish_call)
+        defn.extend(flush_call)
         defn.append(Return(SymbolRef("error_code")))
 
         params.extend(SymbolRef('buf%d' % d, cl.cl_mem())
                       for d in range(len(arg_cfg) + 1))
+        if self.shape_generic:
+            params.extend(SymbolRef("_global_size%d" % d, ct.c_ulong())
+                          for d in range(ndim))
+            params.extend(SymbolRef("_local_size%d" % d, ct.c_ulong())
+                          for d in range(ndim))
+            params.append(SymbolRef("_local_mem_size", ct.c_ulong()))
+            params.extend(self.shape_params())
 
         control = FunctionDecl(ct.c_int32(), "stencil_control",
                                params=params,
@@ -289,6 +357,23 @@ class StencilOclTransformer(StencilBackend):
 
         return control
 
+    def required_extensions(self):
+        """
+        the extensions of the optional element types the kernels use
+        """
+        dtypes = self.grid_dtypes()
+        return [extension for dtype, extension in [
+            (np.float64, 'cl_khr_fp64'), (np.float16, 'cl_khr_fp16')]
+            if np.dtype(dtype) in dtypes]
+
+    def gen_extensions(self):
+        """
+        the pragmas enabling the optional element types the kernels use
+        """
+        return [
+            StringTemplate("#pragma OPENCL EXTENSION %s : enable" % extension)
+            for extension in self.required_extensions()]
+
     def global_array_macro(self, point):
         dim = len(self.output_grid.shape)
         index = point[dim - 1]
@@ -303,11 +388,24 @@ class StencilOclTransformer(StencilBackend):
 
         return FunctionCall(SymbolRef("global_array_macro"), point)
 
+    def grid_stride(self, d):
+        """
+        stride in elements of dimension d of the output grid, the input
+        grid is laid out the same way
+        """
+        if self.shape_generic:
+            return SymbolRef(self.stride_name(self.output_grid_name, d))
+        return Constant(self.output_grid.strides[d] //
+                        self.output_grid.itemsize)
+
     def gen_global_macro(self):
         index = "(d%d)" % (self.output_grid.ndim - 1)
         for x in reversed(range(self.output_grid.ndim - 1)):
-            ndim = str(int(self.output_grid.strides[x] /
-                           self.output_grid.itemsize))
+            if self.shape_generic:
+                ndim = self.stride_name(self.output_grid_name, x)
+            else:
+                ndim = str(int(self.output_grid.strides[x] /
+                               self.output_grid.itemsize))
             index += "+((d%s) * %s)" % (str(x), ndim)
         return index
 
@@ -349,13 +447,11 @@ class StencilOclTransformer(StencilBackend):
         dim = self.output_grid.ndim
         index = get_global_id(dim - 1)
         for d in reversed(range(dim - 1)):
-            stride = self.output_grid.strides[d] // \
-                self.output_grid.itemsize
             index = Add(
                 index,
                 Mul(
                     get_global_id(d),
-                    Constant(stride)
+                    self.grid_stride(d)
                 )
             )
         return index
@@ -444,20 +540,14 @@ class StencilOclTransformer(StencilBackend):
                     ArrayRef(
                         SymbolRef(self.input_names[0]),
                         self.global_array_macro(
-                            [FunctionCall(
-                                SymbolRef('clamp'),
-                                [Cast(ct.c_int(), Sub(Add(
-                                    SymbolRef("local_id%d" % (dim - d - 1)),
-                                    Mul(FunctionCall(
-                                        SymbolRef('get_group_id'),
-                                        [Constant(d)]),
-                                        get_local_size(d))
-                                ), Constant(self.kernel.ghost_depth[d]))),
-                                    Constant(0), Constant(
-                                        self.arg_cfg[0].shape[d]-1
-                                    )
-                                ]
-                            ) for d in range(0, dim)]
+                            [self.edge_index(Cast(ct.c_int(), Sub(Add(
+                                SymbolRef("local_id%d" % (dim - d - 1)),
+                                Mul(FunctionCall(
+                                    SymbolRef('get_group_id'),
+                                    [Constant(d)]),
+                                    get_local_size(d))
+                            ), Constant(self.kernel.ghost_depth[d]))), d)
+                             for d in range(0, dim)]
                         )
                     )
                 )]
@@ -465,23 +555,34 @@ class StencilOclTransformer(StencilBackend):
         )
         return body
 
+    def edge_index(self, index, d):
+        """
+        the index of dimension d the local block is loaded from, clamped to
+        the grid or, for wrap boundary handling, wrapped around it and then
+        clamped so the work items overhanging the grid stay within it
+        """
+        if self.is_wrapped:
+            index = FunctionCall(SymbolRef('wrap'), [index,
+                                                     self.grid_size(d)])
+        return FunctionCall(SymbolRef('clamp'),
+                            [index, Constant(0), self.grid_size(d, 1)])
+
     # noinspection PyPep8Naming
     def visit_InteriorPointsLoop(self, node):
         dim = len(self.output_grid.shape)
         self.kernel_target = node.target
         condition = And(
             Lt(get_global_id(0),
-               Constant(self.arg_cfg[0].shape[0] - self.ghost_depth[0])),
+               self.grid_size(0, self.ghost_depth[0])),
             GtE(get_global_id(0),
                 Constant(self.ghost_depth[0]))
         )
-        for d in range(1, len(self.arg_cfg[0].shape)):
+        for d in range(1, dim):
             condition = And(
                 condition,
                 And(
                     Lt(get_global_id(d),
-                       Constant(self.arg_cfg[0].shape[d] -
-                                self.ghost_depth[d])),
+                       self.grid_size(d, self.ghost_depth[d])),
                     GtE(get_global_id(d),
                         Constant(self.ghost_depth[d]))
                 )
@@ -494,6 +595,13 @@ class StencilOclTransformer(StencilBackend):
             CppDefine("global_array_macro", ["d%d" % i for i in range(dim)],
                       self.gen_global_macro())
         ]
+        if self.is_wrapped:
+            # the loads reach at most the ghost depth beyond the edges, so
+            # one add or subtract of the size wraps them, no modulo needed
+            self.macro_defns.append(CppDefine(
+                "wrap", ["_a", "_n"],
+                StringTemplate("((_a) < 0 ? (_a) + (_n) : "
+                               "(_a) >= (_n) ? (_a) - (_n) : (_a))")))
         body.extend(self.macro_defns)
 
         global_idx = 'global_index'
@@ -512,22 +620,39 @@ class StencilOclTransformer(StencilBackend):
                                    Constant(self.ghost_depth[d]))))
             self.var_list.append("local_id%d" % d)
 
+        output = ArrayRef(SymbolRef(self.output_grid_name),
+                          SymbolRef(self.output_index))
+        if self.kernel.accumulator_dtype:
+            # the point is computed in a private variable of the accumulator
+            # type and rounded to the type of the output when it is stored
+            self.accumulator = self.gen_fresh_var()
+            self.stencil_op.append(Assign(
+                SymbolRef(self.accumulator, self.value_type()),
+                deepcopy(output)))
         for child in map(self.visit, node.body):
             if isinstance(child, list):
                 self.stencil_op.extend(child)
             else:
                 self.stencil_op.append(child)
+        if self.accumulator is not None:
+            self.stencil_op.append(Assign(output,
+                                          SymbolRef(self.accumulator)))
+            self.accumulator = None
+        body.extend(self.neighbor_tables)
+        self.neighbor_tables = []
 
         conditional = None
         for dim in range(len(self.output_grid.shape)):
-            if self.virtual_global_size[dim] != self.global_size[dim]:
+            # the work groups of a shape generic kernel may always overhang
+            if self.shape_generic or \
+                    self.virtual_global_size[dim] != self.global_size[dim]:
                 if conditional is None:
                     conditional = Lt(get_global_id(dim),
-                                     Constant(self.global_size[dim]))
+                                     self.grid_size(dim))
                 else:
                     conditional = And(conditional,
                                       Lt(get_global_id(dim),
-                                         Constant(self.global_size[dim])))
+                                         self.grid_size(dim)))
 
         if conditional is not None:
             body.append(If(conditional, self.stencil_op))
@@ -572,17 +697,15 @@ class StencilOclTransformer(StencilBackend):
         if isinstance(target, SymbolRef):
 
             target_name = target.name
-            if target_name == self.kernel_target:
-                if grid_name == self.output_grid_name:
-                    return ArrayRef(SymbolRef(self.output_grid_name),
-                                    SymbolRef(self.output_index))
-                elif grid_name in self.input_dict:
-                    pt = list(map(lambda x: SymbolRef(x), self.var_list))
-                    index = self.local_array_macro(pt)
-                    return ArrayRef(self.local_block, index)
-            else:
-                pt = list(map(lambda x, y: Add(SymbolRef(x), Constant(y)),
-                              self.var_list, self.offset_list))
+            if target_name == self.kernel_target and \
+                    grid_name == self.output_grid_name:
+                if self.accumulator is not None:
+                    return SymbolRef(self.accumulator)
+                return ArrayRef(SymbolRef(self.output_grid_name),
+                                SymbolRef(self.output_index))
+            if target_name != self.kernel_target or \
+                    grid_name in self.input_dict:
+                pt = self.read_point(target_name == self.kernel_target)
                 index = self.local_array_macro(pt)
                 return ArrayRef(self.local_block, index)
         elif isinstance(target, FunctionCall) or \
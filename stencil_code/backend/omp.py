@@ -1,11 +1,72 @@
 from ctree.omp.nodes import *
 from ctree.omp.macros import *
-from ctree.cpp.nodes import CppDefine
+from .c import StencilCTransformer
 from .stencil_backend import *
-from ctypes import c_int, POINTER, c_float, c_double
+from ctypes import POINTER, c_char, c_double, c_long
 
 
-class StencilOmpTransformer(StencilBackend):  #pragma: no cover
+class OmpCollapseClause(OmpClause):
+    """collapse(count), count may be lowered after the loops are optimized"""
+    _fields = []
+
+    def __init__(self, count=1):
+        self.count = count
+
+    def codegen(self, indent=0):
+        return "collapse(%d)" % self.count
+
+
+class OmpScheduleClause(OmpClause):
+    _fields = []
+
+    def __init__(self, kind='static', chunk=None):
+        self.kind = kind
+        self.chunk = chunk
+
+    def codegen(self, indent=0):
+        if self.chunk is None:
+            return "schedule(%s)" % self.kind
+        return "schedule(%s, %d)" % (self.kind, self.chunk)
+
+
+class OmpProcBindClause(OmpClause):
+    """proc_bind(kind), how the threads are placed, close, spread or master"""
+    _fields = []
+
+    def __init__(self, kind='close'):
+        self.kind = kind
+
+    def codegen(self, indent=0):
+        return "proc_bind(%s)" % self.kind
+
+
+class OmpLoop(OmpNode):
+    """
+    #pragma omp <directive> <clauses> in front of a loop, directive is
+    e.g. parallel for, simd or parallel for simd
+    """
+    _fields = ['clauses']
+
+    def __init__(self, directive="parallel for", clauses=None):
+        self.directive = directive
+        self.clauses = clauses if clauses else []
+
+    def codegen(self, indent=0):
+        return " ".join(["#pragma omp", self.directive] +
+                        [clause.codegen() for clause in self.clauses])
+
+
+class StencilOmpTransformer(StencilCTransformer):
+    """
+    the c backend with the loop nest shared among OpenMP threads, the
+    outer loops are collapsed into one parallel loop and the innermost
+    loop is vectorized, see Stencil for the omp_collapse, omp_schedule,
+    num_threads, proc_bind and simd options
+
+    stencil_first_touch clears or fills a buffer with the threads and the
+    schedule of the kernel, so on NUMA hosts each page of a grid is placed
+    on the node of the thread that later computes it
+    """
     def visit_CFile(self, node):
         node.config_target = 'omp'
         # Assumes only one node in body, TODO: Can this be done?
@@ -13,95 +74,89 @@ class StencilOmpTransformer(StencilBackend):  #pragma: no cover
         return node
 
     def visit_FunctionDecl(self, node):
-        super(StencilOmpTransformer, self).visit_FunctionDecl(node)
-        for index, arg in enumerate(self.input_grids + (self.output_grid,)):
-            defname = "_%s_array_macro" % node.params[index].name
-            params = ','.join(["_d"+str(x) for x in range(arg.ndim)])
-            params = "(%s)" % params
-            calc = "((_d%d)" % (arg.ndim - 1)
-            for x in range(arg.ndim - 1):
-                ndim = str(int(arg.strides[x]/arg.itemsize))
-                calc += "+((_d%s) * %s)" % (str(x), ndim)
-            calc += ")"
-            params = ["_d"+str(x) for x in range(arg.ndim)]
-            node.defn.insert(0, CppDefine(defname, params, calc))
-        abs_decl = FunctionDecl(
-            c_int(), SymbolRef('abs'), [SymbolRef('n', c_int())]
+        return super(StencilOmpTransformer, self).visit_FunctionDecl(node) + \
+            [self.gen_first_touch()]
+
+    def gen_headers(self):
+        return [IncludeOmpHeader(), StringTemplate("#include <string.h>")]
+
+    def parallel_clauses(self):
+        """
+        the clauses shared by every parallel loop, so that the pages a
+        thread touches first are the pages it computes
+        """
+        kernel = self.kernel
+        clauses = [OmpScheduleClause(*kernel.omp_schedule)]
+        if kernel.num_threads:
+            clauses.append(OmpNumThreadsClause(kernel.num_threads))
+        if kernel.proc_bind:
+            clauses.append(OmpProcBindClause(kernel.proc_bind))
+        return clauses
+
+    def gen_first_touch(self):
+        """
+        int stencil_first_touch(char *_dst, char *_src, long _bytes,
+        long _row_bytes) copies _src to _dst, or clears _dst when _src is
+        NULL, one row of _row_bytes per iteration
+        """
+        row_start = Mul(SymbolRef("_row"), SymbolRef("_row_bytes"))
+        row_size = FunctionCall(SymbolRef("min"), [
+            SymbolRef("_row_bytes"), Sub(SymbolRef("_bytes"), row_start)])
+        rows = Div(Sub(Add(SymbolRef("_bytes"), SymbolRef("_row_bytes")),
+                       Constant(1)), SymbolRef("_row_bytes"))
+        loop = For(
+            Assign(SymbolRef("_row", c_long()), Constant(0)),
+            Lt(SymbolRef("_row"), rows),
+            PostInc(SymbolRef("_row")),
+            [If(SymbolRef("_src"),
+                [FunctionCall(SymbolRef("memcpy"), [
+                    Add(SymbolRef("_dst"), row_start),
+                    Add(SymbolRef("_src"), deepcopy(row_start)), row_size])],
+                [FunctionCall(SymbolRef("memset"), [
+                    Add(SymbolRef("_dst"), deepcopy(row_start)), Constant(0),
+                    deepcopy(row_size)])])]
         )
-        macro = CppDefine("min", [SymbolRef('_a'), SymbolRef('_b')],
-                          TernaryOp(Lt(SymbolRef('_a'), SymbolRef('_b')),
-                          SymbolRef('_a'), SymbolRef('_b')))
-        node.params.append(SymbolRef('duration', POINTER(c_float)))
-        start_time = Assign(SymbolRef('start_time', c_double()), omp_get_wtime())
-        node.defn.insert(0, start_time)
+        params = [SymbolRef("_dst", POINTER(c_char)()),
+                  SymbolRef("_src", POINTER(c_char)()),
+                  SymbolRef("_bytes", c_long()),
+                  SymbolRef("_row_bytes", c_long())]
+        return FunctionDecl(c_int(), "stencil_first_touch", params, [
+            OmpLoop("parallel for", self.parallel_clauses()), loop,
+            Return(Constant(0))])
+
+    def gen_zero_fill(self, target, begin, end):
+        return [OmpLoop("parallel for", self.parallel_clauses()),
+                super(StencilOmpTransformer, self).gen_zero_fill(
+                    target, begin, end)]
+
+    def gen_timer(self):
+        start_time = Assign(SymbolRef('start_time', c_double()),
+                            omp_get_wtime())
         end_time = Assign(Deref(SymbolRef('duration')),
                           Sub(omp_get_wtime(), SymbolRef('start_time')))
-        node.defn.append(end_time)
-        return [IncludeOmpHeader(), abs_decl, macro, node]
+        return start_time, end_time
 
     def visit_InteriorPointsLoop(self, node):
+        loop_nests = super(StencilOmpTransformer, self).visit_InteriorPointsLoop(
+            node)
+        if not isinstance(loop_nests, list):
+            loop_nests = [loop_nests]
         dim = len(self.output_grid.shape)
-        self.kernel_target = node.target
-        curr_node = None
-        ret_node = None
-        for d in range(dim):
-            target = SymbolRef(self.gen_fresh_var())
-            self.var_list.append(target.name)
-            for_loop = For(
-                Assign(SymbolRef(target.name, c_int()),
-                       Constant(self.ghost_depth[d])),
-                LtE(target,
-                    Constant(
-                        self.output_grid.shape[d] -
-                        self.ghost_depth[d] - 1)
-                    ),
-                PostInc(target),
-                [])
-
-            if d == 0:
-                ret_node = for_loop
-            else:
-                curr_node.body = [for_loop]
-                if d == dim - 2:
-                    curr_node.body.insert(0, OmpParallelFor())
-                elif d == dim - 1:
-                    curr_node.body.insert(0, OmpIvDep())
-            curr_node = for_loop
-        self.output_index = self.gen_fresh_var()
-        pt = [SymbolRef(x) for x in self.var_list]
-        macro = self.gen_array_macro(self.output_grid_name, pt)
-        curr_node.body = [Assign(SymbolRef(self.output_index, c_int()),
-                                 macro)]
-        for elem in map(self.visit, node.body):
-            if type(elem) == list:
-                curr_node.body.extend(elem)
-            else:
-                curr_node.body.append(elem)
-        self.kernel_target = None
-        return ret_node
-
-    # Handle array references
-    def visit_GridElement(self, node):
-        grid_name = node.grid_name
-        target = node.target
-        if isinstance(target, SymbolRef):
-            target = target.name
-            if target == self.kernel_target:
-                if grid_name is self.output_grid_name:
-                    return ArrayRef(SymbolRef(self.output_grid_name),
-                                    SymbolRef(self.output_index))
-                elif grid_name in self.input_dict:
-                    # grid = self.input_dict[grid_name]
-                    pt = list(map(lambda x: SymbolRef(x), self.var_list))
-                    index = self.gen_array_macro(grid_name, pt)
-                    return ArrayRef(SymbolRef(grid_name), index)
-            else:
-                pt = list(map(lambda x, y: Add(SymbolRef(x), Constant(y)),
-                              self.var_list, self.offset_list))
-                index = self.gen_array_macro(grid_name, pt)
-                return ArrayRef(SymbolRef(grid_name), index)
-        elif isinstance(target, FunctionCall) or \
-                isinstance(target, MathFunction):
-            return ArrayRef(SymbolRef(grid_name), self.visit(target))
-        raise StencilException(
-            "Unsupported GridElement encountered: {} type {} {}".format(grid_name, type(target), repr(target)))
+        kernel = self.kernel
+        statements = []
+        for loop_nest in loop_nests:
+            clauses = [OmpCollapseClause(kernel.omp_collapse or
+                                         max(1, dim - 1))
+                       ] + self.parallel_clauses()
+            if dim == 1:
+                directive = "parallel for simd" if kernel.simd else \
+                    "parallel for"
+                statements += [OmpLoop(directive, clauses), loop_nest]
+                continue
+            if kernel.simd:
+                loop = loop_nest
+                for _ in range(dim - 2):
+                    loop = loop.body[0]
+                loop.body.insert(0, OmpLoop("simd"))
+            statements += [OmpLoop("parallel for", clauses), loop_nest]
+        return statements
@@ -1,14 +1,29 @@
 from copy import deepcopy
 import ctree
+import numpy as np
 
 from ctree.c.nodes import *
-from ctypes import c_int
+from ctree.cpp.nodes import CppDefine
+from ctypes import c_int, c_float, c_double, POINTER
+from ctree.types import register_type_codegenerators
 from ctree.visitors import NodeTransformer
 from stencil_code.stencil_model import *
 from stencil_code.stencil_exception import StencilException
 
+# element types ctree has no c for, half is the opencl name, the c backend
+# defines it, and ctree spells uint8 as the invalid unsigned byte
+register_type_codegenerators({
+    np.float16: lambda t: "half",
+    np.uint8: lambda t: "unsigned char",
+    np.uint64: lambda t: "unsigned long",
+})
+
 
 class StencilBackend(NodeTransformer):
+    # whether the constant tables of rolled neighbor loops are declared
+    # static, OpenCL C only allows that at program scope
+    static_tables = True
+
     def __init__(self, input_grids=None, output_grid=None, kernel=None, arg_cfg=None,
                  fusable_nodes=None, testing=False):
         try:
@@ -22,7 +37,9 @@ class StencilBackend(NodeTransformer):
         self.kernel = kernel
         self.ghost_depth = kernel.ghost_depth
         self.is_clamped = kernel.is_clamped
+        self.is_wrapped = kernel.is_wrapped
         self.is_copied = kernel.is_copied
+        self.shape_generic = kernel.shape_generic
         self.next_fresh_var = 0
         self.output_index = None
         self.neighbor_grid_name = None
@@ -36,6 +53,18 @@ class StencilBackend(NodeTransformer):
         self.arg_cfg = arg_cfg
         self.fusable_nodes = fusable_nodes
         self.testing = testing
+        # the stage of a fused stencil being generated and the offset of
+        # the point it is evaluated at
+        self.stage = kernel
+        self.point_offset = (0,) * kernel.dim
+        # constant tables of the rolled neighbor loops, declared by the
+        # subclasses ahead of the loops, and the names used by the rolled
+        # loop being generated
+        self.neighbor_tables = []
+        self.rolled_loop_count = 0
+        self.neighbor_loop_var = None
+        self.neighbor_offsets = None
+        self.neighbor_weights = None
         super(StencilBackend, self).__init__()
 
     def visit_FunctionDecl(self, node):
@@ -49,6 +78,8 @@ class StencilBackend(NodeTransformer):
                 self.input_names.append(arg.name)
             else:
                 self.output_grid_name = arg.name
+        self.output_fully_assigned = StencilBackend.assigns_every_point(
+            node.defn, self.output_grid_name)
         node.defn = list(map(self.visit, node.defn))
         node.name = "stencil_kernel"
 
@@ -56,6 +87,88 @@ class StencilBackend(NodeTransformer):
         self.next_fresh_var += 1
         return "x%d" % self.next_fresh_var
 
+    def value_type(self):
+        """
+        the type the values of a point are accumulated in, the kernel's
+        accumulator_dtype or else the dtype of the output grid
+        """
+        return np.dtype(self.kernel.accumulator_dtype or
+                        self.output_grid.dtype).type()
+
+    def grid_dtypes(self):
+        """
+        the dtypes of every grid and of the accumulator
+        """
+        dtypes = set(np.dtype(grid.dtype) for grid in
+                     list(self.input_grids) + [self.output_grid])
+        dtypes.add(np.dtype(type(self.value_type())))
+        return dtypes
+
+    def grid_size(self, d, minus=0):
+        """
+        size of dimension d of the grids less minus, a Constant, or for a
+        shape generic kernel an expression of its _shape parameters
+        """
+        if self.shape_generic:
+            size = SymbolRef("_shape%d" % d)
+            if minus < 0:
+                return Add(size, Constant(-minus))
+            return Sub(size, Constant(minus)) if minus else size
+        return Constant(self.output_grid.shape[d] - minus)
+
+    def grid_volume(self, first=0):
+        """
+        number of points in dimensions first and up of the grids
+        """
+        if not self.shape_generic:
+            return Constant(int(np.prod(self.output_grid.shape[first:])))
+        volume = Constant(1)
+        for d in range(first, self.output_grid.ndim):
+            volume = SymbolRef("_shape%d" % d) if d == first else \
+                Mul(volume, SymbolRef("_shape%d" % d))
+        return volume
+
+    @staticmethod
+    def stride_name(grid_name, d):
+        return "_%s_stride%d" % (grid_name, d)
+
+    def shape_params(self):
+        """
+        the runtime parameters of a shape generic kernel, the size of each
+        dimension followed by the strides, in elements, of every grid, an
+        empty list for kernels compiled for one shape
+        """
+        if not self.shape_generic:
+            return []
+        params = [SymbolRef("_shape%d" % d, c_int())
+                  for d in range(self.output_grid.ndim)]
+        for name, grid in zip(self.input_names + [self.output_grid_name],
+                              self.input_grids + (self.output_grid,)):
+            params.extend(SymbolRef(self.stride_name(name, d), c_int())
+                          for d in range(grid.ndim - 1))
+        return params
+
+    def gen_array_macro_definitions(self, node):
+        """
+        a flat index macro for each grid parameter of node, the strides are
+        constants taken from the grids unless the kernel is shape generic
+        """
+        definitions = []
+        for index, arg in enumerate(self.input_grids + (self.output_grid,)):
+            name = node.params[index].name
+            calc = "((_d%d)" % (arg.ndim - 1)
+            for x in range(arg.ndim - 1):
+                if self.shape_generic:
+                    stride = self.stride_name(name, x)
+                else:
+                    stride = str(int(arg.strides[x]/arg.itemsize))
+                calc += "+((_d%s) * %s)" % (str(x), stride)
+            calc += ")"
+            params = ["_d"+str(x) for x in range(arg.ndim)]
+            definitions.append(
+                CppDefine("_%s_array_macro" % name, params, calc))
+        return definitions
+
     # def visit_InteriorPointsLoop(self, node):
     #     """
     #     must be implemented by subclass this is checked in __init__
@@ -69,26 +182,95 @@ class StencilBackend(NodeTransformer):
         unrolls the neighbor points loop, appending each current block of the body to a new
         body for each neighbor point, a side effect of this is local python functions of the
         neighbor point can be collapsed out, for example, a custom python distance function based
-        on neighbor distance can be resolved at transform time
-        DANGER: this blows up on large neighborhoods
+        on neighbor distance can be resolved at transform time.
+        Stencils created with should_unroll=False get a rolled loop over
+        a table of the offsets instead, see gen_rolled_neighbor_loop
         :param node:
         :return:
         """
-        # TODO: unrolling blows up when neighborhood size id large. 27pt laplacian has 5K neighbors
         neighbors_id = node.neighbor_id
-        # grid_name = node.grid_name
-        # grid = self.input_dict[grid_name]
-        zero_point = tuple([0 for x in range(self.kernel.dim)])
         self.neighbor_target = node.neighbor_target
-        # self.neighbor_grid_name = grid_name
         body = []
-        for x in self.kernel.neighbors(zero_point, neighbors_id):
-            self.offset_list = list(x)
-            for statement in node.body:
-                body.append(self.visit(deepcopy(statement)))
+        # the offsets themselves, neighbors() clamps them to the shape of
+        # the grid the python backend last ran on
+        try:
+            offsets = self.stage.neighborhood_definition[neighbors_id]
+        except IndexError:
+            raise StencilException(
+                "Error: undefined neighborhood identifier {}".format(
+                    neighbors_id))
+        # the stages of a fused stencil read values computed for each
+        # offset separately so they are always unrolled
+        if self.stage is self.kernel and not self.kernel.should_unroll:
+            body = self.gen_rolled_neighbor_loop(node, offsets)
+        else:
+            for x in offsets:
+                self.offset_list = list(x)
+                for statement in node.body:
+                    body.append(self.visit(deepcopy(statement)))
         self.neighbor_target = None
         return body
 
+    def gen_rolled_neighbor_loop(self, node, offsets):
+        """
+        generates a single loop over the neighbors, the body is generated
+        once and reads the offset of the current neighbor from a constant
+        table for each dimension.  Calls of distance() are evaluated at
+        transform time for every neighbor into a table of weights.  The
+        tables are added to neighbor_tables.
+        :param node: the NeighborPointsLoop
+        :param offsets: the offsets of its neighborhood
+        :return: the For node
+        """
+        number = self.rolled_loop_count
+        self.rolled_loop_count += 1
+        loop_var = "_neighbor%d" % number
+        dim = len(self.point_offset)
+        self.neighbor_loop_var = loop_var
+        self.neighbor_offsets = ["_neighbor%d_offset%d" % (number, d)
+                                 for d in range(dim)]
+        self.neighbor_weights = None
+        self.offset_list = None
+        body = []
+        for statement in node.body:
+            child = self.visit(deepcopy(statement))
+            if isinstance(child, list):
+                body.extend(child)
+            else:
+                body.append(child)
+
+        for d, name in enumerate(self.neighbor_offsets):
+            self.neighbor_tables.append(self.gen_constant_table(
+                name, c_int(), [Constant(int(x[d])) for x in offsets]))
+        if self.neighbor_weights is not None:
+            zero_point = (0,) * dim
+            weight_type = c_double() if np.dtype(type(
+                self.value_type())) == np.float64 else c_float()
+            self.neighbor_tables.append(self.gen_constant_table(
+                self.neighbor_weights, weight_type,
+                [Constant(float(self.distance(zero_point, tuple(x))))
+                 for x in offsets]))
+        self.neighbor_loop_var = None
+        self.neighbor_offsets = None
+        self.neighbor_weights = None
+        return For(
+            Assign(SymbolRef(loop_var, c_int()), Constant(0)),
+            Lt(SymbolRef(loop_var), Constant(len(offsets))),
+            PostInc(SymbolRef(loop_var)),
+            body
+        )
+
+    def gen_constant_table(self, name, ctype, values):
+        """
+        the declaration of a constant array initialized to values
+        """
+        symbol = SymbolRef(name, ctype)
+        symbol.set_const()
+        if self.static_tables:
+            symbol.set_static()
+        return ArrayDef(symbol, len(values),
+                        Array(ctype, len(values), values))
+
     def visit_GridElement(self, node):  # pragma no cover
         grid_name = node.grid_name
         target = node.target
@@ -113,13 +295,344 @@ class StencilBackend(NodeTransformer):
             return ArrayRef(SymbolRef(grid_name), self.visit(target))
         raise Exception("Found GridElement that is not supported")
 
+    def read_offsets(self, at_center):
+        """
+        the offset from the current point of a grid read, the current
+        neighbor offset unless the read is at the center, shifted by the
+        offset of the fused stage being generated
+        :param at_center: True for a read at the interior points target
+        """
+        if at_center:
+            return list(self.point_offset)
+        if self.neighbor_offsets is not None:
+            # a rolled neighbor loop, the offsets are read from its tables
+            offsets = []
+            for a, name in zip(self.point_offset, self.neighbor_offsets):
+                entry = ArrayRef(SymbolRef(name),
+                                 SymbolRef(self.neighbor_loop_var))
+                offsets.append(Add(entry, Constant(a)) if a else entry)
+            return offsets
+        return [a + b for a, b in zip(self.point_offset, self.offset_list)]
+
+    def read_point(self, at_center):
+        """
+        the index in each dimension of a grid read, relative to the loop
+        variables in var_list
+        :param at_center: True for a read at the interior points target
+        """
+        offsets = self.read_offsets(at_center)
+        if at_center and not any(offsets):
+            return [SymbolRef(x) for x in self.var_list]
+        return [Add(SymbolRef(x), Constant(y)
+                    if isinstance(y, (int, np.integer)) else y)
+                for x, y in zip(self.var_list, offsets)]
+
+    def visit_StageBlock(self, node):
+        saved = self.stage, self.point_offset, self.distance
+        self.stage, self.point_offset = node.stage, tuple(node.offset)
+        self.distance = node.stage.distance
+        body = []
+        for statement in node.body:
+            if isinstance(statement, BinaryOp) and \
+                    isinstance(statement.left, SymbolRef) and \
+                    statement.left.name.startswith("_stage"):
+                # the values of the intermediate stages are declared float
+                # by FusedStencil, they are held in the value type like the
+                # output grid of a stage run on its own
+                statement.left.type = self.value_type()
+            child = self.visit(statement)
+            if isinstance(child, list):
+                body.extend(child)
+            else:
+                body.append(child)
+        self.stage, self.point_offset, self.distance = saved
+        return body
+
+    def visit_StageElement(self, node):
+        offset = self.read_offsets(node.target.name == self.kernel_target)
+        return SymbolRef(node.values[tuple(offset)])
+
     def visit_MathFunction(self, node):
         if str(node.func) == 'distance':
+            if self.neighbor_loop_var is not None:
+                if self.neighbor_weights is None:
+                    self.neighbor_weights = "%s_weight" % \
+                        self.neighbor_loop_var
+                return ArrayRef(SymbolRef(self.neighbor_weights),
+                                SymbolRef(self.neighbor_loop_var))
             zero_point = tuple([0 for _ in range(len(self.offset_list))])
             return Constant(self.distance(zero_point, self.offset_list))
         elif str(node.func) == 'int':
             return Cast(c_int(), self.visit(node.args[0]))
 
+    @staticmethod
+    def assigns_every_point(statements, output_grid_name):
+        """
+        checks whether every interior points loop in statements starts with
+        a plain assignment to the output grid at the current point, in which
+        case the kernel never depends on the previous contents of the output
+        :param statements: the body of the kernel FunctionDecl
+        :param output_grid_name: name of the output grid parameter
+        :return: True if the previous output contents are never read
+        """
+        for loop in statements:
+            if not isinstance(loop, InteriorPointsLoop):
+                continue
+            # the intermediate stages of a fused stencil write no grid
+            body = [statement for statement in loop.body
+                    if not isinstance(statement, StageBlock) or
+                    statement.final]
+            if body and isinstance(body[0], StageBlock):
+                body = body[0].body
+            first = body[0] if body else None
+            if not (isinstance(first, BinaryOp) and
+                    isinstance(first.op, Op.Assign) and
+                    isinstance(first.left, GridElement) and
+                    first.left.grid_name == output_grid_name and
+                    isinstance(first.left.target, SymbolRef) and
+                    first.left.target.name == loop.target):
+                return False
+        return True
+
+    def gen_zero_fill(self, target, begin, end):
+        """
+        generates a loop that clears target[begin:end], used when the kernel
+        accumulates into its output and a buffer is being reused
+        :param target: name of the grid to clear
+        :param begin: first flat index, a ctree expression
+        :param end: one past the last flat index, a ctree expression
+        :return: a For node
+        """
+        return For(
+            Assign(SymbolRef("_index", c_int()), begin),
+            Lt(SymbolRef("_index"), end),
+            PostInc(SymbolRef("_index")),
+            [Assign(ArrayRef(SymbolRef(target), SymbolRef("_index")),
+                    Constant(0))]
+        )
+
+    def gen_run_steps(self, node):
+        """
+        builds a driver that applies the stencil_kernel function described
+        by node n_steps times, ping-ponging between the output grid and a
+        second scratch grid of the same shape.  The first step reads from the
+        input grid, odd steps write to the scratch grid and even steps write
+        back to the output grid, so the result ends up in the output grid when
+        n_steps is odd and in the scratch grid when n_steps is even.
+        Kernels that accumulate into their output get the target grid
+        cleared before each step.
+        Grid parameter types are fixed up by the specializer
+        :param node: the stencil_kernel FunctionDecl
+        :return: a list of FunctionDecls ending with stencil_run_steps
+        """
+        if self.kernel.temporal_block > 1:
+            return self.gen_temporal_run_steps(node)
+
+        shape_params = self.shape_params()
+        grid_count = len(node.params) - 1 - len(shape_params)
+        grid_names = [param.name for param in node.params[:grid_count]]
+        aux_names = grid_names[1:-1]
+        params = [SymbolRef(name) for name in grid_names]
+        params.append(SymbolRef("_scratch_grid"))
+        params.append(SymbolRef("_n_steps", c_int()))
+        params.extend(shape_params)
+        params.append(SymbolRef("duration", POINTER(c_double)))
+        shape_args = [SymbolRef(param.name) for param in shape_params]
+
+        def step(source, target):
+            zero_fill = []
+            if not self.output_fully_assigned:
+                # the kernel accumulates into its output so the stale
+                # contents from two steps ago must be cleared first
+                zero_fill.append(self.gen_zero_fill(
+                    target, Constant(0), self.grid_volume()))
+            return zero_fill + [
+                FunctionCall(
+                    SymbolRef("stencil_kernel"),
+                    [SymbolRef(source)] +
+                    [SymbolRef(name) for name in aux_names] +
+                    [SymbolRef(target)] + deepcopy(shape_args) +
+                    [Ref(SymbolRef("_step_duration"))]
+                ),
+                AddAssign(Deref(SymbolRef("duration")),
+                          SymbolRef("_step_duration")),
+            ]
+
+        output_name = grid_names[-1]
+        step_loop = For(
+            Assign(SymbolRef("_step", c_int()), Constant(1)),
+            Lt(SymbolRef("_step"), SymbolRef("_n_steps")),
+            PostInc(SymbolRef("_step")),
+            [If(Mod(SymbolRef("_step"), Constant(2)),
+                step(output_name, "_scratch_grid"),
+                step("_scratch_grid", output_name))]
+        )
+        defn = [SymbolRef("_step_duration", c_double()),
+                Assign(Deref(SymbolRef("duration")), Constant(0))]
+        defn.append(FunctionCall(
+            SymbolRef("stencil_kernel"),
+            [SymbolRef(name) for name in grid_names] + shape_args +
+            [Ref(SymbolRef("_step_duration"))]
+        ))
+        defn.append(AddAssign(Deref(SymbolRef("duration")),
+                              SymbolRef("_step_duration")))
+        defn.append(step_loop)
+        defn.append(Return(Constant(0)))
+        return [FunctionDecl(c_int(), "stencil_run_steps", params, defn)]
+
+    def temporal_tile_size(self):
+        """
+        number of axis 0 planes in a temporal block tile, either set
+        explicitly on the stencil or picked so that the planes touched by
+        all the fused steps of one tile, in both buffers, fit in
+        temporal_cache_bytes
+        :return: tile height in planes, an expression for shape generic
+            kernels that do not set temporal_tile
+        """
+        if self.kernel.temporal_tile:
+            return self.kernel.temporal_tile
+        skew = self.ghost_depth[0] * self.kernel.temporal_block
+        if self.shape_generic:
+            # same computation, done at run time, as a ctree expression
+            planes = Div(Constant(self.kernel.temporal_cache_bytes),
+                         Mul(Constant(2 * self.output_grid.itemsize),
+                             self.grid_volume(1)))
+            tile = Sub(planes, Constant(2 * skew))
+            least = Constant(max(1, self.ghost_depth[0]))
+            return TernaryOp(Gt(tile, least), deepcopy(tile), least)
+        shape = self.output_grid.shape
+        plane_bytes = int(np.prod(shape[1:])) * self.output_grid.itemsize
+        planes = self.kernel.temporal_cache_bytes // (2 * plane_bytes)
+        return max(1, self.ghost_depth[0], planes - 2 * skew)
+
+    def gen_temporal_run_steps(self, node):
+        """
+        builds a time skewed run_steps driver.  The stencil_kernel body is
+        cloned into stencil_kernel_rows which only computes the axis 0
+        planes in [_row_lo, _row_hi).  The driver sweeps tiles of
+        temporal_tile_size planes along axis 0 and applies temporal_block
+        steps to each tile before moving on, shifting each successive step
+        back by ghost_depth[0] planes so that every value it reads has
+        already been produced by this tile or an earlier one.  The same two
+        buffers are used as in the untiled driver: a step only overwrites
+        planes that no later tile still needs from two steps back.
+        :param node: the stencil_kernel FunctionDecl
+        :return: [stencil_kernel_rows, stencil_run_steps] FunctionDecls
+        """
+        # drop duration and the timing statements around the loop nest
+        shape_params = self.shape_params()
+        grid_count = len(node.params) - 1 - len(shape_params)
+        rows = FunctionDecl(
+            node.return_type, "stencil_kernel_rows",
+            [SymbolRef(param.name) for param in node.params[:grid_count]] +
+            [SymbolRef("_row_lo", c_int()), SymbolRef("_row_hi", c_int())] +
+            self.shape_params(),
+            deepcopy(node.defn[1:-1]))
+        for statement in rows.defn:
+            if isinstance(statement, For):
+                lower = statement.init.right
+                upper = Add(statement.test.right, Constant(1))
+                statement.init.right = TernaryOp(
+                    Gt(SymbolRef("_row_lo"), lower), SymbolRef("_row_lo"),
+                    lower)
+                statement.test = Lt(
+                    SymbolRef(statement.test.left.name),
+                    FunctionCall(SymbolRef("min"),
+                                 [SymbolRef("_row_hi"), upper]))
+
+        grid_names = [param.name for param in node.params[:grid_count]]
+        input_name, aux_names, output_name = \
+            grid_names[0], grid_names[1:-1], grid_names[-1]
+        params = [SymbolRef(name) for name in grid_names]
+        params.append(SymbolRef("_scratch_grid"))
+        params.append(SymbolRef("_n_steps", c_int()))
+        params.extend(shape_params)
+        params.append(SymbolRef("duration", POINTER(c_double)))
+
+        depth = self.kernel.temporal_block
+        skew = self.ghost_depth[0]
+        tile = self.temporal_tile_size()
+        if not isinstance(tile, int):
+            tile = SymbolRef("_tile_size")
+
+        tile_body = [
+            Assign(SymbolRef("_step", c_int()),
+                   Add(SymbolRef("_chunk"), SymbolRef("_t"))),
+            Assign(SymbolRef("_source"), TernaryOp(
+                Eq(SymbolRef("_step"), Constant(0)), SymbolRef(input_name),
+                TernaryOp(Mod(SymbolRef("_step"), Constant(2)),
+                          SymbolRef(output_name),
+                          SymbolRef("_scratch_grid")))),
+            Assign(SymbolRef("_target"), TernaryOp(
+                Mod(SymbolRef("_step"), Constant(2)),
+                SymbolRef("_scratch_grid"), SymbolRef(output_name))),
+            Assign(SymbolRef("_lo", c_int()),
+                   Sub(SymbolRef("_tile"),
+                       Mul(SymbolRef("_t"), Constant(skew)))),
+            Assign(SymbolRef("_hi", c_int()),
+                   Add(SymbolRef("_lo"), self.as_node(tile))),
+        ]
+        if not self.output_fully_assigned:
+            tile_body.append(self.gen_zero_fill(
+                "_target",
+                Mul(TernaryOp(Gt(SymbolRef("_lo"), Constant(0)),
+                              SymbolRef("_lo"), Constant(0)),
+                    self.grid_volume(1)),
+                Mul(FunctionCall(SymbolRef("min"),
+                                 [SymbolRef("_hi"), self.grid_size(0)]),
+                    self.grid_volume(1))))
+        tile_body.append(FunctionCall(
+            SymbolRef("stencil_kernel_rows"),
+            [SymbolRef("_source")] +
+            [SymbolRef(name) for name in aux_names] +
+            [SymbolRef("_target"), SymbolRef("_lo"), SymbolRef("_hi")] +
+            [SymbolRef(param.name) for param in shape_params]))
+
+        step_loop = For(
+            Assign(SymbolRef("_t", c_int()), Constant(0)),
+            Lt(SymbolRef("_t"), SymbolRef("_depth")),
+            PostInc(SymbolRef("_t")),
+            tile_body)
+        tile_loop = For(
+            Assign(SymbolRef("_tile", c_int()), Constant(0)),
+            Lt(SymbolRef("_tile"),
+               self.grid_size(0, -(depth - 1) * skew)),
+            AddAssign(SymbolRef("_tile"), self.as_node(tile)),
+            [step_loop])
+        chunk_loop = For(
+            Assign(SymbolRef("_chunk", c_int()), Constant(0)),
+            Lt(SymbolRef("_chunk"), SymbolRef("_n_steps")),
+            AddAssign(SymbolRef("_chunk"), Constant(depth)),
+            [Assign(SymbolRef("_depth", c_int()),
+                    FunctionCall(SymbolRef("min"), [
+                        Constant(depth),
+                        Sub(SymbolRef("_n_steps"), SymbolRef("_chunk"))])),
+             tile_loop])
+
+        # share the kernel's own timing statements
+        defn = [
+            node.defn[0],
+            SymbolRef("_source", np.ctypeslib.ndpointer(
+                self.output_grid.dtype)()),
+            SymbolRef("_target", np.ctypeslib.ndpointer(
+                self.output_grid.dtype)()),
+        ]
+        if isinstance(tile, SymbolRef):
+            defn.append(Assign(SymbolRef(tile.name, c_int()),
+                               self.temporal_tile_size()))
+        defn += [
+            chunk_loop,
+            node.defn[-1],
+            Return(Constant(0)),
+        ]
+        return [rows, FunctionDecl(c_int(), "stencil_run_steps", params, defn)]
+
+    @staticmethod
+    def as_node(value):
+        if isinstance(value, int):
+            return Constant(value)
+        return deepcopy(value)
+
     def gen_array_macro(self, arg, point):
         name = "_%s_array_macro" % arg
         return FunctionCall(SymbolRef(name), point)
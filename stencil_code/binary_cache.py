@@ -0,0 +1,294 @@
+"""
+A persistent, content addressed cache of compiled stencils.
+
+Every entry lives in its own directory named by the hash of everything that
+determines the generated code: the kernel AST, neighborhoods, boundary
+handling, backend options, argument shapes and dtypes and the compiler
+settings.  An entry holds the shared library ctree built for the host code
+plus a json record of anything else finalize needs, for the ocl backend
+that is the generated OpenCL source of each kernel.
+
+Entries are assembled in a private temporary directory and renamed into
+place, so a reader either sees a complete entry or none at all.  Lookups,
+stores and evictions from different processes are serialized by a lock
+file, a hit loads its library before the lock is released and an entry
+that fails to load is removed so it is rebuilt.  A hit touches the
+entry, and when the cache grows past its size limit the least recently
+used entries are removed.
+"""
+from __future__ import print_function
+import ctypes
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # pragma no cover
+    fcntl = None
+
+CACHE_FORMAT = 1
+LIBRARY_NAME = 'stencil.so'
+RECORD_NAME = 'record.json'
+
+
+def default_cache_directory():
+    """
+    the cache lives in ~/.stencil_code/binaries unless the
+    STENCIL_CODE_BINARY_CACHE environment variable names another directory
+    """
+    return os.environ.get(
+        'STENCIL_CODE_BINARY_CACHE',
+        os.path.join(os.path.expanduser('~'), '.stencil_code', 'binaries'))
+
+
+_package_fingerprint = None
+
+
+def package_fingerprint():
+    """
+    a digest of the stencil_code sources, generated code changes whenever
+    they do so it is part of every key
+    """
+    global _package_fingerprint
+    if _package_fingerprint is None:
+        digest = hashlib.sha256()
+        package = os.path.dirname(os.path.abspath(__file__))
+        for directory in [package, os.path.join(package, 'backend')]:
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.py'):
+                    with open(os.path.join(directory, name), 'rb') as source:
+                        digest.update(source.read())
+        _package_fingerprint = digest.hexdigest()
+    return _package_fingerprint
+
+
+def fingerprint(value, describe=None):
+    """
+    a deterministic description of plain data, numpy arrays are reduced to
+    a digest of their contents and other objects to what describe returns
+    for them, or to their type name when describe is None or returns None
+    :param describe: Optional, a function describing the objects that are
+        not plain data, for example the stencils nested in another one
+    """
+    if isinstance(value, dict):
+        return "{" + ", ".join(
+            "{}: {}".format(fingerprint(key, describe),
+                            fingerprint(value[key], describe))
+            for key in sorted(value, key=str)) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(fingerprint(item, describe)
+                               for item in value) + "]"
+    if isinstance(value, np.ndarray):
+        return "array({}, {}, {})".format(
+            value.dtype, value.shape,
+            hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if value is None or isinstance(value, (bool, int, float, str, np.generic)):
+        return repr(value)
+    description = describe(value) if describe is not None else None
+    if description is not None:
+        return description
+    return type(value).__name__
+
+
+class CachedModule(object):
+    """
+    stands in for ctree's JitModule when the shared library comes from the
+    binary cache instead of a fresh compile
+    """
+    def __init__(self, so_file_name, lib):
+        """
+        :param so_file_name: path of the library in the cache
+        :param lib: the library, already loaded, it stays usable when the
+            entry is evicted
+        """
+        self.so_file_name = so_file_name
+        self.lib = lib
+
+    def get_callable(self, entry_point_name, entry_point_typesig):
+        func_ptr = getattr(self.lib, entry_point_name)
+        func_ptr.argtypes = entry_point_typesig._argtypes_
+        func_ptr.restype = entry_point_typesig._restype_
+        return func_ptr
+
+
+class CacheEntry(object):
+    """
+    a complete entry found in the cache
+    """
+    def __init__(self, key, module, record):
+        self.key = key
+        self.module = module
+        self.record = record
+
+
+class FileLock(object):
+    """
+    an exclusive lock held on a file while in a with block, it serializes
+    processes that share a directory, where fcntl is missing it does not
+    lock
+    """
+    def __init__(self, path):
+        """
+        :param path: the lock file, created if it does not exist
+        """
+        self.path = path
+        self.lock_file = None
+
+    def __enter__(self):
+        self.lock_file = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+class BinaryCache(object):
+    """
+    A size bounded on disk cache of compiled stencils shared by every
+    process that points at the same directory
+    """
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        self.directory = directory or default_cache_directory()
+        self.max_bytes = max_bytes
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        :param parts: anything with a deterministic str()
+        :return: the hex digest identifying a cache entry
+        """
+        digest = hashlib.sha256("format {}".format(CACHE_FORMAT).encode())
+        for part in parts:
+            digest.update(b"\0")
+            digest.update(str(part).encode())
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def lookup(self, key):
+        """
+        the library of a hit is loaded under the lock, so another process
+        cannot evict the entry between the lookup and the load
+        :param key: a key from make_key
+        :return: a CacheEntry or None on a miss
+        """
+        path = self.entry_path(key)
+        library = os.path.join(path, LIBRARY_NAME)
+        with FileLock(os.path.join(self.directory, '.lock')):
+            if not os.path.isdir(path):
+                return None
+            try:
+                with open(os.path.join(path, RECORD_NAME)) as record_file:
+                    record = json.load(record_file)
+                lib = ctypes.cdll.LoadLibrary(library)
+                os.utime(path, None)
+            except (IOError, OSError, ValueError):
+                # a corrupt entry is removed so the next store replaces it
+                self._discard(path)
+                return None
+        return CacheEntry(key, CachedModule(library, lib), record)
+
+    def store(self, key, library, record):
+        """
+        copy a freshly built shared library into the cache, if another
+        process stored the same key first its entry is kept
+        :param key: a key from make_key
+        :param library: path of the shared library to cache
+        :param record: json serializable data finalize needs on a hit
+        :return: the path of the entry
+        """
+        path = self.entry_path(key)
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.directory)
+        try:
+            shutil.copy2(library, os.path.join(staging, LIBRARY_NAME))
+            with open(os.path.join(staging, RECORD_NAME), 'w') as record_file:
+                json.dump(record, record_file)
+            with FileLock(os.path.join(self.directory, '.lock')):
+                if not os.path.exists(path):
+                    os.rename(staging, path)
+                    staging = None
+                self._evict(keep=path)
+        finally:
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+        return path
+
+    def entries(self):
+        """
+        :return: a list of (path, last use, size in bytes) for every entry
+        """
+        result = []
+        for prefix in os.listdir(self.directory):
+            prefix_path = os.path.join(self.directory, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, key)
+                try:
+                    size = sum(
+                        os.path.getsize(os.path.join(path, name))
+                        for name in os.listdir(path)
+                    )
+                    result.append((path, os.path.getmtime(path), size))
+                except OSError:
+                    continue
+        return result
+
+    def size(self):
+        return sum(size for _, _, size in self.entries())
+
+    def _evict(self, keep=None):
+        """
+        remove least recently used entries until the cache fits, caller
+        must hold the lock.  An entry is renamed out of the way before it
+        is deleted so readers never see half of it, libraries a process
+        has already loaded stay usable after they are unlinked
+        """
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self._discard(path)
+            total -= size
+
+    def _discard(self, path):
+        """
+        remove the entry at path, caller must hold the lock
+        """
+        trash = tempfile.mkdtemp(prefix='.evicted-', dir=self.directory)
+        try:
+            os.rename(path, os.path.join(trash, 'entry'))
+        except OSError:
+            pass
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def clear(self):
+        with FileLock(os.path.join(self.directory, '.lock')):
+            for path, _, _ in self.entries():
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,265 @@
+"""
+Grids that stay on the OpenCL device between stencil calls.
+
+A DeviceArray wraps an OpenCL buffer together with the shape and dtype of
+the grid it holds.  The ocl backend accepts DeviceArrays wherever it takes
+numpy grids and, when the first grid of a call is a DeviceArray, returns
+its result as a DeviceArray as well, so a pipeline of stencils or a series
+of timesteps only crosses the bus when the host finally reads the data
+with get() or numpy.asarray().
+
+Buffers come from a BufferPool shared by every stencil that uses the same
+command queue.  A buffer that is released, explicitly or when its
+DeviceArray is garbage collected, goes back to the pool and is handed out
+again to the next request for the same shape and dtype.
+"""
+from __future__ import print_function
+import threading
+
+import numpy as np
+import pycl as cl
+from pycl import buffer_from_ndarray, buffer_to_ndarray
+from ctree.ocl import get_context_and_queue_from_devices
+
+from stencil_code.stencil_exception import StencilException
+
+
+def default_queue():
+    """
+    :return: the context and command queue the ocl backend uses
+    """
+    devices = cl.clGetDeviceIDs()
+    return get_context_and_queue_from_devices([devices[-1]])
+
+
+class BufferPool(object):
+    """
+    Released device buffers kept for reuse, keyed by shape and dtype
+    """
+    def __init__(self, context, queue, max_free=8):
+        """
+        :param context: the OpenCL context buffers are created in
+        :param queue: the command queue used to initialize buffers
+        :param max_free: number of released buffers kept for each key,
+            buffers beyond that are freed
+        """
+        self.context = context
+        self.queue = queue
+        self.max_free = max_free
+        self.free = {}
+        self.zero_buffers = {}
+        # stencils called from several threads share the pool
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(shape, dtype):
+        return tuple(shape), np.dtype(dtype).str
+
+    def acquire(self, shape, dtype):
+        """
+        :return: a buffer large enough for a grid of shape and dtype, its
+            contents are undefined
+        """
+        with self.lock:
+            free = self.free.get(self.key(shape, dtype))
+            if free:
+                return free.pop()
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return cl.clCreateBuffer(self.context, max(nbytes, 1))
+
+    def release(self, buf, shape, dtype):
+        """
+        hand buf back for reuse by a later acquire of the same shape and
+        dtype, the caller must not touch it afterwards
+        """
+        with self.lock:
+            free = self.free.setdefault(self.key(shape, dtype), [])
+            if len(free) < self.max_free:
+                # the pool keeps its own reference, the wrapper passed in
+                # may be released by the garbage collector even if it is
+                # kept here
+                pooled = cl.cl_buffer(buf.value)
+                cl.clRetainMemObject(pooled)
+                free.append(pooled)
+
+    def zeros(self, shape, dtype):
+        """
+        :return: a buffer of zeros for shape and dtype that is shared, it
+            must only be read from, typically as the source of a copy
+        """
+        key = self.key(shape, dtype)
+        with self.lock:
+            if key not in self.zero_buffers:
+                buf, evt = buffer_from_ndarray(
+                    self.queue, np.zeros(shape, dtype),
+                    buf=self.acquire(shape, dtype), blocking=True)
+                evt.wait()
+                self.zero_buffers[key] = buf
+            return self.zero_buffers[key]
+
+    def clear(self):
+        """
+        drop every released buffer
+        """
+        with self.lock:
+            self.free = {}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def buffer_pool(context, queue):
+    """
+    :return: the pool shared by everything that uses queue
+    """
+    with _pools_lock:
+        if queue.value not in _pools:
+            _pools[queue.value] = BufferPool(context, queue)
+        return _pools[queue.value]
+
+
+class DeviceArray(object):
+    """
+    A c contiguous grid held in an OpenCL buffer
+    """
+    def __init__(self, buf, shape, dtype, context=None, queue=None):
+        if queue is None:
+            context, queue = default_queue()
+        self.buffer = buf
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.context = context
+        self.queue = queue
+        # the last write to the buffer enqueued by a non blocking call
+        self.event = None
+
+    @classmethod
+    def empty(cls, shape, dtype, context=None, queue=None):
+        """
+        a DeviceArray with a pooled buffer of undefined contents
+        """
+        if queue is None:
+            context, queue = default_queue()
+        buf = buffer_pool(context, queue).acquire(shape, dtype)
+        return cls(buf, shape, dtype, context, queue)
+
+    @classmethod
+    def from_array(cls, array, context=None, queue=None):
+        """
+        upload a numpy array to the device
+        """
+        array = np.ascontiguousarray(array)
+        device_array = cls.empty(array.shape, array.dtype, context, queue)
+        _, evt = buffer_from_ndarray(device_array.queue, array,
+                                     buf=device_array.buffer, blocking=True)
+        evt.wait()
+        return device_array
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def itemsize(self):
+        return self.dtype.itemsize
+
+    @property
+    def nbytes(self):
+        return self.size * self.itemsize
+
+    @property
+    def strides(self):
+        strides = []
+        stride = self.itemsize
+        for size in reversed(self.shape):
+            strides.insert(0, stride)
+            stride *= size
+        return tuple(strides)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _check_live(self):
+        if self.buffer is None:
+            raise StencilException(
+                "Error: the DeviceArray has been released")
+
+    def wait(self):
+        """
+        block until pending writes to the grid, possibly enqueued on
+        another command queue, have completed
+        """
+        if self.event is not None:
+            self.event.wait()
+            self.event = None
+
+    def get(self, out=None):
+        """
+        download the grid
+        :param out: optional c contiguous array to download into
+        :return: a numpy array
+        """
+        self._check_live()
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        elif out.shape != self.shape or out.dtype != self.dtype or \
+                not out.flags.c_contiguous:
+            raise StencilException(
+                "Error: cannot download {} {} into {} {}".format(
+                    self.dtype, self.shape, out.dtype, out.shape))
+        self.wait()
+        _, evt = buffer_to_ndarray(self.queue, self.buffer, out)
+        evt.wait()
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.get()
+        return array if dtype is None else array.astype(dtype)
+
+    def copy_from(self, source, queue=None):
+        """
+        enqueue a copy of another buffer of the same size on the same
+        device into this grid
+        :param source: a DeviceArray or a buffer
+        :param queue: the command queue to use instead of the grid's own
+        :return: the event of the copy
+        """
+        self._check_live()
+        if isinstance(source, DeviceArray):
+            source.wait()
+            source = source.buffer
+        return cl.clEnqueueCopyBuffer(queue or self.queue, source,
+                                      self.buffer)
+
+    def release(self):
+        """
+        return the buffer to the pool, the DeviceArray is unusable after
+        """
+        if self.buffer is not None:
+            self.wait()
+            buffer_pool(self.context, self.queue).release(
+                self.buffer, self.shape, self.dtype)
+            self.buffer = None
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:  # pragma no cover
+            pass
+
+    def __repr__(self):
+        return "DeviceArray(shape={}, dtype={})".format(self.shape,
+                                                        self.dtype)
+
+
+def to_device(array):
+    """
+    :param array: a numpy array
+    :return: a DeviceArray holding a copy of array on the default device
+    """
+    return DeviceArray.from_array(array)
@@ -0,0 +1,261 @@
+"""
+Apply a stencil with a pool of processes, each computing some blocks of
+the grid.
+
+The grid is cut into blocks, by default along axis 0 with one block per
+process.  Every step each process reads its blocks together with the ghost
+depth of the neighboring blocks around them, the halo, applies the
+compiled stencil to that window and writes back the block.  The grid lives
+in a transport that all the processes share, the default keeps two copies
+of the grid in multiprocessing.shared_memory, the one of the current step
+is read and the next one is written, and a barrier between the steps makes
+the halos written by the neighbors visible, that is the halo exchange.  A
+transport for processes on several hosts implements the same methods.
+
+All the windows have the same shape, the windows at the edges of the grid
+are moved inwards, so the stencil is specialized once, in the parent
+before the processes are forked, and every process runs the same compiled
+kernel.  Where a window is cut short by the edge of the grid the edge is a
+real one and the stencil handles it as it would for the whole grid.
+"""
+from __future__ import print_function
+import itertools
+import multiprocessing
+import time
+
+import numpy as np
+
+from stencil_code.device_array import DeviceArray
+from stencil_code.stencil_exception import StencilException
+
+
+def window_region(index):
+    """
+    the numpy index of a window given a slice or an array of indexes in
+    each dimension
+    """
+    if all(isinstance(i, slice) for i in index):
+        return index
+    return np.ix_(*[np.arange(i.start, i.stop) if isinstance(i, slice) else i
+                    for i in index])
+
+
+class SharedMemoryTransport(object):
+    """
+    the grid of the current and of the next step in shared memory, for
+    processes on one host
+    """
+    def __init__(self, shape, dtype, parties, context):
+        """
+        :param shape: shape of the grid
+        :param dtype: dtype of the grid
+        :param parties: number of processes taking part in each step
+        :param context: the multiprocessing context the processes are
+            started from
+        """
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise StencilException(
+                "Error: the shared memory transport needs python 3.8 or "
+                "later")
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self.memory = [shared_memory.SharedMemory(create=True, size=size)
+                       for _ in range(2)]
+        self.grids = [np.ndarray(shape, dtype, buffer=memory.buf)
+                      for memory in self.memory]
+        self.barrier = context.Barrier(parties)
+
+    def load(self, grid):
+        self.grids[0][...] = grid
+
+    def read(self, step, index):
+        """
+        a copy of the window of the grid at the start of step
+        :param index: a slice or an array of indexes per dimension
+        """
+        return np.ascontiguousarray(self.grids[step % 2][window_region(index)])
+
+    def write(self, step, block, values):
+        """
+        write the values of block, a tuple of slices, computed at step
+        """
+        self.grids[(step + 1) % 2][block] = values
+
+    def wait(self):
+        """
+        wait for all the processes to be done with the step
+        """
+        self.barrier.wait()
+
+    def abort(self):
+        self.barrier.abort()
+
+    def result(self, n_steps, out):
+        out[...] = self.grids[n_steps % 2]
+        return out
+
+    def close(self):
+        del self.grids
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+
+
+class DistributedStencil(object):
+    """
+    applies a stencil to a grid with a pool of processes that exchange
+    the halos of their blocks every step
+    """
+    def __init__(self, stencil, processes=None, blocks=None,
+                 transport=SharedMemoryTransport):
+        """
+        :param stencil: the Stencil to apply, with the c, omp, numpy or
+            python backend
+        :param processes: number of processes, by default one per cpu
+        :param blocks: number of blocks in each dimension, by default the
+            grid is cut along axis 0 into one block per process
+        :param transport: class of the transport the processes share the
+            grid through, called with the shape and dtype of the grid, the
+            number of processes and the multiprocessing context
+        """
+        if stencil.backend is not None and stencil.backend.__name__ == \
+                'StencilOclTransformer':
+            raise StencilException(
+                "Error: ocl stencils cannot be used from forked processes")
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            raise StencilException(
+                "Error: DistributedStencil needs the fork start method")
+        self.stencil = stencil
+        self.processes = processes or multiprocessing.cpu_count()
+        self.blocks = blocks
+        self.transport = transport
+        self.last_duration = None
+
+    def decompose(self, shape):
+        """
+        the blocks of a grid and the shape of the window around each block
+        :return: a list of tuples of (low, high) per dimension, the window
+            shape
+        """
+        counts = self.blocks or \
+            (self.processes,) + (1,) * (len(shape) - 1)
+        if len(counts) != len(shape):
+            raise StencilException(
+                "Error: blocks {} needs one count per dimension of {}".format(
+                    counts, shape))
+        sizes = [-(-size // min(count, size))
+                 for size, count in zip(shape, counts)]
+        ranges = [[(low, min(low + block, size))
+                   for low in range(0, size, block)]
+                  for size, block in zip(shape, sizes)]
+        window = tuple(
+            block + 2 * depth if self.stencil.boundary_handling == 'wrap'
+            else min(block + 2 * depth, size)
+            for block, depth, size in zip(sizes, self.stencil.ghost_depth,
+                                          shape))
+        return list(itertools.product(*ranges)), window
+
+    def window_index(self, block, window, shape):
+        """
+        the indexes of the window around block and the offset of the block
+        within it in each dimension
+        """
+        index, offsets = [], []
+        for (low, _), width, depth, size in zip(
+                block, window, self.stencil.ghost_depth, shape):
+            if self.stencil.boundary_handling == 'wrap':
+                start = low - depth
+                index.append(np.arange(start, start + width) % size)
+            else:
+                start = max(0, min(low - depth, size - width))
+                index.append(slice(start, start + width))
+            offsets.append(low - start)
+        return tuple(index), offsets
+
+    def __call__(self, grid, *args, **kwargs):
+        """
+        :param grid: the first input grid
+        :param args: the other input grids, arrays shaped like grid are
+            cut into windows with it, anything else is passed whole
+        :param n_steps: Optional keyword, number of times to apply the
+            stencil, halos are exchanged between the steps
+        :param out: Optional keyword, the array the result is written to
+        :return: the output grid
+        """
+        n_steps = kwargs.get('n_steps', 1)
+        out = kwargs.get('out')
+        if n_steps < 1:
+            raise StencilException(
+                "Error: n_steps must be at least 1, got {}".format(n_steps))
+        if isinstance(grid, DeviceArray):
+            grid = grid.get()
+        grid = np.asarray(grid)
+        if out is None:
+            out = np.empty_like(grid)
+        elif out.shape != grid.shape or out.dtype != grid.dtype:
+            raise StencilException(
+                "Error: out is {} {}, the stencil produces {} {}".format(
+                    out.dtype, out.shape, grid.dtype, grid.shape))
+
+        start_time = time.time()
+        blocks, window = self.decompose(grid.shape)
+        processes = min(self.processes, len(blocks))
+        # the windows of the other grids never change
+        windows = []
+        for block in blocks:
+            index, _ = self.window_index(block, window, grid.shape)
+            windows.append([np.ascontiguousarray(arg[window_region(index)])
+                            if isinstance(arg, np.ndarray) and
+                            arg.shape == grid.shape else arg
+                            for arg in args])
+        # specialize before forking so every process shares the kernel
+        self.stencil(np.zeros(window, grid.dtype), *windows[0])
+
+        context = multiprocessing.get_context('fork')
+        transport = self.transport(grid.shape, grid.dtype, processes,
+                                   context)
+        try:
+            transport.load(grid)
+            workers = [
+                context.Process(target=self.work, args=(
+                    transport, blocks[rank::processes],
+                    windows[rank::processes], window, grid.shape,
+                    grid.dtype, n_steps))
+                for rank in range(processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if any(worker.exitcode != 0 for worker in workers):
+                raise StencilException(
+                    "Error: a process of the distributed stencil failed")
+            transport.result(n_steps, out)
+        finally:
+            transport.close()
+        self.last_duration = time.time() - start_time
+        return out
+
+    def work(self, transport, blocks, windows, window, shape, dtype,
+             n_steps):
+        """
+        the loop run by each process over the steps and its blocks
+        """
+        try:
+            places = [self.window_index(block, window, shape)
+                      for block in blocks]
+            output = np.zeros(window, dtype)
+            for step in range(n_steps):
+                for block, (index, offsets), args in zip(blocks, places,
+                                                         windows):
+                    result = self.stencil(transport.read(step, index), *args,
+                                          out=output)
+                    transport.write(
+                        step, tuple(slice(low, high) for low, high in block),
+                        result[tuple(
+                            slice(offset, offset + high - low)
+                            for offset, (low, high) in zip(offsets, block))])
+                transport.wait()
+        except Exception:
+            transport.abort()
+            raise
@@ -0,0 +1,147 @@
+"""
+Convolution of a grid with a dense array of constant coefficients through
+the fast fourier transform.
+
+A direct stencil does one multiply add per coefficient at every point,
+for wide coefficient arrays it is beaten by transforming the grid, taking
+the product with the transform of the coefficients and transforming back,
+which costs a few times log2 of the grid size per point whatever the size
+of the coefficient array.  Large grids are split into tiles that are
+convolved separately and added together with their overlap, overlap-add,
+so the transforms stay small.
+
+The result is the one ConvolutionFilter computes, out[p] is the sum over
+the offsets r of the coefficient array of in[p - r] * coefficient[r], with
+the same boundary handling:
+
+    clamp: reads outside the grid use the nearest point of the grid
+    wrap: reads outside the grid wrap around to the other side
+    zero: the points within the ghost zone are zero
+    copy: the points within the ghost zone keep their input values
+"""
+from __future__ import print_function
+import math
+
+import numpy as np
+
+from stencil_code.stencil_exception import StencilException
+
+# the cost, in multiply adds per point and per power of two of the
+# transform size, of a forward and inverse real transform pair relative to
+# the multiply add of a direct stencil
+FFT_COST_FACTOR = 10.0
+
+
+def next_power_of_two(n):
+    return 1 << max(0, int(n) - 1).bit_length()
+
+
+def fft_cost(grid_shape, kernel_shape):
+    """
+    estimated multiply adds of the fft convolution of a grid
+    """
+    size = int(np.prod([g + k - 1 for g, k in zip(grid_shape, kernel_shape)]))
+    return FFT_COST_FACTOR * size * math.log(max(size, 2), 2)
+
+
+def default_tile_shape(grid_shape, kernel_shape, max_points=1 << 22):
+    """
+    the whole grid if its transform has at most max_points points, otherwise
+    tiles whose transforms have a power of two size of about four times the
+    coefficient array in each dimension
+    """
+    if np.prod([g + k - 1 for g, k in zip(grid_shape, kernel_shape)]) <= \
+            max_points:
+        return tuple(grid_shape)
+    return tuple(min(g, next_power_of_two(4 * k) - k + 1)
+                 for g, k in zip(grid_shape, kernel_shape))
+
+
+def overlap_add(grid, coefficients, tile_shape=None):
+    """
+    the full linear convolution of grid with coefficients
+    :param grid: an n-dimensional numpy array
+    :param coefficients: an n-dimensional numpy array
+    :param tile_shape: size of the tiles grid is split into, by default
+        chosen by default_tile_shape
+    :return: an array of shape grid.shape + coefficients.shape - 1
+    """
+    grid_shape, kernel_shape = grid.shape, coefficients.shape
+    if tile_shape is None:
+        tile_shape = default_tile_shape(grid_shape, kernel_shape)
+    if len(tile_shape) != grid.ndim or min(tile_shape) < 1:
+        raise StencilException(
+            "Error: tile shape {} does not fit grid shape {}".format(
+                tile_shape, grid_shape))
+    tile_shape = tuple(min(t, g) for t, g in zip(tile_shape, grid_shape))
+    fft_shape = tuple(next_power_of_two(t + k - 1)
+                      for t, k in zip(tile_shape, kernel_shape))
+    axes = tuple(range(grid.ndim))
+    kernel_transform = np.fft.rfftn(coefficients, fft_shape, axes)
+
+    full_shape = tuple(g + k - 1 for g, k in zip(grid_shape, kernel_shape))
+    result = np.zeros(full_shape)
+    starts = [range(0, g, t) for g, t in zip(grid_shape, tile_shape)]
+    for corner in np.ndindex(*[len(r) for r in starts]):
+        lows = [starts[d][i] for d, i in enumerate(corner)]
+        tile = grid[tuple(slice(low, low + t)
+                          for low, t in zip(lows, tile_shape))]
+        product = np.fft.irfftn(
+            np.fft.rfftn(tile, fft_shape, axes) * kernel_transform,
+            fft_shape, axes)
+        extent = tuple(t + k - 1 for t, k in zip(tile.shape, kernel_shape))
+        result[tuple(slice(low, low + e) for low, e in zip(lows, extent))] += \
+            product[tuple(slice(0, e) for e in extent)]
+    return result
+
+
+def fft_convolve(grid, coefficients, ghost_depth, boundary_handling='copy',
+                 tile_shape=None, out=None):
+    """
+    convolve grid with an array of coefficients centered on its middle
+    element, as ConvolutionFilter does
+    :param grid: an n-dimensional numpy array
+    :param coefficients: the coefficient array, the center is at index
+        shape // 2 in each dimension
+    :param ghost_depth: the reach of the non zero coefficients from the
+        center in each dimension
+    :param boundary_handling: one of clamp, wrap, zero or copy
+    :param tile_shape: tile size for overlap-add
+    :param out: optional array of the shape and dtype of grid that receives
+        the result
+    :return: the convolved grid, with the dtype of grid, rounded to the
+        nearest integer for integer grids
+    """
+    coefficients = np.asarray(coefficients, dtype=np.float64)
+    padding = [(depth, depth) for depth in ghost_depth]
+    if boundary_handling == 'clamp':
+        source = np.pad(grid, padding, mode='edge')
+    elif boundary_handling == 'wrap':
+        source = np.pad(grid, padding, mode='wrap')
+    elif boundary_handling in ('zero', 'copy'):
+        source = grid
+        padding = [(0, 0)] * grid.ndim
+    else:
+        raise StencilException(
+            "Error: boundary handling '{}' not supported by the fft "
+            "convolution".format(boundary_handling))
+
+    full = overlap_add(source.astype(np.float64), coefficients, tile_shape)
+    # out[p] is full[p + center], shifted by the padding of the source
+    result = full[tuple(
+        slice(low + size // 2, low + size // 2 + length)
+        for (low, _), size, length in zip(padding, coefficients.shape,
+                                          grid.shape))]
+    if out is None:
+        out = np.empty_like(grid)
+    if not np.issubdtype(out.dtype, np.inexact):
+        # the transforms leave round off errors either side of the exact
+        # integer sums
+        result = np.rint(result)
+    out[...] = result
+    if boundary_handling in ('zero', 'copy'):
+        border = np.ones(grid.shape, dtype=bool)
+        border[tuple(slice(depth, length - depth) for depth, length in
+                     zip(ghost_depth, grid.shape))] = False
+        out[border] = grid[border] if boundary_handling == 'copy' else 0
+    return out
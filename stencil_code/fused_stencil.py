@@ -0,0 +1,246 @@
+"""
+Fusion of a chain of stencils into a single generated kernel.
+
+FusedStencil([blur, laplacian]) computes laplacian(blur(grid)) in one pass
+over the grid.  Instead of writing the intermediate grid to memory and
+reading it back, the kernel evaluates each intermediate stage into local
+variables at every offset from the current point that the following stage
+reads, recomputing values shared by neighboring points.  The halo of the
+fused stencil is the combined reach of the stages, for the ocl backend
+that widens the block of the input loaded into local memory.
+
+Every stage must have a single interior points loop that writes its output
+only at the current point and reads its first input grid only at the
+current point or its neighbors.  Additional input grids of the stages
+follow the first grid in the call, in stage order.
+
+Points at least the combined ghost depth away from the edges get the same
+values as running the stages one after the other, the remaining points are
+handled by the boundary handling of the fused stencil.  The intermediate
+values are held in the value type of the fused stencil, its
+accumulator_dtype or else the dtype of the output grid, and are rounded to
+it as the output grid of each stage would be, so every backend gives the
+same values for integer grids.
+"""
+from __future__ import print_function
+import ast
+import copy
+from ctypes import c_float
+
+from ctree.c.nodes import Assign, Constant, FunctionDecl, SymbolRef
+from ctree.frontend import get_ast
+from ctree.visitors import NodeTransformer
+
+from stencil_code.python_frontend import PythonToStencilModel
+from stencil_code.stencil_exception import StencilException
+from stencil_code.stencil_kernel import Stencil
+from stencil_code.stencil_model import (
+    GridElement, InteriorPointsLoop, NeighborPointsLoop, StageBlock,
+    StageElement
+)
+
+
+def add_points(a, b):
+    return tuple(x + y for x, y in zip(a, b))
+
+
+class FusedStage(object):
+    """
+    the stencil model of one stage and what the fusion needs to know
+    about it
+    """
+    def __init__(self, stencil):
+        self.stencil = stencil
+        self.tree = PythonToStencilModel().visit(get_ast(stencil.kernel))
+        self.decl = self.tree.find(FunctionDecl)
+        loops = [statement for statement in self.decl.defn
+                 if isinstance(statement, InteriorPointsLoop)]
+        if len(loops) != 1 or len(self.decl.defn) != 1:
+            raise StencilException(
+                "Error: cannot fuse {}, its kernel must consist of a single "
+                "interior points loop".format(type(stencil).__name__))
+        self.loop = loops[0]
+        names = [param.name for param in self.decl.params]
+        self.input_name = names[0]
+        self.extra_names = names[1:-1]
+        self.output_name = names[-1]
+        self.input_reads = self.reads(self.input_name)
+
+    def reads(self, grid_name):
+        """
+        :return: the set of offsets from the current point at which the
+            kernel reads grid_name
+        """
+        zero = (0,) * self.stencil.dim
+        offsets = set()
+
+        def walk(node, neighbor_loop):
+            if isinstance(node, NeighborPointsLoop):
+                neighbor_loop = node
+            if isinstance(node, GridElement) and \
+                    node.grid_name == grid_name:
+                target = getattr(node.target, 'name', None)
+                if target == self.loop.target:
+                    offsets.add(zero)
+                elif neighbor_loop is not None and \
+                        target == neighbor_loop.neighbor_target:
+                    offsets.update(
+                        tuple(point) for point in
+                        self.stencil.neighborhood_definition[
+                            neighbor_loop.neighbor_id])
+                else:
+                    raise StencilException(
+                        "Error: cannot fuse {}, it reads {} at a computed "
+                        "index".format(type(self.stencil).__name__,
+                                       grid_name))
+            for child in ast.iter_child_nodes(node):
+                walk(child, neighbor_loop)
+
+        for statement in self.loop.body:
+            walk(statement, None)
+        return offsets
+
+    def reach(self):
+        """
+        :return: every offset at which the kernel reads any input grid
+        """
+        offsets = set(self.input_reads)
+        for neighborhood in self.stencil.neighborhood_definition:
+            offsets.update(tuple(point) for point in neighborhood)
+        return offsets
+
+
+class _StageRewriter(NodeTransformer):
+    """
+    renames the interior points target of a stage to the target of the
+    fused loop, turns writes and reads of its output into a local variable
+    and reads of its first input into reads of the previous stage
+    """
+    def __init__(self, stage, target, value_name=None, previous=None):
+        self.stage = stage
+        self.target = target
+        self.value_name = value_name
+        self.previous = previous
+        super(_StageRewriter, self).__init__()
+
+    def visit_GridElement(self, node):
+        node.target = self.visit(node.target)
+        if self.value_name is not None and \
+                node.grid_name == self.stage.output_name:
+            if getattr(node.target, 'name', None) != self.target:
+                raise StencilException(
+                    "Error: cannot fuse {}, it accesses its output away "
+                    "from the current point".format(
+                        type(self.stage.stencil).__name__))
+            return SymbolRef(self.value_name)
+        if self.previous is not None and \
+                node.grid_name == self.stage.input_name:
+            return StageElement(values=self.previous, target=node.target)
+        return node
+
+    def visit_SymbolRef(self, node):
+        if node.name == self.stage.loop.target:
+            return SymbolRef(self.target)
+        return node
+
+
+class FusedStencil(Stencil):
+    """
+    A chain of stencils generated as one kernel, each stage reads the
+    output of the stage before it
+    """
+    def __init__(self, stages, backend='ocl', boundary_handling=None,
+                 **kwargs):
+        """
+        :param stages: the stencils to apply, first to last
+        :param backend: as for Stencil
+        :param boundary_handling: as for Stencil, by default that of the
+            first stage
+        """
+        if len(stages) < 2:
+            raise StencilException("Error: fusion needs at least two stages")
+        if len(set(stage.dim for stage in stages)) != 1:
+            raise StencilException(
+                "Error: cannot fuse stencils of different dimensions")
+        if not kwargs.get('should_unroll', True):
+            raise StencilException(
+                "Error: fused stencils unroll their neighbor loops")
+        self.stages = list(stages)
+        self.fused_stages = [FusedStage(stage) for stage in self.stages]
+
+        # the offsets at which each intermediate stage has to be evaluated
+        # so that the stage after it finds every value it reads
+        zero = (0,) * stages[0].dim
+        needed = [{zero}]
+        for stage in reversed(self.fused_stages[1:]):
+            needed.insert(0, set(
+                add_points(offset, read) for offset in needed[0]
+                for read in stage.input_reads))
+        self.stage_offsets = [sorted(offsets) for offsets in needed]
+
+        reach = set()
+        for stage, offsets in zip(self.fused_stages, self.stage_offsets):
+            reach.update(add_points(offset, read) for offset in offsets
+                         for read in stage.reach())
+        super(FusedStencil, self).__init__(
+            backend=backend, neighborhoods=[sorted(reach)],
+            boundary_handling=boundary_handling or
+            stages[0].boundary_handling,
+            **kwargs)
+
+    def stencil_model(self, tree):
+        """
+        one interior points loop evaluating the intermediate stages into
+        local variables, followed by the last stage writing the output
+        """
+        stages = self.fused_stages
+        last = stages[-1]
+        target = last.loop.target
+        body = []
+        previous = None
+        for index, (stage, offsets) in enumerate(
+                zip(stages, self.stage_offsets)):
+            if stage is last:
+                statements = [
+                    _StageRewriter(stage, target, previous=previous).visit(
+                        copy.deepcopy(statement))
+                    for statement in stage.loop.body
+                ]
+                body.append(StageBlock(stage.stencil, offsets[0],
+                                       statements, final=True))
+                break
+            values = {}
+            for number, offset in enumerate(offsets):
+                name = "_stage%d_%d" % (index, number)
+                values[offset] = name
+                rewriter = _StageRewriter(stage, target, name, previous)
+                statements = [Assign(SymbolRef(name, c_float()),
+                                     Constant(0.0))]
+                statements.extend(rewriter.visit(copy.deepcopy(statement))
+                                  for statement in stage.loop.body)
+                body.append(StageBlock(stage.stencil, offset, statements))
+            previous = values
+
+        fused_tree = copy.deepcopy(last.tree)
+        decl = fused_tree.find(FunctionDecl)
+        params = [SymbolRef(stages[0].input_name)]
+        for stage in stages:
+            params.extend(SymbolRef(name) for name in stage.extra_names)
+        params.append(SymbolRef(last.output_name))
+        decl.params = params
+        decl.defn = [InteriorPointsLoop(target=target, body=body)]
+        return fused_tree
+
+    def kernel(self, *args):
+        """
+        the python backend applies the stages one after the other, the
+        intermediate grids have the dtype of output, which is that of the
+        accumulator when there is one
+        """
+        grid, extras, output = args[0], list(args[1:-1]), args[-1]
+        grid = grid.astype(output.dtype, copy=False)
+        for stage in self.fused_stages:
+            count = len(stage.extra_names)
+            stage_args, extras = extras[:count], extras[count:]
+            grid = stage.stencil.python_kernel_wrapper(grid, *stage_args)
+        output[...] = grid
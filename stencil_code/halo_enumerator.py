@@ -75,6 +75,27 @@ class HaloEnumerator(object):
             constraint[dimension][0] = self.halo[dimension]
             constraint[dimension][1] = self.shape[dimension] - self.halo[dimension]
 
+    def slabs(self):
+        """
+        the exterior as boxes, for each dimension the n-planes at its low end
+        then the n-planes at its high end, bounded in the dimensions already
+        processed by their interior, the points fixed_surface_iterator
+        visits but without visiting a point twice when a dimension is
+        narrower than two halos.  Empty boxes are left out
+        :return: a list of boxes, each a list of (start, stop) per dimension
+        """
+        constraint = [(0, size) for size in self.shape]
+        slabs = []
+        for dimension, (halo, size) in enumerate(zip(self.halo, self.shape)):
+            for start, stop in [(0, min(halo, size)),
+                                (max(halo, size - halo), size)]:
+                slab = list(constraint)
+                slab[dimension] = (start, stop)
+                if all(low < high for low, high in slab):
+                    slabs.append(slab)
+            constraint[dimension] = (halo, size - halo)
+        return slabs
+
     def __iter__(self):
         """
         This top level iterator will iterate over successive n-planes at either end of each dimension
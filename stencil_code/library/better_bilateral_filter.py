@@ -15,12 +15,13 @@ class BetterBilateralFilter(Stencil):
     An implementation of BilateralFilter that better encapsulates the
     internal tools used.
     """
-    def __init__(self, sigma_d=3, sigma_i=70, backend='ocl'):
+    def __init__(self, sigma_d=3, sigma_i=70, backend='ocl', **kwargs):
         """
         prepare the bilateral filter
         :param sigma_d: the smoothing associated with distance between points
         :param sigma_i: the smoothing factor associated with intensity difference between points
         :param backend:
+        :param kwargs: passed on to Stencil, e.g. batched
         :return:
         """
         self.sigma_d = sigma_d
@@ -33,7 +34,8 @@ class BetterBilateralFilter(Stencil):
         super(BetterBilateralFilter, self).__init__(
             neighborhoods=[Neighborhood.moore_neighborhood(radius=self.radius, dim=2)],
             backend=backend,
-            should_unroll=False
+            should_unroll=False,
+            **kwargs
         )
 
     def __call__(self, *args, **kwargs):
@@ -7,11 +7,12 @@ import math
 
 
 class BilateralFilter(Stencil):
-    def __init__(self, radius=3, backend='ocl'):
+    def __init__(self, radius=3, backend='ocl', **kwargs):
         super(BilateralFilter, self).__init__(
             neighborhoods=[Neighborhood.moore_neighborhood(radius=radius, dim=2)],
             backend=backend,
-            should_unroll=False
+            should_unroll=False,
+            **kwargs
         )
 
     def distance(self, x, y):
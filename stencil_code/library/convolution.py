@@ -1,7 +1,9 @@
 from __future__ import print_function
 
 import numpy
-from stencil_code.stencil_kernel import Stencil
+from stencil_code.fft_convolution import fft_convolve, fft_cost
+from stencil_code.stencil_future import StencilFuture
+from stencil_code.stencil_kernel import Stencil, check_output
 from stencil_code.neighborhood import Neighborhood
 
 
@@ -10,18 +12,82 @@ class ConvolutionFilter(Stencil):
     basic filter requires user to pass in a matrix of coefficients. the
     dimensions of this convolution_array define the stencil neighborhood
     This should be a foundation class for example stencils such as the
-    laplacians and jacobi stencils
+    laplacians and jacobi stencils.
+    A convolution_array that is the outer product of one vector per
+    dimension, like a gaussian blur, is applied to numpy grids as a
+    sequence of one dimensional passes, k * d instead of k ** d
+    multiplications per point for a k wide kernel.
+    Wide coefficient arrays are applied to floating point numpy grids with
+    the fft when a cost model estimates that to be cheaper than the direct
+    stencil
     """
-    def __init__(self, convolution_array=None, stride=1, backend='ocl'):
+    def __init__(self, convolution_array=None, stride=1, backend='ocl',
+                 separable=True, boundary_handling='copy', fft=None,
+                 fft_tile_shape=None, **kwargs):
+        """
+        :param convolution_array: the coefficients, centered on the point
+        :param stride: step between the points computed
+        :param backend: as for Stencil
+        :param separable: False always generates the dense kernel
+        :param boundary_handling: as for Stencil, by default the points
+            within the ghost zone keep their input values
+        :param fft: True always and False never uses the fft for numpy
+            grids, by default the cost model decides for each grid shape
+        :param fft_tile_shape: the tile size of the overlap-add fft
+            convolution, by default chosen from the grid and coefficients
+        :param kwargs: passed on to Stencil, a batched filter always runs
+            the dense kernel
+        """
         self.convolution_array = convolution_array
         neighbors, coefficients, _ = \
             Neighborhood.compute_from_indices(convolution_array)
         self.neighbor_to_coefficient = dict(zip(neighbors, coefficients))
         self.coefficients = numpy.array(coefficients)
         self.stride = stride
+        self.fft = fft
+        self.fft_tile_shape = fft_tile_shape
         super(ConvolutionFilter, self).__init__(
-            neighborhoods=[neighbors], backend=backend, boundary_handling='copy'
+            neighborhoods=[neighbors], backend=backend,
+            boundary_handling=boundary_handling, **kwargs
         )
+        self.passes = []
+        if separable and stride == 1 and self.is_copied and \
+                not self.batched:
+            self.passes = self.separable_passes(backend)
+
+    def separable_passes(self, backend):
+        """
+        :return: a one dimensional ConvolutionFilter for each dimension in
+            which the coefficients are not a single value, an empty list
+            if the coefficients are not separable or only one pass is needed
+        """
+        matrix = numpy.array(self.convolution_array)
+        factors = Neighborhood.separable_factors(matrix)
+        if factors is None:
+            return []
+        # a dimension with only a center coefficient just scales the result
+        kept = []
+        scale = 1.0
+        for d, factor in enumerate(factors):
+            center = matrix.shape[d] // 2
+            if numpy.count_nonzero(factor) == 1 and factor[center] != 0:
+                scale *= factor[center]
+            else:
+                kept.append((d, factor))
+        if len(kept) < 2:
+            return []
+        passes = []
+        for d, factor in kept:
+            if d == kept[0][0]:
+                factor = factor * scale
+            shape = [1] * matrix.ndim
+            shape[d] = len(factor)
+            # the ghost zone of a pass is only read by points in the ghost
+            # zone of the whole filter, which are copied at the end
+            passes.append(ConvolutionFilter(
+                convolution_array=factor.reshape(shape), backend=backend,
+                separable=False, boundary_handling='zero'))
+        return passes
 
     def __call__(self, *args, **kwargs):
         """
@@ -32,12 +98,73 @@ class ConvolutionFilter(Stencil):
         :param kwargs:
         :return:
         """
+        if isinstance(args[0], numpy.ndarray) and self.stride == 1 and \
+                not self.batched:
+            if self.use_fft(args[0].shape, args[0].dtype):
+                return self.host_call(self.fft_step, args[0], **kwargs)
+            if self.passes:
+                return self.host_call(self.separable_step, args[0], **kwargs)
         new_args = [
             args[0],
             self.coefficients,
         ]
         return super(ConvolutionFilter, self).__call__(*new_args, **kwargs)
 
+    def use_fft(self, shape, dtype=numpy.float64):
+        """
+        :param dtype: the dtype of the grid, the cost model only picks the
+            fft for floating point grids, as the fft and the stencil round
+            the values of integer grids differently
+        :return: True if a grid of shape should be convolved with the fft
+        """
+        if self.fft is not None or self.boundary_handling not in \
+                ('clamp', 'wrap', 'zero', 'copy'):
+            return bool(self.fft)
+        if not numpy.issubdtype(dtype, numpy.floating):
+            return False
+        if self.passes:
+            per_point = sum(len(stencil_pass.coefficients)
+                            for stencil_pass in self.passes)
+        else:
+            per_point = len(self.coefficients)
+        direct = per_point * int(numpy.prod(shape))
+        return fft_cost(shape, numpy.shape(self.convolution_array)) < direct
+
+    def host_call(self, step, grid, n_steps=1, out=None, blocking=True,
+                  **kwargs):
+        """
+        applies step n_steps times, for the ways of computing the filter
+        that run from the host and take numpy grids
+        """
+        if out is not None:
+            check_output(out, grid)
+        for _ in range(n_steps):
+            grid = step(grid, **kwargs)
+        if out is not None:
+            out[...] = grid
+            grid = out
+        if not blocking:
+            return StencilFuture.completed(grid)
+        return grid
+
+    def separable_step(self, grid, **kwargs):
+        """
+        applies the passes one after the other, the points the dense kernel
+        does not compute are then copied from the input
+        """
+        border = numpy.ones(grid.shape, dtype=bool)
+        border[tuple(slice(depth, size - depth) for depth, size in
+                     zip(self.ghost_depth, grid.shape))] = False
+        result = grid
+        for stencil_pass in self.passes:
+            result = stencil_pass(result, **kwargs)
+        result[border] = grid[border]
+        return result
+
+    def fft_step(self, grid, **kwargs):
+        return fft_convolve(grid, self.convolution_array, self.ghost_depth,
+                            self.boundary_handling, self.fft_tile_shape)
+
     def distance(self, x, y):
         d = tuple([x[i]-y[i] for i in range(len(x))])
         return self.neighbor_to_coefficient[d]
@@ -124,6 +124,44 @@ class Neighborhood(object):
 
         return neighbor_points, coefficients, halo
 
+    @staticmethod
+    def separable_factors(matrix, tolerance=1e-6):
+        """
+        splits a matrix of coefficients into one vector per dimension whose
+        outer product is the matrix.  Each unfolding of the matrix into
+        its first dimension against the rest must have a single singular
+        value that is not negligible
+        :param matrix: an n-dimensional matrix of coefficients
+        :param tolerance: singular values below tolerance times the largest
+        one are considered zero
+        :return: a list of 1d numpy arrays, one for each dimension of matrix,
+        or None if matrix is not separable
+        """
+        matrix = numpy.array(matrix, dtype=numpy.float64)
+        if not numpy.any(matrix):
+            return None
+        factors = []
+        rest = matrix
+        for _ in range(matrix.ndim - 1):
+            unfolded = rest.reshape(rest.shape[0], -1)
+            u, s, vt = numpy.linalg.svd(unfolded, full_matrices=False)
+            if len(s) > 1 and s[1] > tolerance * s[0]:
+                return None
+            factors.append(u[:, 0] * s[0])
+            rest = vt[0].reshape(rest.shape[1:])
+        factors.append(rest.reshape(-1))
+
+        for factor in factors:
+            # round off leaves tiny values where the matrix has zeros
+            factor[numpy.abs(factor) <= tolerance * numpy.abs(factor).max()] = 0
+        product = factors[0]
+        for factor in factors[1:]:
+            product = numpy.multiply.outer(product, factor)
+        if not numpy.allclose(product, matrix,
+                              atol=tolerance * numpy.abs(matrix).max()):
+            return None
+        return factors
+
 
 Neighborhood.flatten([[None], None, [[1, 2], [3, 4], [5,6]]])
 
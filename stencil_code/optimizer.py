@@ -1,58 +1,197 @@
 from ctree.visitors import NodeTransformer, NodeVisitor
 from ctree.c.nodes import *
+from ctree.omp.nodes import OmpNode
 from ctypes import c_int
 from copy import deepcopy
 
 
-def unroll(tree, for_node, factor):  # pragma no cover
-    Unroller(factor, for_node).visit(tree)
+def unroll(tree, for_node, factor):
+    return Unroller(factor, for_node).visit(tree)
 
 
-class Unroller(NodeTransformer):  # pragma no cover
+def optimize_loop_nest(for_node, block_factors=None, unroll_factors=None):
+    """
+    cache blocks and then unrolls a perfect loop nest.  Factors are given
+    per dimension, outermost loop first, a factor of 1 leaves that
+    dimension alone.  Unrolling a loop that is not innermost is done as
+    unroll and jam, the copies of the body are merged inside the inner
+    loops, which is safe for stencils since every point is independent.
+    :param for_node: the outermost For of the nest
+    :param block_factors: cache block size for each dimension
+    :param unroll_factors: unroll factor for each dimension
+    :return: a list of statements replacing for_node
+    """
+    loop_vars = [loop.init.left.name for loop in collect_loop_nest(for_node)]
+    statements = [for_node]
+    if block_factors and any(factor > 1 for factor in block_factors):
+        statements = StencilCacheBlocker().block(for_node, block_factors)
+
+    if unroll_factors:
+        # innermost first so that the remainder loops created for an outer
+        # dimension carry the already unrolled inner loops
+        for var, factor in reversed(list(zip(loop_vars, unroll_factors))):
+            if factor > 1:
+                target = FindLoopByVar(var).find(statements)
+                statements = transform_statements(
+                    Unroller(factor, target), statements)
+    return statements
+
+
+def fit_collapse(statements):
+    """
+    lowers the collapse clause of each OpenMP pragma in statements to the
+    depth of the perfect, rectangular nest of the loop that follows it,
+    cache blocking and unrolling may have made the nest shallower
+    :param statements: a list of statements, changed in place
+    """
+    for pragma, loop in zip(statements[:-1], statements[1:]):
+        if not isinstance(pragma, OmpNode) or not isinstance(loop, For):
+            continue
+        for clause in getattr(pragma, 'clauses', []):
+            if hasattr(clause, 'count'):
+                clause.count = max(1, min(clause.count,
+                                          rectangular_nest_depth(loop)))
+
+
+def rectangular_nest_depth(for_node):
+    """
+    number of loops, from for_node inwards, that are perfectly nested
+    with no pragma in between and whose bounds do not depend on the
+    variables of the enclosing loops
+    """
+    depth, outer_vars, loop = 0, set(), for_node
+    while True:
+        bounds = NameFinder().find([loop.init.right, loop.test.right])
+        if bounds & outer_vars:
+            return depth
+        depth += 1
+        outer_vars.add(loop.init.left.name)
+        if len(loop.body) != 1 or not isinstance(loop.body[0], For):
+            return depth
+        loop = loop.body[0]
+
+
+def transform_statements(transformer, statements):
+    """
+    apply a NodeTransformer to each statement of a list, flattening any
+    statements that get replaced by lists
+    """
+    result = []
+    for statement in statements:
+        new_statement = transformer.visit(statement)
+        if isinstance(new_statement, list):
+            result.extend(new_statement)
+        else:
+            result.append(new_statement)
+    return result
+
+
+def collect_loop_nest(for_node):
+    """
+    the loops of a perfect nest, outermost first, pragmas between the
+    loops are ignored
+    """
+    loops = [for_node]
+    while True:
+        inner = [s for s in loops[-1].body if not isinstance(s, OmpNode)]
+        if len(inner) != 1 or not isinstance(inner[0], For):
+            return loops
+        loops.append(inner[0])
+
+
+def _is_inclusive(for_node):
+    return isinstance(for_node.test.op, Op.LtE)
+
+
+def _offset(expression, offset):
+    if offset == 0:
+        return expression
+    if isinstance(expression, Constant):
+        return Constant(expression.value + offset)
+    if offset < 0:
+        return Sub(deepcopy(expression), Constant(-offset))
+    return Add(deepcopy(expression), Constant(offset))
+
+
+def _remainder_start(init, end, inclusive, factor):
+    """
+    first index not covered by the unrolled loop, the integer division
+    truncates toward zero so an empty loop gives a start beyond end
+    """
+    if isinstance(init, Constant) and isinstance(end, Constant):
+        count = end.value - init.value + (1 if inclusive else 0)
+        return Constant(init.value + int(count / factor) * factor)
+    count = Sub(deepcopy(end), deepcopy(init))
+    if inclusive:
+        count = Add(count, Constant(1))
+    return Add(deepcopy(init),
+               Mul(Div(count, Constant(factor)), Constant(factor)))
+
+
+class Unroller(NodeTransformer):
+    """
+    unrolls for_node by factor, the loop must have a unit increment and a
+    < or <= test but the bounds may be arbitrary expressions.  The result
+    is the unrolled loop followed, when needed, by a remainder loop that
+    finishes the leftover iterations
+    """
     def __init__(self, factor, for_node):
         self.factor = factor
         self.for_node = for_node
+        super(Unroller, self).__init__()
 
     # noinspection PyPep8Naming
     def visit_For(self, for_node):
         if for_node is not self.for_node:
-            map(self.visit, for_node.body)
-            return for_node
+            return self.generic_visit(for_node)
         factor = self.factor
-        # Determine the leftover iterations after unrolling
-        # TODO: Requires that parent pointers have been fixed
-        initial = for_node.init.right.value
-        end = for_node.test.right.value
-        # TODO: Lt vs LtE problems
-        leftover_begin = int((end - initial + 1) / factor) * factor + initial - 1
-
-        new_end = leftover_begin
-        new_incr = AddAssign(SymbolRef(for_node.incr.arg.name), factor)
-        new_body = for_node.body[:]
-        for x in range(1, factor):
-            new_extension = deepcopy(for_node.body)
-            new_extension = map(
-                UnrollReplacer(for_node.init.left.name, x).visit, new_extension
-            )
-            new_body.extend(new_extension)
+        var = for_node.init.left.name
+        init = for_node.init.right
+        end = for_node.test.right
+        inclusive = _is_inclusive(for_node)
 
+        leftover_begin = _remainder_start(init, end, inclusive, factor)
         leftover_For = For(
-            Assign(for_node.init.left, Constant(leftover_begin)),
-            for_node.test,
-            for_node.incr,
-            for_node.body
+            Assign(SymbolRef(var, c_int()), leftover_begin),
+            deepcopy(for_node.test),
+            PostInc(SymbolRef(var)),
+            deepcopy(for_node.body)
         )
-        # TODO: Handling LT vs LTE cases?
-        for_node.test = Lt(for_node.init.left.name, new_end)
-        for_node.incr = new_incr
-        for_node.body = new_body
 
-        if leftover_begin < end:
-            return [for_node, leftover_For]
-        return for_node
+        for_node.test = deepcopy(for_node.test)
+        for_node.test.right = _offset(end, -(factor - 1))
+        for_node.incr = AddAssign(SymbolRef(var), Constant(factor))
+        for_node.body = jam(for_node.body, var, factor)
 
+        if isinstance(leftover_begin, Constant) and \
+                isinstance(end, Constant):
+            last = end.value if inclusive else end.value - 1
+            if leftover_begin.value > last:
+                return for_node
+        return [for_node, leftover_For]
 
-def block_loops(inner, unblocked, block_factor):  # pragma no cover
+
+def jam(statements, var, factor):
+    """
+    replicates a loop body factor times with var offset by 0..factor-1,
+    if the body holds inner loops the copies are pushed into them instead
+    """
+    if any(isinstance(statement, For) for statement in statements):
+        for statement in statements:
+            if isinstance(statement, For):
+                statement.body = jam(statement.body, var, factor)
+        return statements
+
+    body = list(statements)
+    for x in range(1, factor):
+        replacer = UnrollReplacer(var, x)
+        replacer.declared = DeclarationFinder().find(statements)
+        body.extend(
+            replacer.visit(statement) for statement in deepcopy(statements))
+    return body
+
+
+def block_loops(inner, unblocked, block_factor):
     #factors = [self.block_factor for x in self.output_grid_shape]
     #factors[len(self.output_grid_shape)-1] = 1
 
@@ -66,40 +205,95 @@ def block_loops(inner, unblocked, block_factor):  # pragma no cover
     return [inner, blocked]
 
 
-class FindInnerMostLoop(NodeVisitor):  # pragma no cover
+class FindInnerMostLoop(NodeVisitor):
     def __init__(self):
         self.inner_most = None
 
     def find(self, node):
-        self.visit(node)
+        for statement in node if isinstance(node, list) else [node]:
+            self.visit(statement)
         return self.inner_most
 
     # noinspection PyPep8Naming
     def visit_For(self, node):
         self.inner_most = node
-        map(self.visit, node.body)
+        list(map(self.visit, node.body))
 
 
-class UnrollReplacer(NodeTransformer):  # pragma no cover
+class FindLoopByVar(NodeVisitor):
+    """finds the first For whose init declares var"""
+    def __init__(self, var):
+        self.var = var
+        self.loop = None
+
+    def find(self, node):
+        for statement in node if isinstance(node, list) else [node]:
+            self.visit(statement)
+        return self.loop
+
+    # noinspection PyPep8Naming
+    def visit_For(self, node):
+        if self.loop is None and node.init.left.name == self.var:
+            self.loop = node
+        list(map(self.visit, node.body))
+
+
+class NameFinder(NodeVisitor):
+    """collects the names referenced inside a tree"""
+    def __init__(self):
+        self.names = set()
+
+    def find(self, statements):
+        for statement in statements:
+            self.visit(statement)
+        return self.names
+
+    # noinspection PyPep8Naming
+    def visit_SymbolRef(self, node):
+        self.names.add(node.name)
+
+
+class DeclarationFinder(NodeVisitor):
+    """collects the names declared, with a type, inside a tree"""
+    def __init__(self):
+        self.names = set()
+
+    def find(self, statements):
+        for statement in statements:
+            self.visit(statement)
+        return self.names
+
+    # noinspection PyPep8Naming
+    def visit_SymbolRef(self, node):
+        if node.type is not None:
+            self.names.add(node.name)
+
+
+class UnrollReplacer(NodeTransformer):
     def __init__(self, loopvar, incr):
         self.loopvar = loopvar
         self.incr = incr
-        self.in_new_scope = False
-        self.inside_for = False
+        self.declared = set()
         super(UnrollReplacer, self).__init__()
 
     # noinspection PyPep8Naming
     def visit_SymbolRef(self, node):
         if node.name == self.loopvar:
-            return Add(node, Constant(self.incr))
-        return SymbolRef(node.name)
+            return Add(SymbolRef(node.name), Constant(self.incr))
+        if node.name in self.declared:
+            # each copy of the body gets its own locals
+            return SymbolRef("%s_%s%d" % (node.name, self.loopvar, self.incr),
+                             node.type)
+        return node
 
 
-class StencilCacheBlocker(object):  # pragma no cover
+class StencilCacheBlocker(object):
     """
     Class that takes a tree of perfectly-nested For loops (as in a stencil) and performs standard cache blocking
     on them.  Usage: StencilCacheBlocker().block(tree, factors) where factors is a tuple, one for each loop nest
-    in the original tree.
+    in the original tree.  The block loops of all blocked dimensions become the outermost loops, in their original
+    order, and the point loops follow.  The point loops are clipped with min so a block size does not have to
+    divide the extent of its dimension.
     """
     class StripMineLoopByIndex(NodeTransformer):
         """Helper class that strip mines a loop of a particular index in the nest."""
@@ -122,20 +316,36 @@ class StencilCacheBlocker(object):  # pragma no cover
                            list(map(self.visit, node.body)))
 
     def block(self, tree, factors):
-        """Main method in StencilCacheBlocker.  Used to block the loops in the tree."""
-        # first we apply strip mining to the loops given in factors
-        for x in range(len(factors)):
-
-            # we may want to not block a particular loop, e.g. when doing Rivera/Tseng blocking
-            if factors[x] > 1:
-                tree = StencilCacheBlocker.StripMineLoopByIndex(x*2, factors[x]).visit(tree)
+        """
+        Main method in StencilCacheBlocker.  Used to block the loops in the tree.
+        :return: a list of statements, pragmas found between the loops are
+            kept in front of the innermost loop when they were there, the
+            rest are moved in front of the new outermost loop
+        """
+        loops = collect_loop_nest(tree)
+        # pragmas just outside the innermost loop (ivdep) stay with it
+        outer_pragmas = [s for loop in loops[:-2] for s in loop.body
+                         if isinstance(s, OmpNode)]
+        inner_pragmas = [s for loop in loops[-2:-1] for s in loop.body
+                         if isinstance(s, OmpNode)]
+
+        block_fors = []
+        point_fors = []
+        for index, loop in enumerate(loops):
+            factor = factors[index] if index < len(factors) else 1
+            if factor > 1:
+                outer_for = LoopBlocker().loop_block(loop, factor)
+                block_fors.append(outer_for)
+                point_fors.append(outer_for.body[0])
+            else:
+                point_fors.append(For(loop.init, loop.test, loop.incr, []))
+        point_fors[-1].body = loops[-1].body
 
-        # now we move all the outer strip-mined loops to be outermost
-        for x in range(1, len(factors)):
-            if factors[x] > 1:
-                tree = self.bubble(tree, 2*x, x)
-
-        return tree
+        nest = block_fors + point_fors
+        for outer, inner in zip(nest[:-1], nest[1:]):
+            outer.body = [inner]
+        nest[-2].body = inner_pragmas + nest[-2].body
+        return outer_pragmas + [nest[0]]
 
     def bubble(self, tree, index, new_index):
         """
@@ -147,38 +357,42 @@ class StencilCacheBlocker(object):  # pragma no cover
         return tree
 
 
-class LoopBlocker(object):  # pragma no cover
+class LoopBlocker(object):
     def loop_block(self, node, block_size):
-        outer_incr_name = SymbolRef(node.init.left.name + node.init.left.name)
+        """
+        strip mines node into a loop over blocks of block_size iterations
+        and an inner loop over the points of one block, the inner loop is
+        clipped to the original bound
+        """
+        var = node.init.left.name
+        outer_var = var + var
+        inclusive = _is_inclusive(node)
 
         new_inner_test = deepcopy(node.test)
-        new_inner_test.right = FunctionCall("min", [
-            Add(outer_incr_name, Constant(block_size - 1)),
-            node.test.right
+        new_inner_test.right = FunctionCall(SymbolRef("min"), [
+            Add(SymbolRef(outer_var),
+                Constant(block_size - 1 if inclusive else block_size)),
+            deepcopy(node.test.right)
         ])
         new_inner_for = For(
-            Assign(node.init.left, SymbolRef(outer_incr_name)),
+            Assign(SymbolRef(var, c_int()), SymbolRef(outer_var)),
             new_inner_test,
-            PostInc(SymbolRef(node.init.left.name)),
+            PostInc(SymbolRef(var)),
             node.body)
 
         newtest = deepcopy(node.test)
-        newtest.left = SymbolRef(node.init.left.name + node.init.left.name)
+        newtest.left = SymbolRef(outer_var)
 
-        old_incr = 1 if type(node.incr) is UnaryOp else node.incr.arg
         new_outer_for = For(
-            Assign(SymbolRef(node.init.left.name + node.init.left.name, c_int()), node.init.right),
+            Assign(SymbolRef(outer_var, c_int()), deepcopy(node.init.right)),
             newtest,
-            AddAssign(
-                SymbolRef(node.init.left.name + node.init.left.name),
-                Mul(Constant(old_incr), SymbolRef(block_size))
-            ),
+            AddAssign(SymbolRef(outer_var), Constant(block_size)),
             [new_inner_for])
 
         return new_outer_for
 
 
-class LoopSwitcher(NodeTransformer):  # pragma no cover
+class LoopSwitcher(NodeTransformer):
     """
     Class that switches two loops.  The user is responsible for making sure the switching
     is valid (i.e. that the code can still compile/run).  Given two integers i,j this
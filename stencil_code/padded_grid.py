@@ -0,0 +1,201 @@
+"""
+Grids stored with a halo of ghost cells around them.
+
+A PaddedGrid keeps its values in an array that is larger than the grid by
+the ghost depth on either side of every dimension.  The cells beyond the
+edges, the halo, hold the values the boundary handling gives the points
+outside the grid: the nearest edge value for clamp, the values of the
+opposite edge for wrap, zeros for zero and, for copy, fixed values that
+are carried over unchanged from one step to the next.  The halo is
+refreshed in bulk, one numpy assignment per dimension and side.
+
+A stencil applied to a PaddedGrid runs its interior variant over the
+padded array, that is the single loop nest over the points at least the
+ghost depth from the edges of the array, which are exactly the points of
+the grid, with no clamping, wrapping or copying in the generated code.
+The result is a PaddedGrid whose halo is refreshed before it is returned,
+so it can be fed straight back in for the next step.  For clamp and wrap
+the values of the grid are the ones the stencil gives for the unpadded
+grid, zero pads the grid with zeros where the stencil would instead leave
+the points near the edges at zero.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+from stencil_code.halo_enumerator import HaloEnumerator
+from stencil_code.stencil_exception import StencilException
+from stencil_code.stencil_future import StencilFuture
+
+
+class PaddedGrid(object):
+    """
+    a grid surrounded by ghost_depth halo cells in every dimension
+    """
+    boundary_handling_list = ['clamp', 'zero', 'copy', 'wrap']
+
+    def __init__(self, data, ghost_depth, boundary_handling='clamp'):
+        """
+        :param data: the padded array, the grid with its halo, it is used in
+            place, not copied
+        :param ghost_depth: the width of the halo in each dimension
+        :param boundary_handling: one of clamp, zero, copy, wrap, how the
+            halo is filled
+        """
+        if boundary_handling not in PaddedGrid.boundary_handling_list:
+            raise StencilException(
+                "Error: boundary handling value '{}' not recognized".format(
+                    boundary_handling))
+        ghost_depth = tuple(ghost_depth)
+        if len(ghost_depth) != data.ndim or any(
+                size <= 2 * depth
+                for size, depth in zip(data.shape, ghost_depth)):
+            raise StencilException(
+                "Error: an array of shape {} cannot hold a halo of {}".format(
+                    data.shape, ghost_depth))
+        self.data = data
+        self.ghost_depth = ghost_depth
+        self.boundary_handling = boundary_handling
+
+    @classmethod
+    def from_array(cls, grid, ghost_depth, boundary_handling='clamp'):
+        """
+        a PaddedGrid holding a copy of grid, the halo is filled from it, a
+        copy halo starts out zeroed and may be set through data
+        :param grid: the values of the grid
+        """
+        grid = np.asarray(grid)
+        data = np.zeros(tuple(size + 2 * depth for size, depth in
+                              zip(grid.shape, ghost_depth)), grid.dtype)
+        padded = cls(data, ghost_depth, boundary_handling)
+        padded.interior[...] = grid
+        padded.fill_halo()
+        return padded
+
+    @property
+    def shape(self):
+        """
+        the shape of the grid, without the halo
+        """
+        return tuple(size - 2 * depth for size, depth in
+                     zip(self.data.shape, self.ghost_depth))
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def interior(self):
+        """
+        the view of data that is the grid
+        """
+        return self.data[tuple(slice(depth, size - depth) for depth, size in
+                               zip(self.ghost_depth, self.data.shape))]
+
+    def get(self):
+        """
+        :return: a copy of the grid, without the halo
+        """
+        return self.interior.copy()
+
+    def __array__(self, dtype=None):
+        return self.get() if dtype is None else self.get().astype(dtype)
+
+    def empty_like(self):
+        """
+        :return: a PaddedGrid of the same shape, halo and boundary handling
+            whose contents are undefined
+        """
+        return PaddedGrid(np.empty_like(self.data), self.ghost_depth,
+                          self.boundary_handling)
+
+    def fill_halo(self, source=None):
+        """
+        refresh the halo from the grid, the dimensions are filled in turn
+        over the whole extent of the others so the corners get the values
+        of both
+        :param source: for copy, the PaddedGrid the halo is copied from,
+            when None the halo is left as it is
+        """
+        data = self.data
+        if self.boundary_handling == 'copy':
+            if source is not None and source is not self:
+                for slab in HaloEnumerator(self.ghost_depth,
+                                           data.shape).slabs():
+                    region = tuple(slice(start, stop) for start, stop in slab)
+                    data[region] = source.data[region]
+            return
+        for d, depth in enumerate(self.ghost_depth):
+            if depth == 0:
+                continue
+            size = data.shape[d] - 2 * depth
+
+            def region(start, stop):
+                return (slice(None),) * d + (slice(start, stop),)
+
+            low, high = region(0, depth), region(depth + size, None)
+            if self.boundary_handling == 'zero':
+                data[low] = 0
+                data[high] = 0
+            elif self.boundary_handling == 'clamp':
+                data[low] = data[region(depth, depth + 1)]
+                data[high] = data[region(depth + size - 1, depth + size)]
+            else:
+                # the halo may be wider than the grid, so it is gathered
+                # through indexes rather than sliced
+                offsets = np.arange(depth)
+                data[low] = np.take(
+                    data, depth + (offsets - depth) % size, axis=d)
+                data[high] = np.take(
+                    data, depth + (offsets + size) % size, axis=d)
+
+
+def apply(stencil, grid, n_steps, *args, **kwargs):
+    """
+    apply stencil n_steps times to a PaddedGrid, the interior variant of
+    the stencil computes the grid and the halo is refreshed after every
+    step, the two buffers the steps alternate between are reused
+    :param stencil: the Stencil to apply, with any backend, its own
+        boundary handling is not used, the grid carries one
+    :param grid: the first input grid, a PaddedGrid, its halo is refreshed
+        first in case the grid was written to
+    :param args: the other input grids, PaddedGrids are passed with their
+        halo, anything else is passed unchanged
+    :param out: Optional keyword, the PaddedGrid the result is written to
+    :param blocking: Optional keyword, if False the result is returned in a
+        StencilFuture that is already done
+    :return: the PaddedGrid after n_steps applications
+    """
+    out = kwargs.get('out')
+    if n_steps < 1:
+        raise StencilException(
+            "Error: n_steps must be at least 1, got {}".format(n_steps))
+    if len(grid.ghost_depth) != len(stencil.ghost_depth) or any(
+            have < need for have, need in zip(grid.ghost_depth,
+                                              stencil.ghost_depth)):
+        raise StencilException(
+            "Error: a halo of {} is too thin for a stencil with ghost depth "
+            "{}".format(grid.ghost_depth, stencil.ghost_depth))
+    if out is None:
+        out = grid.empty_like()
+    elif not isinstance(out, PaddedGrid) or \
+            out.data.shape != grid.data.shape or out.dtype != grid.dtype or \
+            out.ghost_depth != grid.ghost_depth:
+        raise StencilException(
+            "Error: out must be a PaddedGrid like the input grid")
+
+    interior = stencil.interior_stencil()
+    args = tuple(arg.data if isinstance(arg, PaddedGrid) else arg
+                 for arg in args)
+    grid.fill_halo()
+    # the last step writes out
+    buffers = [out, grid.empty_like() if n_steps > 1 else None]
+    source = grid
+    for step in range(n_steps):
+        target = buffers[(n_steps - 1 - step) % 2]
+        interior(source.data, *args, out=target.data)
+        target.fill_halo(source)
+        source = target
+    if not kwargs.get('blocking', True):
+        return StencilFuture.completed(out)
+    return out
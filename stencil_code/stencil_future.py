@@ -0,0 +1,152 @@
+"""
+Results of stencil calls that have been enqueued but not waited for.
+
+A call made with blocking=False returns a StencilFuture as soon as the
+uploads, kernels and read back of the call are on the OpenCL command
+queue.  The host is free to prepare the next frame, or to enqueue work on
+other command queues, while the device runs.  result() waits for the call
+and returns what the blocking call would have returned, and a future can
+be awaited from an asyncio coroutine.
+
+The c, omp and python backends compute their result before returning, they
+hand back futures that are already done so callers need not care which
+backend they use.
+"""
+from __future__ import print_function
+from ctypes import POINTER, byref, c_int32
+
+import pycl as cl
+
+from stencil_code.stencil_exception import StencilException
+
+
+@cl._wrapdll(cl.cl_command_queue)
+def clFlush(queue):
+    clFlush.call(queue)
+
+
+@cl._wrapdll(cl.cl_command_queue, cl.cl_uint, POINTER(cl.cl_event),
+             POINTER(cl.cl_event))
+def clEnqueueMarkerWithWaitList(queue, wait_for=None):
+    nevents, wait_array = cl._make_event_array(wait_for)
+    out_event = cl.cl_event()
+    clEnqueueMarkerWithWaitList.call(queue, nevents, wait_array,
+                                     byref(out_event))
+    return out_event
+
+
+@cl._wrapdll(cl.cl_command_queue, cl.cl_uint, POINTER(cl.cl_event),
+             POINTER(cl.cl_event))
+def clEnqueueBarrierWithWaitList(queue, wait_for=None):
+    nevents, wait_array = cl._make_event_array(wait_for)
+    out_event = cl.cl_event()
+    clEnqueueBarrierWithWaitList.call(queue, nevents, wait_array,
+                                      byref(out_event))
+    return out_event
+
+
+def new_queue(context=None):
+    """
+    :param context: the context of the queue, by default the one every
+        ocl stencil and DeviceArray uses
+    :return: an additional in order command queue on the ocl device, calls
+        made on different queues may overlap each other
+    """
+    devices = cl.clGetDeviceIDs()
+    if context is None:
+        from stencil_code.device_array import default_queue
+        context, _ = default_queue()
+    return cl.clCreateCommandQueue(context, devices[-1])
+
+
+class StencilFuture(object):
+    """
+    The pending result of a stencil call
+    """
+    def __init__(self, result, events=(), on_done=None, keep_alive=()):
+        """
+        :param result: the value result() returns once the events complete
+        :param events: the cl_events the result depends on
+        :param on_done: called once, without arguments, after the events
+            completed, e.g. to hand borrowed buffers back to their pool
+        :param keep_alive: host arrays the device reads from or writes to
+            until the events complete
+        """
+        self._result = result
+        self.events = [event for event in events if event]
+        self._on_done = on_done
+        self._keep_alive = keep_alive
+        self._finished = False
+
+    @classmethod
+    def completed(cls, result):
+        """
+        a future for a result that is already available
+        """
+        return cls(result)
+
+    def done(self):
+        """
+        :return: True if result() will not block
+        """
+        if self._finished:
+            return True
+        for event in self.events:
+            # failed commands report negative error codes as their status
+            status = c_int32(event.status.value).value
+            if status < 0:
+                return True
+            if status != cl.cl_command_execution_status.CL_COMPLETE.value:
+                return False
+        return True
+
+    def wait(self):
+        """
+        block until the call has completed
+        """
+        if self._finished:
+            return
+        try:
+            if self.events:
+                try:
+                    cl.clWaitForEvents(*self.events)
+                except cl.OpenCLError as error:
+                    raise StencilException(
+                        "Error executing stencil kernel: {}".format(error))
+        finally:
+            self._finished = True
+            self.events = []
+            self._keep_alive = ()
+            if self._on_done is not None:
+                on_done, self._on_done = self._on_done, None
+                on_done()
+
+    def result(self):
+        """
+        :return: the result of the call, waiting for it if necessary
+        """
+        self.wait()
+        return self._result
+
+    @property
+    def event(self):
+        """
+        the event that completes last, or None if the future is done
+        """
+        return self.events[-1] if self.events else None
+
+    def __await__(self):
+        import asyncio
+        return asyncio.get_event_loop().run_in_executor(
+            None, self.result).__await__()
+
+    def __del__(self):
+        # buffers that are still in use must not go back to a pool
+        try:
+            self.wait()
+        except Exception:  # pragma no cover
+            pass
+
+    def __repr__(self):
+        return "StencilFuture({})".format(
+            "done" if self.done() else "pending")
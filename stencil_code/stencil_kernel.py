@@ -16,13 +16,22 @@ binary which then efficiently completes executing the call. The binary
 is cached for future calls.
 """
 from __future__ import print_function
+import ast
+import hashlib
 import math
+import multiprocessing
+import os
+import platform
+import threading
+import time
 
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 from numpy import zeros
 
 from ctree.jit import LazySpecializedFunction, ConcreteSpecializedFunction
-from ctree.c.nodes import FunctionDecl
+from ctree.tune import ConstantTuningDriver
+from ctree.c.nodes import FunctionDecl, For
 from ctree.ocl.nodes import OclFile
 import ctree.np
 from stencil_code.stencil_exception import StencilException
@@ -34,9 +43,26 @@ from ctree.nodes import Project
 from .backend.omp import StencilOmpTransformer
 from .backend.ocl import StencilOclTransformer
 from .backend.c import StencilCTransformer
+from .backend.numpy_backend import NumpyStencil
+from .backend.stencil_backend import StencilBackend
+from .backend.local_size_computer import LocalSizeComputer
 from .python_frontend import PythonToStencilModel
-# import optimizer as optimizer
-from ctypes import byref, c_float, CFUNCTYPE, c_int32, POINTER
+from stencil_code import optimizer
+from stencil_code.tuning import StencilTuningDriver, TuningDatabase
+from stencil_code.device_array import DeviceArray, buffer_pool
+from stencil_code.streaming import stream
+from stencil_code import padded_grid
+from stencil_code.padded_grid import PaddedGrid
+from stencil_code.stencil_future import (
+    StencilFuture, clEnqueueBarrierWithWaitList, clEnqueueMarkerWithWaitList,
+    clFlush
+)
+from stencil_code.binary_cache import (
+    BinaryCache, CacheEntry, CachedModule, fingerprint, package_fingerprint
+)
+from ctypes import (
+    byref, c_double, CFUNCTYPE, c_int32, c_long, c_ulong, c_void_p, POINTER
+)
 import pycl as cl
 from pycl import (
     clCreateProgramWithSource, buffer_from_ndarray, buffer_to_ndarray, cl_mem
@@ -50,6 +76,9 @@ from stencil_code.halo_enumerator import HaloEnumerator
 from hindemith.types.hmarray import hmarray, empty_like, Loop
 import copy
 
+# the bytes each first touch iteration clears in a 1D grid, one page
+FIRST_TOUCH_BYTES = 4096
+
 
 def product(nums):
     result = 1
@@ -58,18 +87,120 @@ def product(nums):
     return result
 
 
-class ConcreteStencil(ConcreteSpecializedFunction):
+def shape_arguments(grids):
+    """
+    the run time parameters of a shape generic kernel
+    :param grids: the input grids followed by the output grid
+    :return: the size of each dimension, then the strides, in elements, of
+        every dimension but the last of each grid
+    """
+    values = list(grids[-1].shape)
+    for grid in grids:
+        values.extend(stride // grid.itemsize for stride in grid.strides[:-1])
+    return values
+
+
+def check_output(out, grid):
+    """
+    make sure a caller supplied output array can hold the result of a
+    stencil applied to grid
+    :param out: the array passed as out
+    :param grid: the first input grid
+    """
+    if not isinstance(out, np.ndarray):
+        raise StencilException(
+            "Error: out must be a numpy array, got {}".format(type(out)))
+    if out.shape != grid.shape or out.dtype != grid.dtype:
+        raise StencilException(
+            "Error: out is {} {}, the stencil produces {} {}".format(
+                out.dtype, out.shape, grid.dtype, grid.shape))
+    if not out.flags.c_contiguous:
+        raise StencilException("Error: out must be c contiguous")
+    if np.may_share_memory(out, grid):
+        raise StencilException(
+            "Error: out must not overlap the input grid")
+
+
+def aligned_empty(shape, dtype, alignment):
+    """
+    an uninitialized array whose data starts at a multiple of alignment
+    bytes
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape)) * dtype.itemsize
+    buffer = np.empty(size + alignment, np.uint8)
+    offset = -buffer.ctypes.data % alignment
+    return buffer[offset:offset + size].view(dtype).reshape(shape)
+
+
+def kernel_attributes(stencil):
+    """
+    the attributes of a stencil that may be consulted while its code is
+    generated
+    """
+    return dict(
+        (name, value) for name, value in vars(stencil).items()
+        if name not in ('specializer', 'model', 'thread_state',
+                        'interior_only')
+    )
+
+
+def stencil_fingerprint(value):
+    """
+    a description of a stencil nested in the attributes of another one, such
+    as the stages of a FusedStencil, by the module and name of its class,
+    its kernel source and its attributes, None for anything else
+    """
+    if not isinstance(value, Stencil):
+        return None
+    return "{}.{}({}, {})".format(
+        type(value).__module__, type(value).__name__,
+        hashlib.sha256(ast.dump(get_ast(value.kernel)).encode()).hexdigest(),
+        fingerprint(kernel_attributes(value), stencil_fingerprint))
+
+
+def shape_argument_count(arg_config):
+    """
+    the number of shape generic parameters for grids described by
+    arg_config, the output grid is shaped like the first one
+    """
+    ndim = arg_config[0].ndim
+    return ndim + sum(max(arg.ndim - 1, 0) for arg in arg_config) + \
+        max(ndim - 1, 0)
+
+
+class CompiledStencil(ConcreteSpecializedFunction):
+    """CompiledStencil
+
+    Base of the concrete functions, compiles the project it is finalized
+    with unless it was handed a shared library from the binary cache.
+    """
+    def _compile(self, entry_point_name, project_node, entry_point_typesig,
+                 **kwargs):
+        if isinstance(project_node, CachedModule):
+            self._module = project_node
+            return project_node.get_callable(entry_point_name,
+                                             entry_point_typesig)
+        return super(CompiledStencil, self)._compile(
+            entry_point_name, project_node, entry_point_typesig, **kwargs)
+
+
+class ConcreteStencil(CompiledStencil):
     """StencilFunction
 
     The standard concrete specialized function that is returned when using the
     C or OpenMP backend.
     """
 
-    def finalize(self, tree, entry_name, entry_type, output):
+    def finalize(self, tree, entry_name, entry_type, output,
+                 run_steps_type=None, shape_generic=False,
+                 output_overwritten=False, first_touch=False,
+                 first_touch_inputs=False, alignment=None, restrict=False):
         """
 
         :param tree: A project node containing any files to be compiled for
-                     this specialized function.
+                     this specialized function, or a CachedModule holding
+                     the already compiled project.
         :type tree: Project node
         :param entry_name: The name of the function that will be the entry
                            point to the compiled project.
@@ -78,34 +209,171 @@ class ConcreteStencil(ConcreteSpecializedFunction):
                            `entry_name`.
         :type entry_type: CFUNCTYPE
         :param output: the stencil result buffer
+        :param run_steps_type: The type signature of the stencil_run_steps
+                               driver, if the project contains one.
+        :type run_steps_type: CFUNCTYPE
+        :param shape_generic: True if the compiled functions take the grid
+                              sizes and strides as arguments
+        :param output_overwritten: True if a call writes every point of the
+                                   output, halo included, so an output
+                                   passed in as out need not be cleared
+        :param first_touch: True if the buffers are cleared by the
+                            stencil_first_touch function of the project
+        :param first_touch_inputs: True if the input grids are copied by
+                                   stencil_first_touch before each call
+        :param alignment: the bytes the compiled functions assume every
+                          grid is aligned to, misaligned grids are copied
+        :param restrict: True if the compiled functions assume the output
+                         overlaps no input grid
         :return:
         """
         self.output = output
+        self.shape_generic = shape_generic
+        self.output_overwritten = output_overwritten
+        self.scratch = None
+        self.last_duration = None
+        # guards the preallocated output and scratch buffers, each is
+        # handed to one call at a time
+        self.lock = threading.Lock()
         self._c_function = self._compile(entry_name, tree, entry_type)
+        self._run_steps_function = None
+        if run_steps_type is not None:
+            self._run_steps_function = self._module.get_callable(
+                "stencil_run_steps", run_steps_type)
+        self._first_touch_function = None
+        self.first_touch_inputs = first_touch and first_touch_inputs
+        self.alignment = alignment
+        self.restrict = restrict
+        if first_touch:
+            self._first_touch_function = self._module.get_callable(
+                "stencil_first_touch",
+                CFUNCTYPE(c_int32, c_void_p, c_void_p, c_long, c_long))
+        if output is not None and (first_touch or alignment):
+            self.output = self.allocate(output)
         return self
 
-    def __call__(self, *args):
+    def place_input(self, arg):
+        """
+        the input grid arg, or a copy of it that is aligned or placed by
+        first touch
+        """
+        if not isinstance(arg, np.ndarray):
+            return arg
+        if self.first_touch_inputs or (
+                self.alignment and arg.ctypes.data % self.alignment):
+            return self.allocate(arg, arg)
+        return arg
+
+    def allocate(self, like, source=None):
+        """
+        a grid shaped like like, cleared, or a copy of source, written by
+        the threads of the kernel with its schedule when first touch is on
+        so its pages are placed on the NUMA nodes that compute them
+        """
+        if self._first_touch_function is None and not self.alignment:
+            return np.zeros_like(like) if source is None else source
+        if self.alignment:
+            grid = aligned_empty(like.shape, like.dtype, self.alignment)
+        else:
+            grid = np.empty_like(like)
+        if self._first_touch_function is None:
+            grid[...] = 0 if source is None else source
+            return grid
+        if source is not None:
+            source = np.ascontiguousarray(source)
+        row_bytes = grid.strides[-2] if grid.ndim > 1 else FIRST_TOUCH_BYTES
+        self._first_touch_function(
+            grid.ctypes.data, None if source is None else source.ctypes.data,
+            grid.nbytes, max(row_bytes, 1))
+        return grid
+
+    def __call__(self, *args, **kwargs):
         """__call__
 
         :param *args: Arguments to be passed to our C function, the types
                       should match the types specified by the `entry_type`
                       that was passed to :attr: `finalize`.
+        :param n_steps: Optional keyword, number of times to apply the
+                        stencil, feeding each output back in as the first
+                        input grid.
+        :param out: Optional keyword, a preallocated array the result is
+                    written to and returned.
+        :param blocking: Optional keyword, if False the result is returned
+                         in a StencilFuture that is already done.
 
         """
+        if not kwargs.pop('blocking', True):
+            return StencilFuture.completed(self(*args, **kwargs))
         # TODO: provide stronger type checking to give users better error
         # messages.
-        duration = c_float()
-        if self.output is not None:
-            output = self.output
-            self.output = None
-        else:  # pragma no cover
-            output = np.zeros_like(args[0])
-        args += (output, byref(duration))
+        n_steps = kwargs.get('n_steps', 1)
+        duration = c_double()
+        shape_args = ()
+        # grids left on an OpenCL device by another stencil
+        args = tuple(arg.get() if isinstance(arg, DeviceArray) else arg
+                     for arg in args)
+        if self.shape_generic:
+            # steps after the first read the output in place of the first
+            # grid with the strides of the first grid, the other grids may
+            # have padded rows but their last dimension must be dense
+            args = (np.ascontiguousarray(args[0]), ) + tuple(
+                arg if arg.strides[-1] == arg.itemsize else
+                np.ascontiguousarray(arg) for arg in args[1:])
+        args = tuple(self.place_input(arg) for arg in args)
+        out = kwargs.get('out')
+        if out is not None:
+            check_output(out, args[0])
+            if self.restrict and any(np.may_share_memory(out, arg)
+                                     for arg in args[1:]):
+                raise StencilException(
+                    "Error: out must not overlap the input grids")
+            if self.alignment and out.ctypes.data % self.alignment:
+                # computed in an aligned buffer and copied
+                del kwargs['out']
+                out[...] = self(*args, **kwargs)
+                return out
+            output = out
+            if not self.output_overwritten:
+                output.fill(0)
+        else:
+            with self.lock:
+                output, self.output = self.output, None
+            if output is None:
+                output = self.allocate(args[0])
+        if self.shape_generic:
+            shape_args = tuple(shape_arguments(args + (output, )))
+        start_time = time.time()
+        if n_steps > 1:
+            if out is None:
+                scratch = self.allocate(output)
+            else:
+                # the second buffer is never returned so it is kept for the
+                # next call, the buffers trade places when n_steps is even
+                # so that the result lands in out
+                with self.lock:
+                    scratch, self.scratch = self.scratch, None
+                if scratch is None or scratch.shape != out.shape \
+                        or scratch.dtype != out.dtype:
+                    scratch = self.allocate(out)
+                elif not self.output_overwritten:
+                    scratch.fill(0)
+                kept = scratch
+                if n_steps % 2 == 0:
+                    output, scratch = scratch, output
+            args += (output, scratch, n_steps) + shape_args + \
+                (byref(duration), )
+            self._run_steps_function(*args)
+            if out is not None:
+                self.scratch = kept
+            self.last_duration = time.time() - start_time
+            return output if n_steps % 2 == 1 else scratch
+        args += (output, ) + shape_args + (byref(duration), )
         self._c_function(*args)
+        self.last_duration = time.time() - start_time
         return output
 
 
-class OclStencilFunction(ConcreteSpecializedFunction):
+class OclStencilFunction(CompiledStencil):
     """OclStencilFunction
 
     The ConcreteSpecializedFunction used by the OpenCL backend.  Allows us to
@@ -123,14 +391,25 @@ class OclStencilFunction(ConcreteSpecializedFunction):
             [devices[self.desired_ocl_device]])
         self.max_work_group_size = \
             devices[self.desired_ocl_device].max_work_group_size
+        self.pool = buffer_pool(self.context, self.queue)
 
         # some variables that will be used that PEP-8 wants to see initialized
         # in __init__
         self.kernel = None
         self.output = None
         self._c_function = None
-
-    def finalize(self, tree, entry_type, entry_name, kernel, output_grid):
+        self.output_fully_assigned = False
+        self.last_duration = None
+        self.ghost_depth = None
+        self.launch_shapes = {}
+        self.output_overwritten = False
+        # the arguments of a cl_kernel are set before each launch, so
+        # launches from different threads take turns
+        self.launch_lock = threading.Lock()
+
+    def finalize(self, tree, entry_type, entry_name, kernel, output_grid,
+                 output_fully_assigned=False, ghost_depth=None,
+                 output_overwritten=False):
         """
         finalize
         :param tree: the transformed tree
@@ -138,70 +417,221 @@ class OclStencilFunction(ConcreteSpecializedFunction):
         :param entry_name:
         :param kernel: the kernel generated that will be used in __call__
         :param output_grid:
+        :param output_fully_assigned: True if the kernel never reads the
+            previous contents of its output grid
+        :param ghost_depth: the ghost depth of the stencil if the control
+            function is shape generic, it then takes the work sizes and the
+            grid sizes and strides as arguments
+        :param output_overwritten: True if a call writes every point of the
+            output, halo included, so the output buffer need not be
+            initialized
         :return: a specialized function
         """
         self.kernel = kernel
         self.output = output_grid
+        self.output_fully_assigned = output_fully_assigned
+        self.ghost_depth = ghost_depth
+        self.output_overwritten = output_overwritten
         self._c_function = self._compile(entry_name, tree, entry_type)
         return self
 
-    def __call__(self, *args):
+    def __call__(self, *args, **kwargs):
         """__call__
 
-        :param *args:
+        :param *args: numpy arrays, hmarrays or DeviceArrays
+        :param n_steps: Optional keyword, number of times to apply the
+                        stencil, the intermediate grids stay on the device.
+        :param out: Optional keyword, a preallocated array the result is
+                    read back into and returned, or a DeviceArray the result
+                    is left in.
+        :param blocking: Optional keyword, if False the call returns a
+                         StencilFuture as soon as its work is enqueued, the
+                         host arrays passed in must not be modified until
+                         the future is done.
+        :param queue: Optional keyword, the command queue to enqueue the
+                      call on, by default the queue shared by all stencils.
+        :return: the result, a DeviceArray if the first grid or out is one
         """
-        if isinstance(args[0], hmarray):
+        n_steps = kwargs.get('n_steps', 1)
+        out = kwargs.get('out')
+        blocking = kwargs.get('blocking', True)
+        queue = kwargs.get('queue') or self.queue
+        start_time = time.time()
+        launch_args = []
+        if self.ghost_depth is not None:
+            # the kernel indexes every grid like a c contiguous output
+            args = tuple(arg if isinstance(arg, (hmarray, DeviceArray)) else
+                         np.ascontiguousarray(arg) for arg in args)
+            launch_args = self.launch_arguments(args)
+        shape, dtype = args[0].shape, args[0].dtype
+
+        # buffers taken from the pool for this call only
+        borrowed = []
+
+        def borrow():
+            buf = self.pool.acquire(shape, dtype)
+            borrowed.append((buf, shape, dtype))
+            return buf
+
+        def finish():
+            for buf, buf_shape, buf_dtype in borrowed:
+                self.pool.release(buf, buf_shape, buf_dtype)
+            self.last_duration = time.time() - start_time
+
+        if isinstance(out, DeviceArray):
+            if out.shape != shape or out.dtype != dtype:
+                raise StencilException(
+                    "Error: out is {} {}, the stencil produces {} {}".format(
+                        out.dtype, out.shape, dtype, shape))
+            output = out
+        elif out is None and isinstance(args[0], DeviceArray):
+            output = DeviceArray.empty(shape, dtype, self.context, queue)
+        elif out is not None:
+            check_output(out, args[0])
+            output = out
+            if not self.output_overwritten:
+                output.fill(0)
+        elif isinstance(args[0], hmarray):
             output = empty_like(args[0])
         else:
             output = np.zeros_like(args[0])
-        # self.kernel.argtypes = tuple(
-        #     cl_mem for _ in args + (output, )
-        # ) + (localmem, )
-        buffers = []
-        events = []
-        for index, arg in enumerate(args + (output, )):
-            if isinstance(arg, hmarray):
-                buffers.append(arg.ocl_buf)
+
+        try:
+            # grids still being written by calls on other queues
+            pending = [arg.event for arg in args + (output, )
+                       if isinstance(arg, DeviceArray) and
+                       arg.event is not None]
+            if pending:
+                clEnqueueBarrierWithWaitList(queue, pending)
+            buffers = []
+            for arg in args + (output, ):
+                if isinstance(arg, hmarray):
+                    buffers.append(arg.ocl_buf)
+                elif isinstance(arg, DeviceArray):
+                    buffers.append(arg.buffer)
+                elif arg is output and self.output_overwritten:
+                    # nothing to upload, the kernel writes every point
+                    buffers.append(borrow())
+                else:
+                    # the queue is in order, so the kernel starts after
+                    # the upload finished without the host waiting for it
+                    buf, _ = buffer_from_ndarray(
+                        queue, arg,
+                        buf=self.pool.acquire(arg.shape, arg.dtype),
+                        blocking=False)
+                    borrowed.append((buf, arg.shape, arg.dtype))
+                    buffers.append(buf)
+            if isinstance(output, DeviceArray) and \
+                    not self.output_overwritten:
+                output.copy_from(self.pool.zeros(shape, dtype), queue)
+            if n_steps > 1:
+                # ping-pong between the output buffer and a scratch buffer
+                scratch = borrow()
+                if not self.output_overwritten:
+                    # only the halo has to start out zeroed when the kernel
+                    # assigns every interior point
+                    cl.clEnqueueCopyBuffer(
+                        queue, self.pool.zeros(shape, dtype), scratch)
+
+            self._run_kernel(queue, buffers + launch_args)
+            for step in range(1, n_steps):
+                if step % 2 == 1:
+                    source, target = buffers[-1], scratch
+                else:
+                    source, target = scratch, buffers[-1]
+                if not self.output_fully_assigned:
+                    cl.clEnqueueCopyBuffer(
+                        queue, self.pool.zeros(shape, dtype), target)
+                self._run_kernel(queue, [source] + buffers[1:-1] +
+                                 [target] + launch_args)
+            result_buffer = buffers[-1]
+            if n_steps > 1 and n_steps % 2 == 0:
+                result_buffer = scratch
+
+            if isinstance(output, DeviceArray):
+                if result_buffer is not output.buffer:
+                    output.copy_from(result_buffer, queue)
+                result = output
+            elif isinstance(output, hmarray) and \
+                    result_buffer is buffers[-1]:
+                result = output
             else:
-                buf, evt = buffer_from_ndarray(self.queue, arg, blocking=True)
-                # evt.wait()
-                events.append(evt)
-                buffers.append(buf)
-                # self.kernel.setarg(index, buf, sizeof(cl_mem))
-        cl.clWaitForEvents(*events)
+                if isinstance(output, hmarray) or out is None:
+                    output = np.empty_like(args[0])
+                result, _ = buffer_to_ndarray(queue, result_buffer, output,
+                                              blocking=False)
+            done = clEnqueueMarkerWithWaitList(queue)
+            clFlush(queue)
+        except Exception:
+            finish()
+            raise
+
+        if isinstance(result, DeviceArray) and not blocking:
+            result.event = done
+        future = StencilFuture(result, [done], finish, args + (output, ))
+        if blocking:
+            return future.result()
+        return future
+
+    def launch_arguments(self, grids):
+        """
+        the trailing arguments of a shape generic control function, the
+        global and local work sizes, the size of the local memory block and
+        the grid sizes and strides
+        :param grids: the input grids
+        """
+        shape = grids[0].shape
+        if shape not in self.launch_shapes:
+            device = cl.clGetDeviceIDs()[self.desired_ocl_device]
+            computer = LocalSizeComputer(shape, device)
+            local_size = computer.compute_local_size_bulky()
+            global_size = computer.compute_virtual_global_size(local_size)
+            local_mem_size = product(
+                size + 2 * self.ghost_depth[dim]
+                for dim, size in enumerate(local_size)
+            ) * np.dtype(grids[0].dtype).itemsize
+            self.launch_shapes[shape] = list(global_size) + \
+                list(local_size) + [local_mem_size]
+        # the output is allocated like the first grid
+        return self.launch_shapes[shape] + \
+            shape_arguments(grids + (grids[0], ))
+
+    def _run_kernel(self, queue, buffers):
+        """
+        enqueue one application of the stencil through the control function
+        :param queue: the command queue to enqueue the kernels on
+        :param buffers: cl_mem handles for the input grids and the output
+            grid, followed by the launch arguments of a shape generic kernel
+        """
+        with self.launch_lock:
+            cl_error = self._launch(queue, buffers)
+        if cl.cl_errnum(cl_error) != cl.cl_errnum.CL_SUCCESS:
+            raise StencilException(
+                "Error executing stencil kernel: opencl {} {}".format(
+                    cl_error,
+                    cl.cl_errnum(cl_error)
+                )
+            )
+
+    def _launch(self, queue, buffers):
         cl_error = 0
         if isinstance(self.kernel, list):
             kernels = len(self.kernel)
             if kernels == 2:
-                cl_error = self._c_function(self.queue, self.kernel[0],
+                cl_error = self._c_function(queue, self.kernel[0],
                                             self.kernel[1], *buffers)
             elif kernels == 3:
-                cl_error = self._c_function(self.queue, self.kernel[0],
+                cl_error = self._c_function(queue, self.kernel[0],
                                             self.kernel[1], self.kernel[2],
                                             *buffers)
             elif kernels == 4:
                 cl_error = self._c_function(
-                    self.queue, self.kernel[0], self.kernel[1], self.kernel[2],
+                    queue, self.kernel[0], self.kernel[1], self.kernel[2],
                     self.kernel[3], *buffers
                 )
         else:
-            cl_error = self._c_function(self.queue, self.kernel, *buffers)
-
-        if cl.cl_errnum(cl_error) != cl.cl_errnum.CL_SUCCESS:
-            raise StencilException(
-                "Error executing stencil kernel: opencl {} {}".format(
-                    cl_error,
-                    cl.cl_errnum(cl_error)
-                )
-            )
-        if isinstance(output, hmarray):
-            return output
-        buf, evt = buffer_to_ndarray(
-            self.queue, buffers[-1], output
-        )
-        evt.wait()
-
-        return buf
+            cl_error = self._c_function(queue, self.kernel, *buffers)
+        return cl_error
 
     def __del__(self):
         del self.context
@@ -218,6 +648,9 @@ class SpecializedStencil(LazySpecializedFunction):
                     "omp": StencilOmpTransformer,
                     "ocl": StencilOclTransformer,
                     "opencl": StencilOclTransformer}
+    config_targets = {StencilCTransformer: "c",
+                      StencilOmpTransformer: "omp",
+                      StencilOclTransformer: "opencl"}
 
     def __init__(self, stencil_kernel, backend_name, boundary_handling=""):
         """
@@ -237,9 +670,43 @@ class SpecializedStencil(LazySpecializedFunction):
         self.backend = self.backend_dict[backend_name]
         self.output = None
         self.args = None
+        self.program_config = None
+        # args, output and program_config only describe the call being
+        # specialized, specialization and autotuned calls hold the lock,
+        # other calls only take it to find their concrete function
+        self.lock = threading.RLock()
         backend_key = "{}_{}".format(backend_name, boundary_handling)
+        if stencil_kernel.shape_generic:
+            backend_key += "_generic"
+        if backend_name != 'ocl' and (
+                stencil_kernel.loop_block_factors() or
+                max(stencil_kernel.loop_unroll_factors()) > 1):
+            backend_key += "_b{}_u{}".format(
+                stencil_kernel.loop_block_factors(),
+                stencil_kernel.loop_unroll_factors())
+        if stencil_kernel.temporal_block > 1 and backend_name != 'ocl':
+            backend_key += "_tb{}_{}".format(stencil_kernel.temporal_block,
+                                             stencil_kernel.temporal_tile)
+        # every kernel method is called kernel, so the compiled code of each
+        # kind of stencil gets its own directory, a library is only loaded
+        # once per path
+        sub_dir = "{}_{}".format(
+            type(stencil_kernel).__name__,
+            hashlib.sha1(stencil_fingerprint(stencil_kernel)
+                         .encode()).hexdigest()[:16])
         super(SpecializedStencil, self).__init__(get_ast(stencil_kernel.kernel),
+                                                 sub_dir=sub_dir,
                                                  backend_name=backend_key)
+        self.binary_cache = None
+        if stencil_kernel.binary_cache:
+            directory = stencil_kernel.binary_cache
+            if directory is True:
+                directory = None
+            self.binary_cache = BinaryCache(
+                directory, stencil_kernel.binary_cache_size)
+        # the number of input grids of the kernel, found from the stencil
+        # model by the first call
+        self.grid_count = None
 
     def args_to_subconfig(self, args):
         """
@@ -249,31 +716,198 @@ class SpecializedStencil(LazySpecializedFunction):
         :param args: StencilGrid instances being passed as params.
         :return: Tuple of information about the StencilGrids
         """
+        if self.grid_count is None:
+            tree = self.kernel.stencil_model(
+                copy.deepcopy(self.original_tree))
+            self.grid_count = len(tree.find(FunctionDecl).params) - 1
+        if len(args) != self.grid_count:
+            raise StencilException(
+                "Error: {} takes {} grids, got {}".format(
+                    type(self.kernel).__name__, self.grid_count, len(args)))
         self.args = args
-        return tuple(
-            StencilArgConfig(len(arg), arg.dtype, arg.ndim, arg.shape)
-            for arg in args
+        if self.kernel.shape_generic:
+            # one compiled kernel serves every shape
+            arg_config = tuple(
+                StencilArgConfig(None, arg.dtype, arg.ndim, None)
+                for arg in args
+            )
+        else:
+            arg_config = tuple(
+                StencilArgConfig(len(arg), arg.dtype, arg.ndim, arg.shape)
+                for arg in args
+            )
+        if isinstance(self._tuner, StencilTuningDriver):
+            self._tuner.select(self.tuning_key(arg_config), arg_config)
+        return arg_config
+
+    def get_tuning_driver(self):
+        """
+        Returns the tuning driver used for this Specialized Function.  When
+        the stencil was created with autotune=True this is a
+        StencilTuningDriver that times loop block and unroll factors for
+        the c and omp backends, or work group shapes for the ocl backend,
+        separately for every argument configuration.
+
+        :return: A tuning driver instance
+        """
+        if not self.kernel.autotune:
+            return ConstantTuningDriver()
+        database = None
+        if self.kernel.tuning_database is not False:
+            database = TuningDatabase(self.kernel.tuning_database)
+        return StencilTuningDriver(self.tuning_candidates, database,
+                                   trials=self.kernel.tuning_trials)
+
+    def tuning_key(self, arg_config):
+        """
+        the key under which the tuned configuration for these arguments
+        is stored in the tuning database
+        """
+        # a shape generic kernel is still tuned for each shape
+        grids = self.args if self.kernel.shape_generic else arg_config
+        return "{}.{}/{}/{}".format(
+            type(self.kernel).__module__, type(self.kernel).__name__,
+            self.backend_name,
+            ",".join("{}{}".format(arg.dtype, tuple(arg.shape))
+                     for arg in grids))
+
+    def tuning_candidates(self, arg_config):
+        """
+        the configurations the autotuner will time, the first one is the
+        configuration the stencil was created with
+        :param arg_config: the StencilArgConfig tuple of the call
+        :return: a list of configuration dictionaries
+        """
+        shape = arg_config[0].shape
+        if self.kernel.shape_generic:
+            if self.backend == StencilOclTransformer:
+                # work sizes are computed for every call
+                return [{}]
+            shape = self.args[0].shape
+        if self.backend == StencilOclTransformer:
+            device = cl.clGetDeviceIDs()[-1]
+            return [
+                {'local_size': tuple(local_size)}
+                for local_size in LocalSizeComputer(
+                    shape, device).compute_local_size_candidates()
+            ]
+
+        default = {'block_factors': self.kernel.loop_block_factors(),
+                   'unroll_factors': self.kernel.loop_unroll_factors()}
+        candidates = [default]
+        for block_size in [None, 8, 32]:
+            if block_size is not None and block_size >= max(shape[:-1] or [0]):
+                continue
+            for unroll_factor in [1, 2, 4]:
+                if unroll_factor > shape[-1]:
+                    continue
+                candidate = {
+                    'block_factors': None if block_size is None else
+                    (block_size,) * (len(shape) - 1) + (1,),
+                    'unroll_factors': (1,) * (len(shape) - 1) + (unroll_factor,)
+                }
+                if candidate not in candidates:
+                    candidates.append(candidate)
+        return candidates
+
+    def binary_cache_key(self, program_config):
+        """
+        the binary cache key for a program configuration, it covers the
+        kernel source and the attributes of the stencil, which may be
+        consulted during the transform, including the stencils nested in
+        them, the stencil_code sources, the argument shapes and dtypes, the
+        backend options and the compiler settings
+        """
+        arg_config, tuner_config = program_config
+        target = self.config_targets[self.backend]
+        return BinaryCache.make_key(
+            hash(self),
+            package_fingerprint(),
+            type(self.kernel).__module__ + "." + type(self.kernel).__name__,
+            fingerprint(kernel_attributes(self.kernel), stencil_fingerprint),
+            self.backend_name,
+            fingerprint(tuner_config),
+            [(arg.shape, str(arg.dtype), arg.ndim) for arg in arg_config],
+            [ctree.CONFIG.get(target, option)
+             for option in ('CC', 'CFLAGS', 'LDFLAGS')],
         )
 
-    # def get_tuning_driver(self):
-    #     """
-    #     Returns the tuning driver used for this Specialized Function.
-    #     Initializes a brute force tuning driver that explores the space of
-    #     loop unrolling factors as well as cache blocking factors for each
-    #     dimension of our input StencilGrids.
-
-    #     :return: A BruteForceTuning driver instance
-    #     """
-    #     from ctree.tune import (
-    #         BruteForceTuningDriver,
-    #         IntegerParameter,
-    #         MinimizeTime
-    #     )
-
-    #     params = [IntegerParameter("unroll_factor", 1, 4)]
-    #     for d in range(len(self.input_grids[0].shape) - 1):
-    #         params.append(IntegerParameter("block_factor_%s" % d, 4, 8))
-    #     return BruteForceTuningDriver(params, MinimizeTime())
+    def get_transform_result(self, program_config, dir_name, cache=True):
+        """
+        a hit in the binary cache skips the transform and the compile, the
+        cache entry is handed to finalize in place of the generated files
+        """
+        if self.binary_cache is not None:
+            entry = self.binary_cache.lookup(
+                self.binary_cache_key(program_config))
+            if entry is not None:
+                return entry
+        return super(SpecializedStencil, self).get_transform_result(
+            program_config, dir_name, cache)
+
+    def get_program_config(self, args, kwargs):
+        self.program_config = super(SpecializedStencil, self).get_program_config(
+            args, kwargs)
+        return self.program_config
+
+    def concrete_function(self, args, kwargs):
+        """
+        the concrete function for the arguments of a call, it is generated
+        and compiled by the first call that needs it while other threads
+        wait for it
+        """
+        with self.lock:
+            program_config = self.get_program_config(args, kwargs)
+            dir_name = self.config_to_dirname(program_config)
+            if ctree.CONFIG.getboolean('jit', 'CACHE') and \
+                    dir_name in self.concrete_functions:
+                return self.concrete_functions[dir_name]
+            if not os.path.exists(dir_name):
+                os.makedirs(dir_name)
+            concrete_function = self.finalize(
+                self.get_transform_result(program_config, dir_name),
+                program_config)
+            self.concrete_functions[dir_name] = concrete_function
+            return concrete_function
+
+    def __call__(self, *args, **kwargs):
+        """
+        runs the specialized stencil, while the autotuner is still
+        searching the running time of the call is reported back to it
+        """
+        # the compiled call runs outside the lock, ctypes releases the GIL
+        # so calls from several threads run in parallel
+        if not isinstance(self._tuner, StencilTuningDriver):
+            return self.concrete_function(args, kwargs)(*args, **kwargs)
+        with self.lock:
+            # selects the tuning key of the arguments, once its search is
+            # done the best configuration is run like an untuned one
+            concrete_function = self.concrete_function(args, kwargs)
+            if self._tuner.is_tuning():
+                return self.tuned_call(*args, **kwargs)
+        return concrete_function(*args, **kwargs)
+
+    def tuned_call(self, *args, **kwargs):
+        if not kwargs.get('blocking', True) and self._tuner.is_tuning():
+            # the call has to complete to be timed
+            kwargs['blocking'] = True
+            return StencilFuture.completed(self(*args, **kwargs))
+
+        try:
+            result = super(SpecializedStencil, self).__call__(*args, **kwargs)
+        except StencilException:
+            if not self._tuner.is_tuning():
+                raise
+            # this candidate cannot run here, e.g. an ocl work group
+            # that is too large for the kernel, move on to the next one
+            self._tuner.reject()
+            return self(*args, **kwargs)
+        if self._tuner.is_tuning():
+            concrete_function = self.concrete_functions[
+                self.config_to_dirname(self.program_config)]
+            self.report(time=concrete_function.last_duration /
+                        kwargs.get('n_steps', 1))
+        return result
 
     def transform(self, tree, program_config):
         """
@@ -294,57 +928,64 @@ class SpecializedStencil(LazySpecializedFunction):
         if self.backend == StencilOclTransformer:
             param_types.append(param_types[0])
         else:
-            param_types.append(POINTER(c_float))
-
-        # block_factors = [2**tuning_configuration['block_factor_%s' % d] for
-        #                  d in range(len(self.input_grids[0].shape) - 1)]
-        # unroll_factor = 2**tuning_configuration['unroll_factor']
-        unroll_factor = 0
-
-        for transformer in [
-            PythonToStencilModel(),
-            self.backend(self.args, output, self.kernel,
-                         arg_cfg=argument_configuration, fusable_nodes=None)
-        ]:
-            tree = transformer.visit(tree)
-
-        # first_For = tree.find(For)
-        # TODO: let the optimizer handle this? Or move the find inner most loop
-        # code somewhere else?
-        # inner_For = optimizer.FindInnerMostLoop().find(first_For)
-        # self.block(inner_For, first_For, block_factor)
-        # TODO: If should unroll check
-        # optimizer.unroll(inner_For, unroll_factor)
-        # TODO: This should be handled by the backend
-        # if self.backend != StencilOclTransformer:
-
-        # fix up the parameters type signatures, int the stencil_kernel
+            param_types.append(POINTER(c_double))
+
+        backend_options = {}
+        if self.backend == StencilOclTransformer and tuning_configuration:
+            backend_options['local_size'] = tuning_configuration['local_size']
+        tree = self.kernel.stencil_model(tree)
+        tree = self.backend(self.args, output, self.kernel,
+                            arg_cfg=argument_configuration,
+                            fusable_nodes=None,
+                            **backend_options).visit(tree)
+
+        # fix up the parameters type signatures, int the stencil_kernel, the
+        # sizes of a shape generic kernel follow the grids
+        grid_count = len(argument_configuration) + 1
         entry_point = tree.find(FunctionDecl, name="stencil_kernel")
-        for index, _type in enumerate(param_types):
+        for index, _type in enumerate(param_types[:grid_count]):
             entry_point.params[index].type = _type()
+        last = grid_count if self.backend == StencilOclTransformer else -1
+        entry_point.params[last].type = param_types[-1]()
+        run_steps = tree.find(FunctionDecl, name="stencil_run_steps")
+        if run_steps is not None:
+            # grids plus a scratch grid shaped like the output
+            for index, _type in enumerate(param_types[:-1] + param_types[-2:-1]):
+                run_steps.params[index].type = _type()
+        kernel_rows = tree.find(FunctionDecl, name="stencil_kernel_rows")
+        if kernel_rows is not None:
+            for index, _type in enumerate(param_types[:-1]):
+                kernel_rows.params[index].type = _type()
         # entry_point.set_typesig(kernel_sig)
-        # TODO: This logic should be provided by the backends
-        if self.backend == StencilOclTransformer:
-            return tree.files
-        else:
-            if self.args[0].shape[len(self.args[0].shape) - 1] \
-                    >= unroll_factor:
-                # FIXME: Lack of parent pointers breaks current loop unrolling
-                # first_For = tree.find(For)
-                # inner_For = optimizer.FindInnerMostLoop().find(first_For)
-                # inner, first = optimizer.block_loops(inner_For, tree,
-                #                                      block_factors + [1])
-                # first_For.replace(first)
-                # optimizer.unroll(tree, inner_For, unroll_factor)
-                pass
-
-        # import ast
-        # print(ast.dump(tree))
+        if self.backend != StencilOclTransformer:
+            if tuning_configuration:
+                block_factors = tuning_configuration['block_factors']
+                unroll_factors = tuning_configuration['unroll_factors']
+            else:
+                block_factors = self.kernel.loop_block_factors()
+                unroll_factors = self.kernel.loop_unroll_factors()
+            for function in (entry_point, kernel_rows):
+                if function is None:
+                    continue
+                defn = []
+                for statement in function.defn:
+                    if isinstance(statement, For):
+                        defn.extend(optimizer.optimize_loop_nest(
+                            statement, block_factors, unroll_factors))
+                    else:
+                        defn.append(statement)
+                optimizer.fit_collapse(defn)
+                function.defn = defn
 
         return tree.files
 
     def finalize(self, transform_result, program_config):
-        project = Project(transform_result)
+        cached = None
+        if isinstance(transform_result, CacheEntry):
+            cached = transform_result
+            project = cached.module
+        else:
+            project = Project(transform_result)
         arg_config, tuner_config = program_config
 
         self.output = self.generate_output(program_config)
@@ -352,6 +993,9 @@ class SpecializedStencil(LazySpecializedFunction):
             np.ctypeslib.ndpointer(arg.dtype, arg.ndim, arg.shape)
             for arg in arg_config + (self.output, )
         ]
+        shape_types = []
+        if self.kernel.shape_generic:
+            shape_types = [c_int32] * shape_argument_count(arg_config)
         if self.backend == StencilOclTransformer:
             entry_point = "stencil_control"
             param_types.append(param_types[0])
@@ -360,48 +1004,66 @@ class SpecializedStencil(LazySpecializedFunction):
                 for _ in range(self.kernel.dim):
                     entry_type.append(cl.cl_kernel)
             entry_type.extend(cl_mem for _ in range(len(arg_config) + 1))
+            if shape_types:
+                # global and local work sizes and the local memory size
+                entry_type.extend(
+                    [c_ulong] * (2 * arg_config[0].ndim + 1) + shape_types)
             entry_type = CFUNCTYPE(*entry_type)
         else:
             entry_point = "stencil_kernel"
-            param_types.append(POINTER(c_float))
-            entry_type = CFUNCTYPE(c_int32, *param_types)
+            param_types.append(POINTER(c_double))
+            entry_type = CFUNCTYPE(
+                c_int32, *(param_types[:-1] + shape_types + param_types[-1:]))
+            run_steps_type = CFUNCTYPE(
+                c_int32, *(param_types[:-1] + param_types[-2:-1] +
+                           [c_int32] + shape_types + [POINTER(c_double)])
+            )
 
+        record = {}
         if self.backend == StencilOclTransformer:
             concrete_function = OclStencilFunction()
-            if self.kernel.is_copied:
-                args = [
-                    project, entry_type, entry_point,
-                ]
-                kernels = []
-                for index, kernel in enumerate(project.find_all(OclFile)):
-                    # print("XXX index {} kernel {}".format(index, kernel.name))
-                    print("Kernel Codegen\n".format(kernel.codegen()))
-                    program = clCreateProgramWithSource(
-                        concrete_function.context, kernel.codegen()).build()
-                    if index == 0:
-                        ocl_kernel_name = 'stencil_kernel'
-                    else:
-                        ocl_kernel_name = kernel.name
-                    kernel_ptr = program[ocl_kernel_name]
-                    kernels.append(kernel_ptr)
-                args.append(kernels)
-                args.append(self.output)
-
-                finalized = concrete_function.finalize(*args)
+            if cached is not None:
+                record = cached.record
             else:
-                kernel = project.find(OclFile)
-                program = clCreateProgramWithSource(concrete_function.context,
-                                                    kernel.codegen()).build()
-                stencil_kernel_ptr = program['stencil_kernel']
-                finalized = concrete_function.finalize(
-                    project, entry_type, entry_point,
-                    stencil_kernel_ptr,
-                    self.output
-                )
+                kernel_sources = []
+                for index, kernel in enumerate(project.find_all(OclFile)):
+                    if index > 0 and not self.kernel.is_copied:
+                        break
+                    # the boundary kernels are named after their file
+                    ocl_kernel_name = \
+                        'stencil_kernel' if index == 0 else kernel.name
+                    kernel_sources.append([ocl_kernel_name, kernel.codegen()])
+                record = {
+                    'kernels': kernel_sources,
+                    'output_fully_assigned': self.output_fully_assigned(),
+                }
+            kernels = [
+                clCreateProgramWithSource(
+                    concrete_function.context, source).build()[name]
+                for name, source in record['kernels']
+            ]
+            finalized = concrete_function.finalize(
+                project, entry_type, entry_point,
+                kernels if self.kernel.is_copied else kernels[0],
+                self.output,
+                record['output_fully_assigned'],
+                self.kernel.ghost_depth if self.kernel.shape_generic else None,
+                self.output_overwritten(record['output_fully_assigned'])
+            )
         else:
             concrete_function = ConcreteStencil()
-            finalized = concrete_function.finalize(project, entry_point,
-                                                   entry_type, self.output)
+            finalized = concrete_function.finalize(
+                project, entry_point, entry_type,
+                None if self.kernel.shape_generic else self.output,
+                run_steps_type, self.kernel.shape_generic,
+                self.output_overwritten(self.output_fully_assigned()),
+                self.backend == StencilOmpTransformer and
+                self.kernel.first_touch, self.kernel.first_touch_inputs,
+                self.kernel.alignment, self.kernel.restrict)
+        if self.binary_cache is not None and cached is None:
+            self.binary_cache.store(self.binary_cache_key(program_config),
+                                    concrete_function._module.so_file_name,
+                                    record)
         self.output = None
         self.fusable_nodes = []
         return finalized
@@ -409,10 +1071,36 @@ class SpecializedStencil(LazySpecializedFunction):
         concrete_function = ConcreteStencil()
         return concrete_function.finalize(entry_point, project, entry_type)
 
+    def output_fully_assigned(self):
+        """
+        checks whether the kernel overwrites every point of its output, in
+        which case the output never needs to be cleared between steps
+        :return: True if the kernel never reads the previous output contents
+        """
+        tree = self.kernel.stencil_model(copy.deepcopy(self.original_tree))
+        kernel_decl = tree.find(FunctionDecl)
+        return StencilBackend.assigns_every_point(
+            kernel_decl.defn, kernel_decl.params[-1].name)
+
+    def output_overwritten(self, fully_assigned):
+        """
+        :param fully_assigned: the result of output_fully_assigned
+        :return: True if a call writes every point of its output, the
+            interior through the kernel and the halo through clamping,
+            wrapping or copying, a zero boundary relies on the output starting out zeroed
+        """
+        return fully_assigned and (self.kernel.is_clamped or
+                                   self.kernel.is_wrapped or
+                                   self.kernel.is_copied)
+
     def generate_output(self, program_cfg):
         arg_cfg, tune_cfg = program_cfg
         if self.output is None:
-            self.output = zeros(arg_cfg[0].shape, arg_cfg[0].dtype)
+            if arg_cfg[0].shape is None:
+                # shape generic, the backends only use the layout
+                self.output = zeros(self.args[0].shape, arg_cfg[0].dtype)
+            else:
+                self.output = zeros(arg_cfg[0].shape, arg_cfg[0].dtype)
         return self.output
 
     def get_placeholder_output(self, args):
@@ -430,11 +1118,9 @@ class SpecializedStencil(LazySpecializedFunction):
             for arg in arg_cfg + (output, )
         ]
 
-        for transformer in [
-            PythonToStencilModel(),
-            self.backend(self.args, output, self.kernel, arg_cfg=arg_cfg,
-                         fusable_nodes=None)]:
-            tree = transformer.visit(tree)
+        tree = self.kernel.stencil_model(tree)
+        tree = self.backend(self.args, output, self.kernel, arg_cfg=arg_cfg,
+                            fusable_nodes=None).visit(tree)
         ocl_file = tree.find(OclFile)
         loop_body = ocl_file.body[0].defn
         params = ocl_file.body[0].params
@@ -457,12 +1143,16 @@ class Stencil(object):
                     "omp": StencilOmpTransformer,
                     "ocl": StencilOclTransformer,
                     "opencl": StencilOclTransformer,
-                    "python": None}
+                    "python": None,
+                    "numpy": None}
 
     boundary_handling_list = ['clamp', 'zero', 'copy', 'wrap']
     composable = True
 
     def __call__(self, *args, **kwargs):
+        if args and isinstance(args[0], PaddedGrid):
+            return padded_grid.apply(self, args[0], kwargs.pop('n_steps', 1),
+                                     *args[1:], **kwargs)
         return self.specializer(*args, **kwargs)
 
     def __init__(self, backend='ocl', neighborhoods=None,
@@ -476,10 +1166,16 @@ class Stencil(object):
         specialization process using ctree's infrastructure.
 
         :param backend: Optional backend that should be used by ctree.
-        Supported backends are c, omp (openmp), and ocl (opencl).
+        Supported backends are c, omp (openmp), and ocl (opencl), numpy
+        evaluates the kernel with array operations and python runs it
+        point by point, neither needs a compiler.
         :param neighborhood_definition: an iterable of neighborhoods
             neighborhoods are a list of points(tuples)
-        :param boundary_handling: one of skip, clamped, copy; default is clamped
+        :param boundary_handling: one of clamp, zero, copy, wrap; default is
+            clamp, wrap reads the grids as periodic
+        :param batched: Optional keyword, True if the grids have an extra
+            leading axis of independent grids, per dimension block_size and
+            unroll_factor then include that axis
         :raise Exception: If no kernel method is defined.
         """
 
@@ -506,13 +1202,14 @@ class Stencil(object):
 
         self.boundary_handling = boundary_handling
         self.is_clamped = boundary_handling == 'clamp'
-        self.is_warped = boundary_handling == 'warp'
+        self.is_wrapped = boundary_handling == 'wrap'
         self.is_copied = boundary_handling == 'copy'
         self.is_zeroed = boundary_handling == 'zero'
 
         # this is used to communicate shape info from interior points to
-        # neighbors
-        self.current_shape = None
+        # neighbors, it is kept per thread so python kernels may run in
+        # several threads at once
+        self.thread_state = threading.local()
 
         try:
             self.dim = len(self.neighborhood_definition[0][0])
@@ -522,40 +1219,362 @@ class Stencil(object):
                     type(self))
             )
 
-        self.ghost_depth = self.compute_ghost_depth()
+        # a leading batch axis, every grid of a call is a stack of
+        # independent grids the stencil is applied to in a single kernel,
+        # the axis has no neighbors and no ghost zone
+        self.batched = kwargs.get('batched', False)
+        if self.batched:
+            self.neighborhood_definition = [
+                [(0, ) + tuple(neighbor) for neighbor in neighborhood]
+                for neighborhood in self.neighborhood_definition]
+            self.dim += 1
+            spatial_distance = self.distance
+            self.distance = lambda x, y: spatial_distance(x[1:], y[1:])
+            if backend in ('ocl', 'opencl') and (self.is_copied or
+                                                 self.dim > 3):
+                raise StencilException(
+                    "Error: the ocl backend batches grids of at most two "
+                    "dimensions and does not copy their boundary")
 
-        if backend == 'python':
-            self.specializer = self.python_kernel_wrapper
-        elif backend in ['c', 'omp', 'ocl']:
-            self.specializer = SpecializedStencil(self, backend,
-                                                  boundary_handling)
-        self.model = self.kernel
+        self.ghost_depth = self.compute_ghost_depth()
 
         self.should_unroll = kwargs.get('should_unroll', True)
         self.should_cacheblock = kwargs.get('should_cacheblock', False)
         self.block_size = kwargs.get('block_size', 1)
+        self.unroll_factor = kwargs.get('unroll_factor', 1)
+        for name in ['block_size', 'unroll_factor']:
+            factors = getattr(self, name)
+            if not isinstance(factors, int) and len(factors) != self.dim:
+                raise StencilException(
+                    "Error: {} {} needs one factor per dimension, {}".format(
+                        name, factors, self.dim))
+
+        # temporal blocking, fuse this many steps per tile in run_steps,
+        # only used by the c and omp backends
+        self.temporal_block = kwargs.get('temporal_block', 1)
+        self.temporal_tile = kwargs.get('temporal_tile', None)
+        self.temporal_cache_bytes = kwargs.get('temporal_cache_bytes',
+                                               256 * 1024)
+        if self.temporal_block < 1:
+            raise StencilException(
+                "Error: temporal_block must be at least 1, got {}".format(
+                    self.temporal_block))
+        if self.temporal_tile is not None and (
+                isinstance(self.temporal_tile, bool) or
+                not isinstance(self.temporal_tile, (int, np.integer)) or
+                self.temporal_tile < 1):
+            raise StencilException(
+                "Error: temporal_tile must be None or an int of at least 1, "
+                "got {}".format(self.temporal_tile))
+        if self.temporal_block > 1 and self.is_wrapped:
+            # the first planes of a step read the last planes of the step
+            # before, which a sweep along axis 0 has not computed yet
+            raise StencilException(
+                "Error: temporal_block cannot be combined with wrap boundary "
+                "handling")
+
+        # persistent cache of compiled stencils, binary_cache is True for
+        # the default directory or the path of the cache directory
+        self.binary_cache = kwargs.get('binary_cache', False)
+        self.binary_cache_size = kwargs.get('binary_cache_size',
+                                            256 * 1024 * 1024)
+
+        # autotuning of the compiled variant, tuning_database is the path
+        # of the json file results persist to, False keeps them in memory
+        self.autotune = kwargs.get('autotune', False)
+        self.tuning_database = kwargs.get('tuning_database', None)
+        self.tuning_trials = kwargs.get('tuning_trials', 2)
+
+        # compile one kernel for every grid shape, the sizes and strides
+        # are then passed in at run time instead of baked into the code
+        self.shape_generic = kwargs.get('shape_generic', False)
+
+        # openmp options, omp_collapse outer loops are shared among the
+        # threads, by default all but the innermost, which is the most
+        # with simd, omp_schedule is a kind or a (kind, chunk) pair, simd
+        # vectorizes the innermost loop and num_threads overrides the
+        # openmp default
+        self.omp_collapse = kwargs.get('omp_collapse', None)
+        schedule = kwargs.get('omp_schedule', 'static')
+        if not isinstance(schedule, (tuple, list)):
+            schedule = (schedule, None)
+        self.omp_schedule = tuple(schedule)
+        if len(self.omp_schedule) != 2 or self.omp_schedule[0] not in (
+                'static', 'dynamic', 'guided', 'auto', 'runtime'):
+            raise StencilException(
+                "Error: omp_schedule {} is not an openmp schedule".format(
+                    schedule))
+        self.simd = kwargs.get('simd', True)
+        self.num_threads = kwargs.get('num_threads', None)
+        if self.omp_collapse is not None:
+            most = self.dim - 1 if self.simd and self.dim > 1 else self.dim
+            if isinstance(self.omp_collapse, bool) or \
+                    not isinstance(self.omp_collapse, (int, np.integer)) or \
+                    not 1 <= self.omp_collapse <= most:
+                raise StencilException(
+                    "Error: omp_collapse must be an int from 1 to {} for {} "
+                    "dimensions{}, got {}".format(
+                        most, self.dim, " with simd" if self.simd else "",
+                        self.omp_collapse))
+
+        # numa placement for the omp backend, proc_bind binds the threads
+        # close together or spread over the sockets, the places they are
+        # bound to, e.g. cores or sockets, are read by the openmp runtime
+        # from OMP_PLACES once, so it has to be set in the environment the
+        # process is started with, omp_places checks that it is, first_touch
+        # has the outputs cleared by the threads that compute them and
+        # first_touch_inputs copies the input grids the same way
+        self.proc_bind = kwargs.get('proc_bind', None)
+        if self.proc_bind not in (None, 'master', 'primary', 'close',
+                                  'spread'):
+            raise StencilException(
+                "Error: proc_bind {} is not an openmp thread affinity".format(
+                    self.proc_bind))
+        self.omp_places = kwargs.get('omp_places', None)
+        if self.omp_places is not None and \
+                os.environ.get('OMP_PLACES') != str(self.omp_places):
+            raise StencilException(
+                "Error: omp_places {} needs OMP_PLACES={} in the environment "
+                "the process is started with, got {}".format(
+                    self.omp_places, self.omp_places,
+                    os.environ.get('OMP_PLACES')))
+        self.first_touch = kwargs.get('first_touch', True)
+        self.first_touch_inputs = kwargs.get('first_touch_inputs', False)
+
+        # vectorization of the c and omp backends, restrict promises the
+        # compiler the output overlaps no input, alignment, in bytes, has
+        # the grids copied to aligned buffers where they are not so the
+        # compiler may assume it, cpu_dispatch compiles the kernel for each
+        # isa of a tuple, True for avx512f, avx2 and sse4.2, and runs the
+        # best one the cpu supports
+        self.restrict = kwargs.get('restrict', True)
+        self.alignment = kwargs.get('alignment', None)
+        if self.alignment and self.alignment & (self.alignment - 1):
+            raise StencilException(
+                "Error: alignment {} is not a power of two".format(
+                    self.alignment))
+        cpu_dispatch = kwargs.get('cpu_dispatch', False)
+        if cpu_dispatch is True:
+            if platform.machine().lower() not in ('x86_64', 'amd64'):
+                raise StencilException(
+                    "Error: cpu_dispatch has no default isas for {}".format(
+                        platform.machine()))
+            cpu_dispatch = ('avx512f', 'avx2', 'sse4.2')
+        self.cpu_dispatch = tuple(cpu_dispatch or ())
+
+        # the dtype the value of each point is accumulated in before it is
+        # stored, e.g. float32 for float16 grids, by default the dtype of
+        # the output
+        accumulator_dtype = kwargs.get('accumulator_dtype', None)
+        self.accumulator_dtype = None if accumulator_dtype is None else \
+            np.dtype(accumulator_dtype).name
+
+        self.backend_name = backend
+        self.specializer = self.make_specializer()
+        # the variant applied to PaddedGrids, made on first use
+        self.interior_only = None
+        self.model = self.kernel
 
         self.specialized_sizes = None
 
+    def make_specializer(self):
+        """
+        :return: the callable that applies the stencil with its backend
+        """
+        if self.backend_name == 'python':
+            return self.python_kernel_wrapper
+        elif self.backend_name == 'numpy':
+            return NumpyStencil(self)
+        elif self.backend_name in ['c', 'omp', 'ocl']:
+            return SpecializedStencil(self, self.backend_name,
+                                      self.boundary_handling)
+
+    def interior_stencil(self):
+        """
+        this stencil with zero boundary handling, so that it only computes
+        the points at least the ghost depth from the edges and has no
+        boundary code, it is applied to PaddedGrids whose halo stands in
+        for the boundary handling
+        :return: a Stencil sharing everything else with this one
+        """
+        if self.is_zeroed:
+            return self
+        if self.interior_only is None:
+            interior = copy.copy(self)
+            interior.boundary_handling = 'zero'
+            interior.is_clamped = interior.is_wrapped = False
+            interior.is_copied = False
+            interior.is_zeroed = True
+            interior.thread_state = threading.local()
+            interior.specializer = interior.make_specializer()
+            self.interior_only = interior
+        return self.interior_only
+
+    @property
+    def current_shape(self):
+        return getattr(self.thread_state, 'current_shape', None)
+
+    @current_shape.setter
+    def current_shape(self, shape):
+        self.thread_state.current_shape = shape
+
+    def loop_block_factors(self):
+        """
+        cache block size for each dimension of the compiled loop nest, an
+        integer block_size blocks every dimension but the innermost
+        :return: a tuple of factors or None if blocking is off
+        """
+        if not self.should_cacheblock:
+            return None
+        if isinstance(self.block_size, int):
+            return (self.block_size,) * (self.dim - 1) + (1,)
+        return tuple(self.block_size)
+
+    def loop_unroll_factors(self):
+        """
+        unroll factor for each dimension of the compiled loop nest, an
+        integer unroll_factor only unrolls the innermost dimension
+        :return: a tuple of factors
+        """
+        if isinstance(self.unroll_factor, int):
+            return (1,) * (self.dim - 1) + (self.unroll_factor,)
+        return tuple(self.unroll_factor)
+
     @abc.abstractmethod
     def kernel(self, *args):
         """subclasses must implement this"""
         return
 
-    def python_kernel_wrapper(self, *args):
+    def stencil_model(self, tree):
+        """
+        the stencil model the backends generate code from
+        :param tree: the python AST of the kernel method
+        """
+        return PythonToStencilModel().visit(tree)
+
+    def run_steps(self, grid, n_steps, *args, **kwargs):
+        """
+        apply the stencil n_steps times, each step uses the output of the
+        previous step as its first input grid, any additional args are
+        passed unchanged to every step.  It is a call with n_steps, so a
+        subclass that adds arguments in __call__ adds them here too.
+        Compiled backends do the whole iteration in a single call,
+        alternating between two preallocated buffers
+        :param grid: the initial grid
+        :param n_steps: number of times to apply the stencil
+        :param out: optional keyword, an array shaped like grid that
+            receives the result
+        :param blocking: optional keyword, False returns a StencilFuture
+        :param queue: optional keyword, the command queue of an ocl call
+        :return: the grid after n_steps applications
+        """
+        if n_steps < 1:
+            raise StencilException(
+                "Error: n_steps must be at least 1, got {}".format(n_steps))
+        kwargs['n_steps'] = n_steps
+        return self(grid, *args, **kwargs)
+
+    def map(self, grids, *args, **kwargs):
+        """
+        apply the stencil to each of a batch of independent grids from a
+        pool of threads, compiled calls release the GIL so they run on all
+        the cores at once, any additional args are passed to every call
+        :param grids: an iterable of input grids
+        :param workers: optional keyword, number of threads, by default one
+            per cpu
+        :param out: optional keyword, a sequence of output arrays, one for
+            each grid
+        :param kwargs: the other keywords, e.g. n_steps or blocking, are
+            passed to every call
+        :return: the list of the outputs, in the order of grids
+        """
+        grids = list(grids)
+        workers = kwargs.pop('workers', None) or multiprocessing.cpu_count()
+        outs = kwargs.pop('out', None)
+        if outs is None:
+            outs = [None] * len(grids)
+        elif len(outs) != len(grids):
+            raise StencilException(
+                "Error: map got {} output arrays for {} grids".format(
+                    len(outs), len(grids)))
+
+        def call(grid_and_out):
+            grid, out = grid_and_out
+            if out is None:
+                return self(grid, *args, **kwargs)
+            return self(grid, *args, out=out, **kwargs)
+
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(call, list(zip(grids, outs)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def stream(self, grid, *args, **kwargs):
+        """
+        apply the stencil to a grid too large for memory, one slab of rows
+        along axis 0 at a time, see stencil_code.streaming.stream
+        :param grid: a numpy.memmap or other array, or an iterable of
+            chunks of consecutive rows
+        :param out: optional keyword, the array or memmap written to,
+            required for chunks
+        :param filename: optional keyword, write the result to a new .npy
+            memmap of that name
+        :param slab_rows: optional keyword, output rows computed per call
+        :param n_steps: optional keyword, number of applications
+        :return: the output array
+        """
+        return stream(self, grid, *args, **kwargs)
+
+    def python_kernel_wrapper(self, *args, **kwargs):
         """
         create an output buffer based on input_buffer then call the kernel
         :param args:
+        :param n_steps: optional keyword, number of times to apply the
+            kernel, each output is the first input grid of the next step
+        :param out: optional keyword, the output buffer to use instead
+        :param blocking: optional keyword, False returns a StencilFuture
+            that is already done
         :return:
         """
+        n_steps = kwargs.get('n_steps', 1)
+        out = kwargs.get('out')
+        output = args[0]
+        for step in range(n_steps):
+            output = self.python_step(
+                (output,) + tuple(args[1:]),
+                out if step == n_steps - 1 else None)
+
+        if not kwargs.get('blocking', True):
+            return StencilFuture.completed(output)
+        return output
+
+    def python_step(self, args, output=None):
+        """
+        one application of the kernel for the python backend
+        :param args: the input grids
+        :param output: the output buffer, None for a new one
+        :return: the output grid
+        """
         input_grid = args[0]
-        output = np.zeros_like(input_grid)
-        self.kernel(*(args + (output,)))
+        if output is None:
+            output = np.zeros_like(input_grid)
+        else:
+            check_output(output, input_grid)
+            output.fill(0)
+        if self.accumulator_dtype is None:
+            self.kernel(*(args + (output,)))
+        else:
+            accumulated = np.zeros(output.shape, self.accumulator_dtype)
+            self.kernel(*(args + (accumulated,)))
+            output[...] = accumulated
 
         if self.is_copied:
-            for point in self.halo_points(input_grid):
-                output[point] = input_grid[point]
-
+            for slab in HaloEnumerator(self.ghost_depth,
+                                       input_grid.shape).slabs():
+                region = tuple(slice(start, stop) for start, stop in slab)
+                output[region] = input_grid[region]
         return output
 
     @property
@@ -582,14 +1601,14 @@ class Stencil(object):
         """
         an iterator over the points in a matrix being operated on.  The
         behaviour of this method depends on the boundary_handling
-        DANGER: clamping requires that the neighbors method have access to the
-        current shape, which means this functions is not re-entrant, it cannot
-        be called from separate threads with different shapes
+        clamping and wrapping require that the neighbors method have access
+        to the current shape, it is kept per thread so separate threads may iterate
+        over grids of different shapes
         :param x: the matrix to iterate over, typically this is the output
             matrix
         :return:
         """
-        if self.is_clamped:
+        if self.is_clamped or self.is_wrapped:
             self.current_shape = x.shape
             dims = (range(0, dim, stride) for dim in x.shape)
         elif self.is_copied:
@@ -619,6 +1638,11 @@ class Stencil(object):
                         lambda dim: Stencil.clamp(point[dim]+neighbor[dim], 0,
                                                   self.current_shape[dim]),
                         range(len(point))))
+            elif self.is_wrapped and self.current_shape is not None:
+                for neighbor in self.neighborhood_definition[neighbors_id]:
+                    yield tuple(
+                        (point[dim] + neighbor[dim]) % self.current_shape[dim]
+                        for dim in range(len(point)))
             else:
                 for neighbor in self.neighborhood_definition[neighbors_id]:
                     yield tuple(map(lambda a, b: a+b, list(point),
@@ -638,7 +1662,8 @@ class Stencil(object):
         :return: a tuple representing a numpy slice that selects the interior of
         a grid
         """
-        return tuple([slice(x+extra, -(x+extra)) for x in self.ghost_depth])
+        return tuple([slice(x+extra, -(x+extra) or None)
+                      for x in self.ghost_depth])
 
     def distance(self, x, y):
         """
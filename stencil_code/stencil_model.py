@@ -1,4 +1,5 @@
 import ast
+from copy import deepcopy
 from ctree.dotgen import DotGenVisitor
 from ctree.templates.nodes import StringTemplate
 from ctree.c.nodes import *
@@ -68,6 +69,41 @@ class GridElement(StencilModelNode):
         return GridElement(grid_name=self.grid_name, target=self.target)
 
 
+class StageBlock(StencilModelNode):
+    """
+    the body of one stage of a fused stencil, evaluated as if the current
+    point were shifted by offset, intermediate stages keep their result in
+    a local variable instead of writing a grid
+    """
+    _fields = ['body']
+
+    def __init__(self, stage=None, offset=None, body=None, final=False):
+        self.stage = stage
+        self.offset = offset
+        self.body = body
+        self.final = final
+        super(StageBlock, self).__init__()
+
+    def __deepcopy__(self, memo):
+        # the stage is the stencil the block comes from, not part of the
+        # tree, so copies of the tree share it
+        return StageBlock(self.stage, self.offset,
+                          deepcopy(self.body, memo), self.final)
+
+
+class StageElement(StencilModelNode):
+    """
+    a read of the previous stage of a fused stencil, values maps the
+    offsets at which that stage was evaluated to the names of its results
+    """
+    _fields = ['target']
+
+    def __init__(self, values=None, target=None):
+        self.values = values
+        self.target = target
+        super(StageElement, self).__init__()
+
+
 class StencilModelDotGen(DotGenVisitor):  # pragma: no cover
     def label_InteriorPointsLoop(self, node):
         return r"%s" % "InteriorPointsLoop"
@@ -81,6 +117,12 @@ class StencilModelDotGen(DotGenVisitor):  # pragma: no cover
     def label_GridElement(self, node):
         return r"%s" % "GridElement"
 
+    def label_StageBlock(self, node):
+        return r"StageBlock %s" % str(node.offset)
+
+    def label_StageElement(self, node):
+        return r"StageElement"
+
     def label_MacroDefns(self, node):
         return r"MacroDefns"
 
@@ -0,0 +1,169 @@
+"""
+Apply a stencil to grids larger than memory one slab at a time.
+
+The grid is cut into slabs of rows along axis 0.  Each slab is read
+together with the rows within the ghost depth on either side of it into a
+window buffer, the stencil is applied to the window and only the rows of
+the slab are written to the output, so the halo rows of neighboring slabs
+overlap and the result is the one a call on the whole grid would give.
+Every window has the same shape, the last one is moved back to end at the
+last row of the grid, so a compiled backend specializes a single kernel
+that is reused for every slab, and the window and its output buffer are
+reused too.  Peak memory is a few windows whatever the size of the grid.
+
+The grid may be a numpy.memmap, or any array, or an iterable of chunks of
+consecutive rows, in which case out must be given so the number of rows is
+known.  The output is written slab by slab, typically into a memmap.
+"""
+from __future__ import print_function
+
+import numpy as np
+
+from stencil_code.device_array import DeviceArray
+from stencil_code.stencil_exception import StencilException
+
+# default size of the window a slab is computed in
+SLAB_BYTES = 64 * 1024 * 1024
+
+
+class ChunkReader(object):
+    """
+    random access to increasing row ranges of grids arriving as an iterable
+    of chunks of consecutive rows, only the rows that may still be read are
+    kept
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.start = 0
+        self.rows = None
+
+    def read(self, low, high):
+        """
+        rows low to high of the grid, low must not decrease between calls
+        """
+        if low < self.start:
+            raise StencilException(
+                "Error: row {} of a chunked grid was already released".format(
+                    low))
+        if self.rows is not None:
+            self.rows = self.rows[low - self.start:]
+        self.start = low
+        while self.rows is None or self.start + len(self.rows) < high:
+            try:
+                chunk = np.asarray(next(self.chunks))
+            except StopIteration:
+                raise StencilException(
+                    "Error: chunks end before row {}".format(high))
+            self.rows = chunk if self.rows is None else np.concatenate(
+                [self.rows, chunk])
+        return self.rows[:high - low]
+
+
+def default_slab_rows(shape, itemsize, halo, slab_bytes=SLAB_BYTES):
+    """
+    the number of output rows per slab for windows of about slab_bytes
+    """
+    row_bytes = itemsize * int(np.prod(shape[1:]))
+    return max(1, slab_bytes // max(row_bytes, 1) - 2 * halo)
+
+
+def stream(stencil, grid, *args, **kwargs):
+    """
+    apply stencil to grid one slab of rows at a time
+    :param stencil: the Stencil to apply, with any backend
+    :param grid: the first input grid, an array, typically a numpy.memmap,
+        or an iterable of arrays that are consecutive rows of the grid
+    :param args: the other input grids, arrays shaped like the grid are
+        cut into slabs with it, anything else is passed whole to every call
+    :param out: Optional keyword, the array, typically a numpy.memmap, the
+        result is written to, required when grid is an iterable of chunks
+    :param filename: Optional keyword, when out is not given the result is
+        written to a new .npy file of that name, opened as a memmap
+    :param slab_rows: Optional keyword, the number of output rows computed
+        per call, by default windows are about SLAB_BYTES
+    :param n_steps: Optional keyword, apply the stencil this many times,
+        the halo of every slab is n_steps times the ghost depth
+    :return: out
+    """
+    out = kwargs.get('out')
+    n_steps = kwargs.get('n_steps', 1)
+    if n_steps < 1:
+        raise StencilException(
+            "Error: n_steps must be at least 1, got {}".format(n_steps))
+
+    if isinstance(grid, np.ndarray):
+        reader = None
+        shape, dtype = grid.shape, grid.dtype
+    elif out is not None:
+        reader = ChunkReader(grid)
+        shape, dtype = out.shape, out.dtype
+    else:
+        raise StencilException(
+            "Error: out is required to stream a grid given as chunks")
+    if out is None:
+        filename = kwargs.get('filename')
+        if filename is not None:
+            out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                            shape=shape)
+        else:
+            out = np.empty(shape, dtype)
+    elif out.shape != tuple(shape) or out.dtype != dtype:
+        raise StencilException(
+            "Error: out is {} {}, the stencil produces {} {}".format(
+                out.dtype, out.shape, dtype, shape))
+
+    rows = shape[0]
+    halo = stencil.ghost_depth[0] * n_steps
+    wrapped = stencil.boundary_handling == 'wrap'
+    if wrapped and reader is not None:
+        raise StencilException(
+            "Error: wrap boundary handling needs random access to the grid, "
+            "it cannot be streamed from chunks")
+    slab_rows = kwargs.get('slab_rows') or default_slab_rows(
+        shape, np.dtype(dtype).itemsize, halo)
+    window_rows = slab_rows + 2 * halo
+    if not wrapped:
+        window_rows = min(window_rows, rows)
+
+    def is_slabbed(arg):
+        return isinstance(arg, np.ndarray) and arg.shape == tuple(shape)
+
+    def read(source, low):
+        if wrapped:
+            return np.take(source, np.arange(low, low + window_rows) % rows,
+                           axis=0)
+        if source is None:
+            return reader.read(low, low + window_rows)
+        return source[low:low + window_rows]
+
+    windows = [np.empty((window_rows,) + tuple(shape[1:]), dtype)] + [
+        np.empty((window_rows,) + arg.shape[1:], arg.dtype)
+        for arg in args if is_slabbed(arg)]
+    result = np.empty_like(windows[0])
+    for low in range(0, rows, slab_rows):
+        high = min(low + slab_rows, rows)
+        # the first row of the window, moved so the window stays within
+        # the grid, where it is cut short by the edge of the grid the edge
+        # is a real one and the stencil handles it
+        start = low - halo if wrapped else \
+            max(0, min(low - halo, rows - window_rows))
+        windows[0][...] = read(None if reader is not None else grid, start)
+        call_args, slabbed = [windows[0]], 1
+        for arg in args:
+            if is_slabbed(arg):
+                windows[slabbed][...] = read(arg, start)
+                call_args.append(windows[slabbed])
+                slabbed += 1
+            else:
+                call_args.append(arg)
+        if n_steps > 1:
+            slab = stencil.run_steps(call_args[0], n_steps, *call_args[1:],
+                                     out=result)
+        else:
+            slab = stencil(*call_args, out=result)
+        if isinstance(slab, DeviceArray):
+            slab = slab.get()
+        out[low:high] = slab[low - start:high - start]
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
@@ -0,0 +1,212 @@
+"""
+Autotuning support for the compiled backends.
+
+A StencilTuningDriver times a list of candidate configurations on the
+first calls made with a given argument configuration, one candidate per
+call, and then keeps handing out the fastest one.  Every candidate computes
+the same result so the calls made while tuning are ordinary calls.  The
+winner is written to a TuningDatabase so that later processes start with
+the tuned variant.
+"""
+from __future__ import print_function
+import json
+import os
+import tempfile
+
+from ctree.tune import TuningDriver
+
+from stencil_code.binary_cache import FileLock
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def default_database_path():
+    """
+    the tuning database lives in ~/.stencil_code unless the
+    STENCIL_CODE_TUNING_DB environment variable names another file
+    """
+    return os.environ.get(
+        'STENCIL_CODE_TUNING_DB',
+        os.path.join(os.path.expanduser('~'), '.stencil_code', 'tuning.json'))
+
+
+def _as_config(entry):
+    """json turns tuples into lists, turn them back"""
+    if entry is None:
+        return None
+    return dict(
+        (name, tuple(value) if isinstance(value, list) else value)
+        for name, value in entry.items()
+    )
+
+
+class TuningDatabase(object):
+    """
+    A json file mapping tuning keys to the best configuration found for
+    them.  The file is rewritten through a temporary file and a rename so a
+    reader never sees a partially written database, and stores from
+    different processes are serialized by a lock file next to it so none
+    of their entries are lost.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_database_path()
+
+    def load(self):
+        try:
+            with open(self.path) as database_file:
+                return json.load(database_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def lookup(self, key):
+        """
+        :param key: a tuning key
+        :return: the stored configuration or None
+        """
+        return _as_config(self.load().get(key))
+
+    def store(self, key, config):
+        """
+        record config as the best configuration for key, entries for other
+        keys are preserved
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with FileLock(self.path + '.lock'):
+            entries = self.load()
+            entries[key] = config
+            handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w') as temp_file:
+                    json.dump(entries, temp_file, indent=2, sort_keys=True)
+                _replace(temp_path, self.path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+
+class TuningSearch(object):
+    """
+    the state of the search for one tuning key, each candidate is run
+    trials times and judged by its fastest run
+    """
+    def __init__(self, candidates, trials=2, best=None):
+        self.candidates = candidates
+        self.trials = trials
+        self.times = [[] for _ in candidates]
+        self.index = 0
+        self.best = best
+
+    @property
+    def done(self):
+        return self.best is not None
+
+    def next_config(self):
+        if self.done:
+            return self.best
+        return self.candidates[self.index]
+
+    def report(self, elapsed):
+        """
+        :return: True if this report finished the search
+        """
+        if self.done:
+            return False
+        self.times[self.index].append(elapsed)
+        if len(self.times[self.index]) >= self.trials:
+            self.index += 1
+        return self._finish()
+
+    def reject(self):
+        """
+        the current candidate could not be run, skip it
+        :return: True if this finished the search
+        """
+        if self.done:
+            return False
+        self.times[self.index] = [float('inf')]
+        self.index += 1
+        return self._finish()
+
+    def _finish(self):
+        if self.index < len(self.candidates):
+            return False
+        fastest = min(range(len(self.candidates)),
+                      key=lambda index: min(self.times[index]))
+        self.best = self.candidates[fastest]
+        return True
+
+
+class StencilTuningDriver(TuningDriver):
+    """
+    Tunes each argument configuration separately.  The specializer calls
+    select() from args_to_subconfig, ctree then draws the configuration for
+    the call from configs, and the specializer reports the time the call
+    took.
+    """
+    def __init__(self, candidate_generator, database=None, trials=2):
+        """
+        :param candidate_generator: called with the argument configuration,
+            returns the list of configurations to try, the first one is
+            the untuned default
+        :param database: a TuningDatabase or None to keep results in memory
+        :param trials: number of timed calls per candidate
+        """
+        self.candidate_generator = candidate_generator
+        self.database = database
+        self.trials = trials
+        self.searches = {}
+        self.key = None
+        super(StencilTuningDriver, self).__init__()
+
+    def select(self, key, arg_config):
+        """
+        make key the tuning key for the following call, starting a search
+        unless the database already knows its best configuration
+        """
+        if key not in self.searches:
+            best = self.database.lookup(key) if self.database else None
+            candidates = [] if best else self.candidate_generator(arg_config)
+            if not best and len(candidates) == 1:
+                best = candidates[0]
+            self.searches[key] = TuningSearch(candidates, self.trials, best)
+        self.key = key
+
+    def is_tuning(self):
+        return self.key is not None and not self.searches[self.key].done
+
+    def best_config(self, key):
+        search = self.searches.get(key)
+        return search.best if search else None
+
+    def _get_configs(self):
+        while True:
+            if self.key is None:
+                yield None
+            else:
+                yield self.searches[self.key].next_config()
+
+    def report(self, time=None, **kwargs):
+        if self.key is None or time is None:
+            return
+        if self.searches[self.key].report(time):
+            self._store()
+
+    def reject(self):
+        """
+        report that the most recent configuration failed to run
+        """
+        if self.key is not None and self.searches[self.key].reject():
+            self._store()
+
+    def _store(self):
+        search = self.searches[self.key]
+        if self.database and min(min(times) for times in search.times) < \
+                float('inf'):
+            self.database.store(self.key, search.best)
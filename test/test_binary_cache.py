@@ -0,0 +1,106 @@
+import ctypes
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import numpy
+
+from stencil_code.binary_cache import BinaryCache, fingerprint
+
+
+class TestBinaryCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        # a hit loads the library, so the entries hold a real one
+        source = os.path.join(self.directory, 'generated.c')
+        with open(source, 'w') as source_file:
+            source_file.write("int answer(void) { return 42; }\n")
+        self.library = os.path.join(self.directory, 'generated.so')
+        subprocess.check_call(['cc', '-shared', '-fPIC', '-o', self.library,
+                               source])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miss_then_hit(self):
+        cache = BinaryCache(self.cache_directory)
+        key = BinaryCache.make_key('kernel', (16, 16), 'float32')
+        self.assertIsNone(cache.lookup(key))
+
+        cache.store(key, self.library, {'kernels': [['stencil_kernel', 'src']]})
+        entry = BinaryCache(self.cache_directory).lookup(key)
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.record, {'kernels': [['stencil_kernel', 'src']]})
+        self.assertTrue(os.path.exists(entry.module.so_file_name))
+
+    def test_keys_depend_on_every_part(self):
+        key = BinaryCache.make_key('kernel', (16, 16), 'float32')
+        self.assertEqual(key, BinaryCache.make_key('kernel', (16, 16), 'float32'))
+        self.assertNotEqual(key, BinaryCache.make_key('kernel', (16, 17), 'float32'))
+        self.assertNotEqual(key, BinaryCache.make_key('kernel', (16, 16), 'float64'))
+
+    def test_first_store_wins(self):
+        cache = BinaryCache(self.cache_directory)
+        key = BinaryCache.make_key('kernel')
+        cache.store(key, self.library, {'first': True})
+        cache.store(key, self.library, {'first': False})
+        self.assertEqual(cache.lookup(key).record, {'first': True})
+        self.assertEqual(len(cache.entries()), 1)
+        # no staging directories are left behind
+        self.assertEqual(
+            [name for name in os.listdir(self.cache_directory) if name.startswith('.s')], [])
+
+    def test_hit_survives_eviction(self):
+        cache = BinaryCache(self.cache_directory)
+        key = BinaryCache.make_key('kernel')
+        cache.store(key, self.library, {})
+        entry = cache.lookup(key)
+        # another process evicts the entry before finalize runs
+        cache.clear()
+        self.assertIsNone(cache.lookup(key))
+        answer = entry.module.get_callable('answer',
+                                           ctypes.CFUNCTYPE(ctypes.c_int))
+        self.assertEqual(answer(), 42)
+
+    def test_unloadable_entry_is_a_miss(self):
+        cache = BinaryCache(self.cache_directory)
+        key = BinaryCache.make_key('kernel')
+        cache.store(key, self.library, {})
+        with open(os.path.join(cache.entry_path(key), 'stencil.so'),
+                  'wb') as library_file:
+            library_file.write(b'x' * 1000)
+        self.assertIsNone(cache.lookup(key))
+        # the corrupt entry is replaced by the next store
+        cache.store(key, self.library, {'repaired': True})
+        entry = cache.lookup(key)
+        self.assertEqual(entry.record, {'repaired': True})
+        self.assertEqual(entry.module.get_callable(
+            'answer', ctypes.CFUNCTYPE(ctypes.c_int))(), 42)
+
+    def test_least_recently_used_are_evicted(self):
+        max_bytes = int(3.5 * os.path.getsize(self.library))
+        cache = BinaryCache(self.cache_directory, max_bytes=max_bytes)
+        keys = [BinaryCache.make_key('kernel', index) for index in range(3)]
+        for index, key in enumerate(keys):
+            cache.store(key, self.library, {})
+            os.utime(cache.entry_path(key), (index, index))
+        # using the oldest entry makes the second one the eviction victim
+        self.assertIsNotNone(cache.lookup(keys[0]))
+        cache.store(BinaryCache.make_key('kernel', 3), self.library, {})
+
+        self.assertIsNotNone(cache.lookup(keys[0]))
+        self.assertIsNone(cache.lookup(keys[1]))
+        self.assertIsNotNone(cache.lookup(keys[2]))
+        self.assertLessEqual(cache.size(), max_bytes)
+
+    def test_fingerprint(self):
+        array = numpy.arange(6).reshape(2, 3)
+        self.assertEqual(fingerprint({'b': array, 'a': [1, 2.5]}),
+                         fingerprint({'a': [1, 2.5], 'b': array.copy()}))
+        self.assertNotEqual(fingerprint({'b': array}), fingerprint({'b': array + 1}))
+        self.assertEqual(fingerprint(object()), 'object')
+        self.assertEqual(fingerprint([object()], lambda value: 'described'),
+                         '[described]')
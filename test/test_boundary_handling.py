@@ -45,6 +45,30 @@ class TestBoundaryHandling(unittest.TestCase):
             "neighborhoods around interior points are not clamped"
         )
 
+    def test_python_wrapping(self):
+        class Wrapper(Stencil):
+            neighborhoods = [Neighborhood.von_neuman_neighborhood(radius=1, dim=2)]
+
+            def kernel(self, in_grid, out_grid):
+                for p in self.interior_points(out_grid):
+                    for n in self.neighbors(p, 0):
+                        out_grid[p] += in_grid[n]
+
+        wrapper = Wrapper(backend='python', boundary_handling='wrap')
+        in_grid = numpy.random.random([6, 7])
+        wrapper.current_shape = in_grid.shape
+
+        assert_list_equal(
+            [x for x in wrapper.neighbors((5, 0), 0)],
+            [(4, 0), (5, 6), (5, 0), (5, 1), (0, 0)],
+            "neighbors beyond the edges wrap around to the other side"
+        )
+        expected = in_grid.copy()
+        for axis in range(2):
+            for shift in [-1, 1]:
+                expected += numpy.roll(in_grid, shift, axis)
+        numpy.testing.assert_array_almost_equal(wrapper(in_grid), expected)
+
     def test_clamped(self):
         """
         zero boundary handling should just leave zero's in grid halo
@@ -1,9 +1,15 @@
 __author__ = 'leonardtruong'
+import itertools
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import numpy
 import numpy.testing
 
+from stencil_code.fused_stencil import FusedStencil
 from stencil_code.library.convolution import ConvolutionFilter
 from stencil_code.library.bilateral_filter import BilateralFilter, gaussian
 from stencil_code.library.better_bilateral_filter import BetterBilateralFilter
@@ -12,11 +18,31 @@ from stencil_code.library.jacobi_stencil import Jacobi
 from stencil_code.library.laplacian import LaplacianKernel
 from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
 from stencil_code.library.two_d_heat import TwoDHeatFlow
+from stencil_code.padded_grid import PaddedGrid
+from stencil_code.stencil_exception import StencilException
+from stencil_code.stencil_future import StencilFuture
+from stencil_code.stencil_kernel import SpecializedStencil, Stencil
+from stencil_code.tuning import TuningDatabase
 
 import logging
 logging.basicConfig(level=20)
 
 
+def load_source(name, path):
+    """
+    import the python file at path as a module called name
+    """
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
 class TestCEndToEnd(unittest.TestCase):
     backend_to_test = 'c'
     backend_to_compare = 'python'
@@ -93,3 +119,517 @@ class TestCEndToEnd(unittest.TestCase):
     def test_better_bilateral_filter(self):
         in_grid = numpy.random.random([64, 32]).astype(numpy.float32) * 255
         self._check(BetterBilateralFilter, in_grid)
+
+    def _check_run_steps(self, stencil_class_to_test, n_steps, in_grid, *args, **kwargs):
+        hp_stencil = stencil_class_to_test(backend=TestCEndToEnd.backend_to_test, **kwargs)
+        compare_stencil = stencil_class_to_test(backend=TestCEndToEnd.backend_to_compare,
+                                                **kwargs)
+
+        hp_out_grid = hp_stencil.run_steps(in_grid, n_steps, *args)
+        compare_grid = compare_stencil.run_steps(in_grid, n_steps, *args)
+
+        self._compare_grids(hp_stencil, hp_out_grid, compare_grid)
+
+    def test_2d_heat_run_steps(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        self._check_run_steps(TwoDHeatFlow, 1, in_grid)
+        self._check_run_steps(TwoDHeatFlow, 4, in_grid)
+        self._check_run_steps(TwoDHeatFlow, 5, in_grid, boundary_handling='copy')
+
+    def test_run_steps_adds_call_arguments(self):
+        in_grid = numpy.random.random([20, 24]).astype(numpy.float32) * 255
+        for stencil in [
+                ConvolutionFilter(numpy.random.random([3, 3]),
+                                  backend=TestCEndToEnd.backend_to_test,
+                                  separable=False, fft=False),
+                BetterBilateralFilter(
+                    backend=TestCEndToEnd.backend_to_test)]:
+            expected = stencil(stencil(in_grid))
+            numpy.testing.assert_array_almost_equal(
+                stencil.run_steps(in_grid, 2), expected)
+            numpy.testing.assert_array_almost_equal(
+                stencil.stream(in_grid, n_steps=2, slab_rows=7), expected)
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend=TestCEndToEnd.backend_to_test)(
+                in_grid[None], in_grid[None])
+
+    def test_laplacian27_run_steps(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        coefficients = numpy.array([0.1, 0.05, 0.025, 0.0125]).astype(numpy.float32)
+        self._check_run_steps(SpecializedLaplacian27, 3, in_grid, coefficients,
+                              boundary_handling='copy')
+
+    def test_temporal_blocking(self):
+        in_grid = numpy.random.random([20, 9, 9]).astype(numpy.float32)
+        coefficients = numpy.array([0.1, 0.05, 0.025, 0.0125]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy']:
+            for temporal_block, temporal_tile in [(2, 1), (3, 4), (4, None)]:
+                untiled = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                       boundary_handling=boundary_handling)
+                tiled = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                     boundary_handling=boundary_handling,
+                                     temporal_block=temporal_block,
+                                     temporal_tile=temporal_tile)
+                numpy.testing.assert_array_almost_equal(
+                    tiled.run_steps(in_grid, 7), untiled.run_steps(in_grid, 7))
+
+                # accumulating kernel, output is cleared tile by tile
+                untiled = SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                                 boundary_handling=boundary_handling)
+                tiled = SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                               boundary_handling=boundary_handling,
+                                               temporal_block=temporal_block,
+                                               temporal_tile=temporal_tile)
+                numpy.testing.assert_array_almost_equal(
+                    tiled.run_steps(in_grid, 4, coefficients),
+                    untiled.run_steps(in_grid, 4, coefficients))
+
+    def test_cacheblock_and_unroll(self):
+        in_grid = numpy.random.random([13, 11, 9]).astype(numpy.float32)
+        coefficients = numpy.array([0.1, 0.05, 0.025, 0.0125]).astype(numpy.float32)
+        options = [
+            {'unroll_factor': 4},
+            {'unroll_factor': (2, 1, 3)},
+            {'should_cacheblock': True, 'block_size': 4},
+            {'should_cacheblock': True, 'block_size': (3, 5, 2), 'unroll_factor': (2, 1, 3)},
+        ]
+        for boundary_handling in ['clamp', 'zero', 'copy']:
+            plain = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                 boundary_handling=boundary_handling)
+            plain_l27 = SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                               boundary_handling=boundary_handling)
+            for kwargs in options:
+                optimized = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                         boundary_handling=boundary_handling, **kwargs)
+                numpy.testing.assert_array_almost_equal(optimized(in_grid), plain(in_grid))
+                optimized = SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                                   boundary_handling=boundary_handling, **kwargs)
+                numpy.testing.assert_array_almost_equal(
+                    optimized(in_grid, coefficients), plain_l27(in_grid, coefficients))
+
+    def test_autotune(self):
+        directory = tempfile.mkdtemp()
+        try:
+            database = os.path.join(directory, 'tuning.json')
+            in_grid = numpy.random.random([20, 18, 16]).astype(numpy.float32)
+            expected = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test)(in_grid)
+
+            stencil = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                   autotune=True, tuning_database=database)
+            tuner = stencil.specializer._tuner
+            calls = 0
+            while True:
+                numpy.testing.assert_array_almost_equal(stencil(in_grid), expected)
+                calls += 1
+                if not tuner.is_tuning():
+                    break
+            self.assertGreater(calls, 1)
+            best = tuner.best_config(tuner.key)
+            self.assertEqual(TuningDatabase(database).lookup(tuner.key), best)
+
+            # once tuned, the compiled call runs outside the lock
+            specializer = stencil.specializer
+            original = specializer.concrete_function
+            unlocked = []
+
+            def try_lock():
+                if specializer.lock.acquire(False):
+                    unlocked.append(True)
+                    specializer.lock.release()
+
+            def concrete_function(args, kwargs):
+                compiled = original(args, kwargs)
+
+                def probe(*call_args, **call_kwargs):
+                    other = threading.Thread(target=try_lock)
+                    other.start()
+                    other.join()
+                    return compiled(*call_args, **call_kwargs)
+                return probe
+
+            specializer.concrete_function = concrete_function
+            numpy.testing.assert_array_almost_equal(stencil(in_grid), expected)
+            self.assertEqual(unlocked, [True])
+
+            # a fresh stencil starts with the tuned variant
+            tuned = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                 autotune=True, tuning_database=database)
+            numpy.testing.assert_array_almost_equal(tuned(in_grid), expected)
+            self.assertFalse(tuned.specializer._tuner.is_tuning())
+            self.assertEqual(tuned.specializer.program_config.tuner_subconfig, best)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_binary_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            in_grid = numpy.random.random([12, 10, 8]).astype(numpy.float32)
+            expected = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test)(in_grid)
+            first = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                 binary_cache=directory)
+            numpy.testing.assert_array_almost_equal(first(in_grid), expected)
+
+            def transform_must_not_run(*args):
+                raise AssertionError("binary cache missed")
+
+            second = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                  binary_cache=directory)
+            second.specializer.transform = transform_must_not_run
+            numpy.testing.assert_array_almost_equal(second(in_grid), expected)
+            numpy.testing.assert_array_almost_equal(
+                second.run_steps(in_grid, 2),
+                TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test).run_steps(in_grid, 2))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_binary_cache_keys_cover_stages(self):
+        directory = tempfile.mkdtemp()
+        try:
+            in_grid = numpy.random.random([6, 5, 4]).astype(numpy.float32)
+            # stages of classes with the same name but different kernels,
+            # from two modules
+            for factor in [2, 3]:
+                name = 'stage_module_{}'.format(factor)
+                path = os.path.join(directory, name + '.py')
+                with open(path, 'w') as module_file:
+                    module_file.write("\n".join([
+                        "from stencil_code.stencil_kernel import Stencil",
+                        "",
+                        "",
+                        "class A(Stencil):",
+                        "    neighborhoods = [[(0, 0, 0)]]",
+                        "",
+                        "    def kernel(self, in_grid, out_grid):",
+                        "        for x in self.interior_points(out_grid):",
+                        "            out_grid[x] = {} * in_grid[x]".format(
+                            factor), ""]))
+                module = load_source(name, path)
+                fused = FusedStencil(
+                    [module.A(backend='python'), module.A(backend='python')],
+                    backend=TestCEndToEnd.backend_to_test,
+                    binary_cache=os.path.join(directory, 'cache'))
+                numpy.testing.assert_array_almost_equal(
+                    fused(in_grid), factor * factor * in_grid)
+
+            # stages that differ only in their attributes
+            class Weighted(Stencil):
+                neighborhoods = [[(0, 0, 0)]]
+
+                def __init__(self, weight, **kwargs):
+                    self.weight = weight
+                    super(Weighted, self).__init__(**kwargs)
+
+                def distance(self, x, y):
+                    return self.weight
+
+                def kernel(self, in_grid, out_grid):
+                    for x in self.interior_points(out_grid):
+                        for y in self.neighbors(x, 0):
+                            out_grid[x] += in_grid[y] * self.distance(x, y)
+
+            for weight in [2.0, 3.0]:
+                fused = FusedStencil(
+                    [Weighted(weight, backend='python'),
+                     Weighted(weight, backend='python')],
+                    backend=TestCEndToEnd.backend_to_test,
+                    binary_cache=os.path.join(directory, 'cache'))
+                numpy.testing.assert_array_almost_equal(
+                    fused(in_grid), weight * weight * in_grid)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_shape_generic(self):
+        coefficients = numpy.array([0.1, 0.05, 0.025, 0.0125]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy']:
+            for kwargs in [{}, {'unroll_factor': 3}, {'temporal_block': 2}]:
+                generic = SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                                 boundary_handling=boundary_handling,
+                                                 shape_generic=True, **kwargs)
+                for shape in [[9, 7, 11], [16, 12, 5], [6, 6, 20]]:
+                    in_grid = numpy.random.random(shape).astype(numpy.float32)
+                    fixed = SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                                   boundary_handling=boundary_handling,
+                                                   **kwargs)
+                    numpy.testing.assert_array_almost_equal(
+                        generic(in_grid, coefficients), fixed(in_grid, coefficients))
+                    numpy.testing.assert_array_almost_equal(
+                        generic.run_steps(in_grid, 3, coefficients),
+                        fixed.run_steps(in_grid, 3, coefficients))
+                # every shape ran through the same compiled kernel
+                self.assertEqual(len(generic.specializer.concrete_functions), 1)
+
+        # grids that are views of larger arrays
+        in_grid = numpy.random.random([20, 24]).astype(numpy.float32)
+        generic = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test, shape_generic=True)
+        fixed = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test)
+        for view in [in_grid[2:14, 3:20], in_grid[:, ::2]]:
+            numpy.testing.assert_array_almost_equal(
+                generic(view), fixed(numpy.ascontiguousarray(view)))
+
+    def test_out_argument(self):
+        in_grid = numpy.random.random([12, 10, 8]).astype(numpy.float32)
+        coefficients = numpy.array([0.1, 0.05, 0.025, 0.0125]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy']:
+            # a kernel that assigns every point and one that accumulates
+            for stencil, args in [
+                    (TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                  boundary_handling=boundary_handling), ()),
+                    (SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test,
+                                            boundary_handling=boundary_handling),
+                     (coefficients,))]:
+                out = numpy.full_like(in_grid, 7.0)
+                for n_steps in [1, 2, 3, 2]:
+                    result = stencil.run_steps(in_grid, n_steps, *args, out=out)
+                    self.assertIs(result, out)
+                    numpy.testing.assert_array_almost_equal(
+                        out, stencil.run_steps(in_grid, n_steps, *args))
+
+    def test_non_blocking(self):
+        in_grid = numpy.random.random([12, 10, 8]).astype(numpy.float32)
+        for backend in [TestCEndToEnd.backend_to_test, 'python']:
+            stencil = TwoDHeatFlow(backend=backend)
+            future = stencil.run_steps(in_grid, 3, blocking=False)
+            self.assertIsInstance(future, StencilFuture)
+            self.assertTrue(future.done())
+            numpy.testing.assert_array_almost_equal(
+                future.result(), stencil.run_steps(in_grid, 3))
+            numpy.testing.assert_array_almost_equal(
+                stencil(in_grid, blocking=False).result(), stencil(in_grid))
+
+    def test_fused_stencil(self):
+        in_grid = numpy.random.random([12, 10, 8]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero']:
+            heat = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test,
+                                boundary_handling=boundary_handling)
+            laplacian = LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                                        boundary_handling=boundary_handling)
+            fused = FusedStencil([heat, laplacian],
+                                 backend=TestCEndToEnd.backend_to_test)
+            interior = fused.interior_points_slice()
+            numpy.testing.assert_array_almost_equal(
+                fused(in_grid)[interior], laplacian(heat(in_grid))[interior],
+                decimal=4)
+        # intermediate values are rounded like the output of each stage
+        in_grid = (in_grid * 100).astype(numpy.int32)
+        stages = [TwoDHeatFlow(backend='python'),
+                  LaplacianKernel(backend='python')]
+        for accumulator_dtype in [None, numpy.float32]:
+            expected = FusedStencil(stages, backend='python',
+                                    accumulator_dtype=accumulator_dtype)
+            for backend in [TestCEndToEnd.backend_to_test, 'numpy']:
+                fused = FusedStencil(stages, backend=backend,
+                                     accumulator_dtype=accumulator_dtype)
+                interior = fused.interior_points_slice()
+                numpy.testing.assert_array_equal(
+                    fused(in_grid)[interior], expected(in_grid)[interior])
+
+    def test_map(self):
+        grids = [numpy.random.random([10 + index % 3, 10, 8]).astype(
+            numpy.float32) for index in range(9)]
+        stencil = TwoDHeatFlow(backend=TestCEndToEnd.backend_to_test)
+        python_stencil = TwoDHeatFlow(backend='python')
+        for result, grid in zip(stencil.map(grids, workers=4), grids):
+            numpy.testing.assert_array_almost_equal(result,
+                                                    python_stencil(grid))
+
+        # concurrent calls into one preallocated scratch buffer
+        outs = [numpy.empty_like(grids[0]) for _ in range(6)]
+        threads = [threading.Thread(
+            target=stencil.run_steps, args=(grids[0], 4), kwargs={'out': out})
+            for out in outs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        expected = stencil.run_steps(grids[0], 4)
+        for out in outs:
+            numpy.testing.assert_array_almost_equal(out, expected)
+
+    def test_batched(self):
+        tiles = numpy.random.random([4, 12, 10]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy']:
+            batched = Jacobi(backend=TestCEndToEnd.backend_to_test,
+                             boundary_handling=boundary_handling,
+                             batched=True)
+            single = Jacobi(backend='python',
+                            boundary_handling=boundary_handling)
+            numpy.testing.assert_array_almost_equal(
+                batched(tiles), numpy.array([single(tile) for tile in tiles]))
+            numpy.testing.assert_allclose(
+                batched.run_steps(tiles, 3),
+                numpy.array([single.run_steps(tile, 3) for tile in tiles]),
+                rtol=1e-5)
+
+        images = (numpy.random.random([3, 24, 24]) * 255).astype(
+            numpy.float32)
+        batched = BetterBilateralFilter(
+            backend=TestCEndToEnd.backend_to_test, batched=True)
+        single = BetterBilateralFilter(backend=TestCEndToEnd.backend_to_test)
+        for result, image in zip(batched(images), images):
+            numpy.testing.assert_array_almost_equal(result, single(image))
+
+    def test_stencils_do_not_share_binaries(self):
+        in_grid = numpy.random.random([12, 10, 8]).astype(numpy.float32)
+        for stencil_class in [TwoDHeatFlow, LaplacianKernel]:
+            python_stencil = stencil_class(backend='python')
+            expected = python_stencil(in_grid)
+            # the python run must not leave clamped offsets behind
+            self.assertIsNotNone(python_stencil.current_shape)
+            python_stencil.specializer = SpecializedStencil(
+                python_stencil, TestCEndToEnd.backend_to_test, 'clamp')
+            numpy.testing.assert_array_almost_equal(
+                python_stencil(in_grid), expected, decimal=4)
+
+    def test_rolled_neighbor_loop(self):
+        in_grid = numpy.random.random([12, 10, 8]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero']:
+            unrolled = LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                                       boundary_handling=boundary_handling)
+            rolled = LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                                     boundary_handling=boundary_handling,
+                                     should_unroll=False)
+            numpy.testing.assert_array_almost_equal(
+                rolled(in_grid), unrolled(in_grid))
+
+        # 361 neighbors with the distance weights read from a table
+        image = numpy.random.random([40, 40]).astype(numpy.float32) * 255
+        args = image, gaussian(3, 18), gaussian(70, 256)
+        hp_stencil = BilateralFilter(9, backend=TestCEndToEnd.backend_to_test)
+        compare_stencil = BilateralFilter(
+            9, backend=TestCEndToEnd.backend_to_compare)
+        self._compare_grids(hp_stencil, hp_stencil(*args),
+                            compare_stencil(*args))
+
+    def test_separable_convolution(self):
+        gaussian_1d = numpy.exp(-numpy.arange(-3, 4) ** 2 / 4.0)
+        gaussian_2d = numpy.outer(gaussian_1d, gaussian_1d)
+        gaussian_3d = numpy.multiply.outer(gaussian_2d, gaussian_1d)
+        for coefficients, shape in [(gaussian_2d, [40, 36]),
+                                    (gaussian_3d, [20, 18, 16])]:
+            in_grid = numpy.random.random(shape).astype(numpy.float32)
+            separable = ConvolutionFilter(
+                convolution_array=coefficients,
+                backend=TestCEndToEnd.backend_to_test)
+            dense = ConvolutionFilter(
+                convolution_array=coefficients,
+                backend=TestCEndToEnd.backend_to_compare, separable=False)
+            self.assertEqual(len(separable.passes), coefficients.ndim)
+            self.assertEqual(dense.passes, [])
+            numpy.testing.assert_array_almost_equal(
+                separable(in_grid), dense(in_grid), decimal=4)
+
+    def test_fft_convolution(self):
+        coefficients = numpy.random.random([9, 9])
+        in_grid = numpy.random.random([40, 36]).astype(numpy.float32)
+        direct = ConvolutionFilter(convolution_array=coefficients,
+                                   backend=TestCEndToEnd.backend_to_test,
+                                   fft=False)
+        fft = ConvolutionFilter(convolution_array=coefficients,
+                                backend=TestCEndToEnd.backend_to_test,
+                                fft=True, fft_tile_shape=(16, 16))
+        numpy.testing.assert_array_almost_equal(
+            fft(in_grid, n_steps=2), direct(in_grid, n_steps=2), decimal=3)
+
+    def test_boundary_slabs(self):
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        for shape in [[13, 17, 19], [3, 2, 5], [1, 6, 4]]:
+            in_grid = numpy.random.random(shape).astype(numpy.float32)
+            for boundary_handling, options in itertools.product(
+                    ['clamp', 'copy'],
+                    [dict(), dict(shape_generic=True),
+                     dict(temporal_block=2)]):
+                stencil = SpecializedLaplacian27(
+                    backend=TestCEndToEnd.backend_to_test,
+                    boundary_handling=boundary_handling, **options)
+                expected = SpecializedLaplacian27(
+                    backend='numpy', boundary_handling=boundary_handling)
+                numpy.testing.assert_array_almost_equal(
+                    stencil.run_steps(in_grid, 2, coefficients),
+                    expected.run_steps(in_grid, 2, coefficients))
+
+    def test_wrap(self):
+        for shape in [[13, 17, 19], [3, 2, 5], [1, 6, 4]]:
+            in_grid = numpy.random.random(shape).astype(numpy.float32)
+            expected = -4 * in_grid
+            for axis in range(3):
+                for shift in [-1, 1]:
+                    expected += numpy.roll(in_grid, shift, axis)
+            for options in [dict(), dict(shape_generic=True),
+                            dict(should_cacheblock=True, block_size=2,
+                                 unroll_factor=2)]:
+                stencil = LaplacianKernel(
+                    backend=TestCEndToEnd.backend_to_test,
+                    boundary_handling='wrap', **options)
+                numpy.testing.assert_array_almost_equal(stencil(in_grid),
+                                                        expected)
+                numpy.testing.assert_array_almost_equal(
+                    stencil.run_steps(in_grid, 3),
+                    LaplacianKernel(backend='numpy',
+                                    boundary_handling='wrap').run_steps(
+                        in_grid, 3))
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                            boundary_handling='wrap', temporal_block=2)
+
+    def test_padded_grid(self):
+        in_grid = numpy.random.random([13, 17, 19]).astype(numpy.float32)
+        stencil = LaplacianKernel(backend=TestCEndToEnd.backend_to_test)
+        for boundary_handling in ['clamp', 'wrap']:
+            padded = PaddedGrid.from_array(in_grid, stencil.ghost_depth,
+                                           boundary_handling)
+            numpy.testing.assert_array_almost_equal(
+                stencil.run_steps(padded, 3).get(),
+                LaplacianKernel(backend='numpy',
+                                boundary_handling=boundary_handling).run_steps(
+                    in_grid, 3))
+
+    def test_vectorization_options(self):
+        in_grid = numpy.random.random([21, 17, 19]).astype(numpy.float32)
+        expected = LaplacianKernel(backend='numpy')(in_grid)
+        # grids that are not aligned to 64 bytes
+        misaligned = numpy.empty(in_grid.size + 1, numpy.float32)[1:]
+        misaligned = misaligned.reshape(in_grid.shape)
+        misaligned[...] = in_grid
+        out = numpy.empty(in_grid.size + 1, numpy.float32)[1:].reshape(
+            in_grid.shape)
+        for options in [dict(restrict=False), dict(alignment=64),
+                        dict(alignment=64, cpu_dispatch=('avx2', ))]:
+            stencil = LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                                      **options)
+            numpy.testing.assert_array_almost_equal(stencil(in_grid),
+                                                    expected)
+            self.assertIs(stencil(misaligned, out=out), out)
+            numpy.testing.assert_array_almost_equal(out, expected)
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                            alignment=48)
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        # restrict, the output must not overlap any input
+        out = numpy.zeros([4, 4, 4], numpy.float32)
+        with self.assertRaises(StencilException):
+            SpecializedLaplacian27(backend=TestCEndToEnd.backend_to_test)(
+                numpy.zeros([4, 4, 4], numpy.float32), out.ravel()[:4],
+                out=out)
+
+    def test_dtypes(self):
+        for dtype in [numpy.float64, numpy.int32, numpy.uint8]:
+            in_grid = (numpy.random.random([11, 9, 13]) * 100).astype(dtype)
+            for options in [dict(), dict(shape_generic=True)]:
+                result = LaplacianKernel(
+                    backend=TestCEndToEnd.backend_to_test, **options)(in_grid)
+                self.assertEqual(result.dtype, dtype)
+                numpy.testing.assert_allclose(
+                    result, LaplacianKernel(backend='numpy')(in_grid),
+                    rtol=1e-6)
+        # half precision grids summed in single precision
+        in_grid = numpy.random.random([11, 9, 13]).astype(numpy.float16)
+        stencil = LaplacianKernel(backend=TestCEndToEnd.backend_to_test,
+                                  accumulator_dtype=numpy.float32)
+        result = stencil.run_steps(in_grid, 2)
+        self.assertEqual(result.dtype, numpy.float16)
+        numpy.testing.assert_allclose(
+            result, LaplacianKernel(
+                backend='numpy', accumulator_dtype=numpy.float32).run_steps(
+                    in_grid, 2), rtol=3e-3, atol=3e-3)
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy
+
+from stencil_code.device_array import DeviceArray, buffer_pool, to_device
+from stencil_code.stencil_exception import StencilException
+
+
+class TestDeviceArray(unittest.TestCase):
+    def test_round_trip(self):
+        data = numpy.random.random([8, 12]).astype(numpy.float32)
+        device_array = to_device(data)
+        self.assertEqual(device_array.shape, (8, 12))
+        self.assertEqual(device_array.dtype, numpy.float32)
+        self.assertEqual(device_array.strides, data.strides)
+        numpy.testing.assert_array_equal(device_array.get(), data)
+        numpy.testing.assert_array_equal(numpy.asarray(device_array), data)
+
+        out = numpy.empty_like(data)
+        self.assertIs(device_array.get(out), out)
+        numpy.testing.assert_array_equal(out, data)
+
+    def test_copy_from(self):
+        data = numpy.random.random([16]).astype(numpy.float32)
+        source = to_device(data)
+        target = DeviceArray.empty(source.shape, source.dtype)
+        target.copy_from(source)
+        numpy.testing.assert_array_equal(target.get(), data)
+
+    def test_released_buffers_are_reused(self):
+        device_array = DeviceArray.empty((4, 4), numpy.float32)
+        pool = buffer_pool(device_array.context, device_array.queue)
+        pool.clear()
+        handle = device_array.buffer.value
+        device_array.release()
+        self.assertEqual(pool.acquire((4, 4), numpy.float32).value, handle)
+        self.assertNotEqual(
+            pool.acquire((4, 4), numpy.float32).value, handle)
+
+    def test_errors(self):
+        device_array = to_device(numpy.zeros([4, 4], numpy.float32))
+        with self.assertRaises(StencilException):
+            device_array.get(numpy.empty([4, 5], numpy.float32))
+        with self.assertRaises(StencilException):
+            device_array.get(numpy.empty([4, 4], numpy.float64))
+        device_array.release()
+        with self.assertRaises(StencilException):
+            device_array.get()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy
+import numpy.testing
+
+from stencil_code.distributed import DistributedStencil
+from stencil_code.library.laplacian import LaplacianKernel
+from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
+from stencil_code.stencil_exception import StencilException
+
+
+class TestDistributedStencil(unittest.TestCase):
+    def test_decompose(self):
+        stencil = LaplacianKernel(backend='numpy', boundary_handling='zero')
+        blocks, window = DistributedStencil(stencil, 3).decompose((10, 6, 4))
+        self.assertEqual([block[0] for block in blocks],
+                         [(0, 4), (4, 8), (8, 10)])
+        self.assertEqual(window, (6, 6, 4))
+        blocks, window = DistributedStencil(
+            stencil, 2, blocks=(1, 2, 2)).decompose((10, 6, 4))
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(window, (10, 5, 4))
+        with self.assertRaises(StencilException):
+            DistributedStencil(stencil, 2, blocks=(2, 2)).decompose(
+                (10, 6, 4))
+
+    def test_matches_single_process(self):
+        in_grid = numpy.random.random([21, 10, 12]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy', 'wrap']:
+            stencil = LaplacianKernel(backend='numpy',
+                                      boundary_handling=boundary_handling)
+            for blocks in [None, (2, 3, 2)]:
+                distributed = DistributedStencil(stencil, 3, blocks=blocks)
+                numpy.testing.assert_array_almost_equal(
+                    distributed(in_grid), stencil(in_grid))
+                numpy.testing.assert_array_almost_equal(
+                    distributed(in_grid, n_steps=3),
+                    stencil.run_steps(in_grid, 3))
+
+    def test_grid_arguments(self):
+        in_grid = numpy.random.random([16, 10, 12]).astype(numpy.float32)
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        stencil = SpecializedLaplacian27(backend='numpy',
+                                         boundary_handling='copy')
+        out = numpy.empty_like(in_grid)
+        self.assertIs(DistributedStencil(stencil, 2)(
+            in_grid, coefficients, n_steps=2, out=out), out)
+        numpy.testing.assert_array_almost_equal(
+            out, stencil.run_steps(in_grid, 2, coefficients))
@@ -0,0 +1,93 @@
+import unittest
+
+import numpy
+import numpy.testing
+
+from stencil_code.fft_convolution import fft_convolve, overlap_add
+from stencil_code.library.convolution import ConvolutionFilter
+from stencil_code.stencil_exception import StencilException
+
+
+def direct_convolve(grid, coefficients, ghost_depth, boundary_handling):
+    """
+    out[p] = sum of grid[p - r] * coefficients[center + r], one shifted
+    copy of the padded grid per coefficient
+    """
+    mode = {'clamp': 'edge', 'wrap': 'wrap'}.get(boundary_handling,
+                                                 'constant')
+    padded = numpy.pad(grid.astype(numpy.float64),
+                       [(depth, depth) for depth in ghost_depth], mode=mode)
+    result = numpy.zeros(grid.shape)
+    for index in numpy.ndindex(*coefficients.shape):
+        shift = [i - size // 2 for i, size in zip(index, coefficients.shape)]
+        result += coefficients[index] * padded[tuple(
+            slice(depth - r, depth - r + size)
+            for depth, r, size in zip(ghost_depth, shift, grid.shape))]
+    if boundary_handling in ('zero', 'copy'):
+        border = numpy.ones(grid.shape, dtype=bool)
+        border[tuple(slice(depth, size - depth) for depth, size in
+                     zip(ghost_depth, grid.shape))] = False
+        result[border] = grid[border] if boundary_handling == 'copy' else 0
+    return result
+
+
+class TestFftConvolution(unittest.TestCase):
+    def test_overlap_add(self):
+        grid = numpy.random.random([23, 17])
+        coefficients = numpy.random.random([5, 3])
+        whole = overlap_add(grid, coefficients)
+        self.assertEqual(whole.shape, (27, 19))
+        numpy.testing.assert_allclose(
+            overlap_add(grid, coefficients, tile_shape=(4, 6)), whole)
+
+    def test_boundary_handling(self):
+        for coefficient_shape, grid_shape in [((5, 5), (30, 26)),
+                                              ((4, 6), (20, 22)),
+                                              ((3, 5, 3), (12, 10, 14))]:
+            coefficients = numpy.random.random(coefficient_shape)
+            grid = numpy.random.random(grid_shape).astype(numpy.float32)
+            ghost_depth = [size // 2 for size in coefficient_shape]
+            for boundary_handling in ['clamp', 'wrap', 'zero', 'copy']:
+                expected = direct_convolve(grid, coefficients, ghost_depth,
+                                           boundary_handling)
+                for tile_shape in [None, (7,) * grid.ndim]:
+                    result = fft_convolve(grid, coefficients, ghost_depth,
+                                          boundary_handling, tile_shape)
+                    self.assertEqual(result.dtype, grid.dtype)
+                    numpy.testing.assert_allclose(result, expected,
+                                                  rtol=1e-5, atol=1e-5)
+        with self.assertRaises(StencilException):
+            fft_convolve(grid, coefficients, ghost_depth, 'reflect')
+
+    def test_convolution_filter(self):
+        coefficients = numpy.random.random([5, 5])
+        grid = numpy.random.random([32, 32]).astype(numpy.float32)
+        fft_filter = ConvolutionFilter(coefficients, backend='python',
+                                       fft=True)
+        direct_filter = ConvolutionFilter(coefficients, backend='python',
+                                          fft=False)
+        numpy.testing.assert_array_almost_equal(
+            fft_filter(grid), direct_filter(grid), decimal=4)
+
+        # the cost model only picks the fft for wide coefficient arrays
+        self.assertTrue(ConvolutionFilter(
+            numpy.random.random([21, 21]), backend='python').use_fft(
+                (512, 512)))
+        self.assertFalse(ConvolutionFilter(
+            numpy.random.random([3, 3]), backend='python').use_fft(
+                (512, 512)))
+        # nor for integer grids
+        self.assertFalse(ConvolutionFilter(
+            numpy.random.random([21, 21]), backend='python').use_fft(
+                (512, 512), numpy.int32))
+
+    def test_integer_grids_are_rounded(self):
+        coefficients = numpy.random.random([5, 5])
+        grid = (numpy.random.random([32, 32]) * 100).astype(numpy.int32)
+        for boundary_handling in ['clamp', 'wrap', 'zero', 'copy']:
+            expected = fft_convolve(grid.astype(numpy.float64), coefficients,
+                                    (2, 2), boundary_handling)
+            result = fft_convolve(grid, coefficients, (2, 2),
+                                  boundary_handling)
+            self.assertEqual(result.dtype, numpy.int32)
+            numpy.testing.assert_array_equal(result, numpy.rint(expected))
@@ -0,0 +1,65 @@
+import unittest
+import numpy
+import numpy.testing
+
+from stencil_code.fused_stencil import FusedStencil
+from stencil_code.library.laplacian import LaplacianKernel
+from stencil_code.library.two_d_heat import TwoDHeatFlow
+from stencil_code.stencil_exception import StencilException
+from stencil_code.stencil_kernel import Stencil
+
+
+class Shift(Stencil):
+    neighborhoods = [[(0, 1, 0)]]
+
+    def kernel(self, in_grid, out_grid):
+        for x in self.interior_points(out_grid):
+            for y in self.neighbors(x, 0):
+                out_grid[x] = 2 * in_grid[y]
+
+
+class TestFusedStencil(unittest.TestCase):
+    def test_offsets_and_ghost_depth(self):
+        fused = FusedStencil([Shift(backend='python'), Shift(backend='python'),
+                              LaplacianKernel(backend='python')],
+                             backend='python')
+        zero = (0, 0, 0)
+        self.assertEqual(fused.stage_offsets[2], [zero])
+        self.assertEqual(len(fused.stage_offsets[1]), 7)
+        self.assertEqual(fused.stage_offsets[0],
+                         sorted(set((a, b + 1, c) for a, b, c in
+                                    fused.stage_offsets[1])))
+        self.assertEqual(fused.ghost_depth, (1, 3, 1))
+
+    def test_python_backend_applies_stages_in_order(self):
+        in_grid = numpy.random.random([10, 10, 10]).astype(numpy.float32)
+        heat = TwoDHeatFlow(backend='python', boundary_handling='zero')
+        laplacian = LaplacianKernel(backend='python', boundary_handling='zero')
+        fused = FusedStencil([heat, laplacian], backend='python')
+        numpy.testing.assert_array_almost_equal(
+            fused(in_grid), laplacian(heat(in_grid)))
+
+    def test_errors(self):
+        class Strided(Stencil):
+            neighborhoods = [[(0, 1, 0)]]
+
+            def kernel(self, in_grid, out_grid):
+                for x in self.interior_points(out_grid):
+                    out_grid[x] = in_grid[int(x)]
+
+        class Flat(Stencil):
+            neighborhoods = [[(0, 1)]]
+
+            def kernel(self, in_grid, out_grid):
+                for x in self.interior_points(out_grid):
+                    out_grid[x] = in_grid[x]
+
+        heat = TwoDHeatFlow(backend='python')
+        with self.assertRaises(StencilException):
+            FusedStencil([heat], backend='python')
+        with self.assertRaises(StencilException):
+            FusedStencil([heat, Flat(backend='python')], backend='python')
+        with self.assertRaises(StencilException):
+            FusedStencil([heat, Strided(backend='python')], backend='python')
+        with self.assertRaises(StencilException):
+            FusedStencil([heat, heat], backend='python', should_unroll=False)
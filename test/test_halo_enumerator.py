@@ -102,3 +102,22 @@ class TestHaloEnumerator(unittest.TestCase):
                 self.assertTrue(halo_set.issubset(all_indices))
                 self.assertTrue(interior_set.issubset(all_indices))
                 self.assertTrue(interior_set.union(halo_set) == all_indices)
+
+    def test_slabs(self):
+        for shape in [[5, 5], [3, 4, 5], [1, 6], [2, 3, 1], [7]]:
+            for halo in itertools.product([0, 1, 2], repeat=len(shape)):
+                enumerator = HaloEnumerator(list(halo), shape)
+                points = [
+                    point for slab in enumerator.slabs()
+                    for point in itertools.product(
+                        *[range(start, stop) for start, stop in slab])]
+                # every halo point once, even when the halos overlap
+                self.assertEqual(len(points), len(set(points)))
+                self._are_lists_equal(points, [
+                    point for point in itertools.product(
+                        *[range(size) for size in shape])
+                    if any(x < h or x >= size - h
+                           for x, h, size in zip(point, halo, shape))])
+        self.assertEqual(HaloEnumerator([1, 1], [5, 5]).slabs(),
+                         [[(0, 1), (0, 5)], [(4, 5), (0, 5)],
+                          [(1, 4), (0, 1)], [(1, 4), (4, 5)]])
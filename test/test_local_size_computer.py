@@ -119,3 +119,14 @@ class TestLocalSizeComputer(unittest.TestCase):
 
             self.assertListEqual(list(cpu_local_size), list(expected_cpu_local_size))
             self.assertListEqual(list(gpu_local_size), list(expected_gpu_local_size))
+
+    def test_compute_local_size_candidates(self):
+        for grid_shape in [[64, 64], [4, 4, 512], [99, 99, 99], [100]]:
+            computer = LocalSizeComputer(grid_shape, MockIrisPro)
+            candidates = computer.compute_local_size_candidates(count=3)
+            self.assertEqual(candidates[0], computer.compute_local_size_bulky())
+            self.assertLessEqual(len(candidates), 3)
+            self.assertEqual(len(set(candidates)), len(candidates))
+            for candidate in candidates:
+                self.assertEqual(len(candidate), len(grid_shape))
+                self.assertLessEqual(product(candidate), MockIrisPro.max_work_group_size)
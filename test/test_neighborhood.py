@@ -136,3 +136,20 @@ class TestNeighborhood(unittest.TestCase):
             value = tuple([value[0] + 1, value[1] + 1])  # add one because indices have become offsets
             self.assertEqual(c[index], coff[value])
         self._are_lists_equal(n, Neighborhood.von_neuman_neighborhood(1, 2))
+
+    def test_separable_factors(self):
+        row = numpy.array([1.0, 4.0, 6.0, 4.0, 1.0])
+        column = numpy.array([1.0, 0.0, -1.0])
+        factors = Neighborhood.separable_factors(numpy.outer(column, row))
+        self.assertEqual(len(factors), 2)
+        numpy.testing.assert_allclose(
+            numpy.outer(factors[0], factors[1]), numpy.outer(column, row))
+        self.assertEqual(factors[0][1], 0.0)
+
+        cube = numpy.multiply.outer(numpy.outer(row, column), row)
+        factors = Neighborhood.separable_factors(cube)
+        self.assertEqual([len(factor) for factor in factors], [5, 3, 5])
+
+        self.assertIsNone(Neighborhood.separable_factors(
+            [[0, 1, 0], [1, -4, 1], [0, 1, 0]]))
+        self.assertIsNone(Neighborhood.separable_factors(numpy.zeros([3, 3])))
@@ -0,0 +1,112 @@
+import unittest
+
+import numpy
+import numpy.testing
+
+from stencil_code.fused_stencil import FusedStencil
+from stencil_code.library.better_bilateral_filter import BetterBilateralFilter
+from stencil_code.library.laplacian import LaplacianKernel
+from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
+from stencil_code.library.two_d_heat import TwoDHeatFlow
+from stencil_code.stencil_exception import StencilException
+from stencil_code.stencil_future import StencilFuture
+from stencil_code.stencil_kernel import Stencil
+
+
+class TestNumpyBackend(unittest.TestCase):
+    def _check(self, stencil_class, *args, **kwargs):
+        interior_only = kwargs.pop('interior_only', False)
+        numpy_stencil = stencil_class(backend='numpy', **kwargs)
+        python_stencil = stencil_class(backend='python', **kwargs)
+        # the python backend passes clamped neighbors to distance()
+        region = numpy_stencil.interior_points_slice() \
+            if interior_only else Ellipsis
+        numpy.testing.assert_array_almost_equal(
+            numpy_stencil(*args)[region], python_stencil(*args)[region],
+            decimal=4)
+
+    def test_boundary_handling(self):
+        in_grid = numpy.random.random([10, 8, 12]).astype(numpy.float32)
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy', 'wrap']:
+            self._check(LaplacianKernel, in_grid,
+                        boundary_handling=boundary_handling)
+            self._check(TwoDHeatFlow, in_grid,
+                        boundary_handling=boundary_handling)
+            if boundary_handling == 'wrap':
+                # the python backend passes wrapped neighbors to distance()
+                continue
+            self._check(SpecializedLaplacian27, in_grid, coefficients,
+                        boundary_handling=boundary_handling,
+                        interior_only=boundary_handling == 'clamp')
+
+    def test_wrap(self):
+        in_grid = numpy.random.random([6, 7, 8]).astype(numpy.float32)
+        result = LaplacianKernel(backend='numpy', boundary_handling='wrap')(
+            in_grid)
+        expected = -4 * in_grid
+        for axis in range(3):
+            for shift in [-1, 1]:
+                expected += numpy.roll(in_grid, shift, axis)
+        numpy.testing.assert_array_almost_equal(result, expected)
+
+    def test_lookup_tables_and_distance(self):
+        in_grid = numpy.random.random([20, 16]).astype(numpy.float32) * 255
+        numpy_stencil = BetterBilateralFilter(backend='numpy')
+        python_stencil = BetterBilateralFilter(backend='python')
+        interior = numpy_stencil.interior_points_slice()
+        numpy.testing.assert_array_almost_equal(
+            numpy_stencil(in_grid)[interior],
+            python_stencil(in_grid)[interior], decimal=3)
+
+    def test_fused_stencil(self):
+        in_grid = numpy.random.random([10, 10, 10]).astype(numpy.float32)
+        stages = [TwoDHeatFlow(backend='python'),
+                  LaplacianKernel(backend='python')]
+        fused = FusedStencil(stages, backend='numpy')
+        interior = fused.interior_points_slice()
+        numpy.testing.assert_array_almost_equal(
+            fused(in_grid)[interior],
+            FusedStencil(stages, backend='python')(in_grid)[interior],
+            decimal=4)
+
+    def test_keywords(self):
+        in_grid = numpy.random.random([8, 8, 8]).astype(numpy.float32)
+        stencil = LaplacianKernel(backend='numpy')
+        expected = stencil(stencil(stencil(in_grid)))
+        numpy.testing.assert_array_almost_equal(
+            stencil.run_steps(in_grid, 3), expected)
+        out = numpy.ones_like(in_grid)
+        self.assertIs(stencil(in_grid, out=out), out)
+        numpy.testing.assert_array_almost_equal(out, stencil(in_grid))
+        future = stencil(in_grid, blocking=False)
+        self.assertIsInstance(future, StencilFuture)
+        numpy.testing.assert_array_almost_equal(future.result(),
+                                                stencil(in_grid))
+
+    def test_accumulator_dtype(self):
+        in_grid = numpy.random.random([10, 8, 12]).astype(numpy.float16)
+        expected = LaplacianKernel(backend='numpy')(
+            in_grid.astype(numpy.float32))
+        for backend in ['numpy', 'python']:
+            result = LaplacianKernel(backend=backend,
+                                     accumulator_dtype='float32')(in_grid)
+            self.assertEqual(result.dtype, numpy.float16)
+            numpy.testing.assert_allclose(result, expected, rtol=1e-3,
+                                          atol=1e-3)
+
+    def test_errors(self):
+        class Branching(Stencil):
+            neighborhoods = [[(0, 1)]]
+
+            def kernel(self, in_grid, out_grid):
+                for x in self.interior_points(out_grid):
+                    if in_grid[x] > 0:
+                        out_grid[x] = 1
+
+        in_grid = numpy.random.random([8, 8]).astype(numpy.float32)
+        with self.assertRaises(StencilException):
+            Branching(backend='numpy')(in_grid)
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend='numpy')(in_grid, in_grid)
@@ -1,9 +1,13 @@
 __author__ = 'chickmarkley'
+import sys
 import unittest
 
 import numpy
 import numpy.testing
 
+from stencil_code.device_array import DeviceArray, to_device
+from stencil_code.stencil_future import StencilFuture, new_queue
+from stencil_code.fused_stencil import FusedStencil
 from stencil_code.library.better_bilateral_filter import BetterBilateralFilter
 from stencil_code.library.laplacian import LaplacianKernel
 from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
@@ -60,3 +64,159 @@ class TestOclEndToEnd(unittest.TestCase):
     def test_bilateral_filter(self):
         in_grid = numpy.random.random([64, 32]).astype(numpy.float32) * 255
         self._check(BetterBilateralFilter, in_grid)
+
+    def test_2d_heat_run_steps(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        for n_steps in [1, 4, 5]:
+            hp_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_test)
+            compare_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+            self._compare_grids(
+                hp_stencil,
+                hp_stencil.run_steps(in_grid, n_steps),
+                compare_stencil.run_steps(in_grid, n_steps)
+            )
+
+    def test_laplacian27_run_steps(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        coefficients = numpy.array([0.1, 0.05, 0.025, 0.0125]).astype(numpy.float32)
+        hp_stencil = SpecializedLaplacian27(backend=TestOclEndToEnd.backend_to_test)
+        compare_stencil = SpecializedLaplacian27(backend=TestOclEndToEnd.backend_to_compare)
+        self._compare_grids(
+            hp_stencil,
+            hp_stencil.run_steps(in_grid, 3, coefficients),
+            compare_stencil.run_steps(in_grid, 3, coefficients)
+        )
+
+    def test_autotune_local_size(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        hp_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_test,
+                                  autotune=True, tuning_database=False)
+        compare_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+        expected = compare_stencil(in_grid)
+        tuner = hp_stencil.specializer._tuner
+        while True:
+            self._compare_grids(hp_stencil, hp_stencil(in_grid), expected)
+            if not tuner.is_tuning():
+                break
+        self.assertIn('local_size', tuner.best_config(tuner.key))
+
+    def test_shape_generic(self):
+        hp_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_test,
+                                  shape_generic=True)
+        for shape in [[16, 16, 16], [8, 12, 20], [16, 16, 32]]:
+            in_grid = numpy.random.random(shape).astype(numpy.float32)
+            compare_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+            self._compare_grids(hp_stencil, hp_stencil(in_grid),
+                                compare_stencil(in_grid))
+            self._compare_grids(hp_stencil, hp_stencil.run_steps(in_grid, 4),
+                                compare_stencil.run_steps(in_grid, 4))
+        self.assertEqual(len(hp_stencil.specializer.concrete_functions), 1)
+
+    def test_out_argument(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        hp_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_test)
+        compare_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+        out = numpy.full_like(in_grid, 7.0)
+        for n_steps in [1, 2, 3]:
+            self.assertIs(hp_stencil.run_steps(in_grid, n_steps, out=out), out)
+            self._compare_grids(hp_stencil, out,
+                                compare_stencil.run_steps(in_grid, n_steps))
+
+    def test_device_pipeline(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        hp_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_test)
+        compare_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+        device_grid = to_device(in_grid)
+        for n_steps in [1, 2, 3]:
+            result = hp_stencil.run_steps(device_grid, n_steps)
+            self.assertIsInstance(result, DeviceArray)
+            self._compare_grids(hp_stencil, result.get(),
+                                compare_stencil.run_steps(in_grid, n_steps))
+
+        chained = hp_stencil(hp_stencil(device_grid))
+        self.assertIsInstance(chained, DeviceArray)
+        self._compare_grids(hp_stencil, chained.get(),
+                            compare_stencil(compare_stencil(in_grid)))
+
+        out = DeviceArray.empty(in_grid.shape, in_grid.dtype)
+        self.assertIs(hp_stencil(in_grid, out=out), out)
+        self._compare_grids(hp_stencil, out.get(), compare_stencil(in_grid))
+
+    def test_non_blocking(self):
+        hp_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_test)
+        compare_stencil = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+        frames = [numpy.random.random([16, 16, 16]).astype(numpy.float32)
+                  for _ in range(4)]
+        queues = [new_queue(), new_queue()]
+        futures = [
+            hp_stencil.run_steps(frame, 2, blocking=False,
+                                 queue=queues[index % 2])
+            for index, frame in enumerate(frames)
+        ]
+        for frame, future in zip(frames, futures):
+            self.assertIsInstance(future, StencilFuture)
+            self._compare_grids(hp_stencil, future.result(),
+                                compare_stencil.run_steps(frame, 2))
+            self.assertTrue(future.done())
+
+        # a device grid produced on one queue and consumed on another
+        first = hp_stencil(to_device(frames[0]), blocking=False,
+                           queue=queues[0])
+        second = hp_stencil(first.result(), blocking=False, queue=queues[1])
+        self._compare_grids(hp_stencil, second.result().get(),
+                            compare_stencil(compare_stencil(frames[0])))
+
+        # awaited from an event loop, the future is passed to the loop as
+        # an awaitable so the module still parses without async syntax
+        if sys.version_info >= (3, 5):
+            import asyncio
+            loop = asyncio.new_event_loop()
+            try:
+                awaited = loop.run_until_complete(
+                    hp_stencil(frames[1], blocking=False))
+            finally:
+                loop.close()
+            self._compare_grids(hp_stencil, awaited,
+                                compare_stencil(frames[1]))
+
+    def test_fused_stencil(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        heat = TwoDHeatFlow(backend=TestOclEndToEnd.backend_to_compare)
+        laplacian = LaplacianKernel(backend=TestOclEndToEnd.backend_to_compare)
+        fused = FusedStencil([heat, laplacian],
+                             backend=TestOclEndToEnd.backend_to_test)
+        self.assertEqual(fused.ghost_depth, (2, 2, 2))
+        self._compare_grids(fused, fused(in_grid), laplacian(heat(in_grid)))
+
+    def test_rolled_neighbor_loop(self):
+        in_grid = numpy.random.random([16, 16, 16]).astype(numpy.float32)
+        rolled = LaplacianKernel(backend=TestOclEndToEnd.backend_to_test,
+                                 should_unroll=False)
+        compare_stencil = LaplacianKernel(
+            backend=TestOclEndToEnd.backend_to_compare)
+        self._compare_grids(rolled, rolled(in_grid), compare_stencil(in_grid))
+
+    def test_wrap(self):
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        for shape in [[16, 16, 16], [5, 7, 9]]:
+            in_grid = numpy.random.random(shape).astype(numpy.float32)
+            for shape_generic in [False, True]:
+                hp_stencil = SpecializedLaplacian27(
+                    backend=TestOclEndToEnd.backend_to_test,
+                    boundary_handling='wrap', shape_generic=shape_generic)
+                compare_stencil = SpecializedLaplacian27(
+                    backend='numpy', boundary_handling='wrap')
+                numpy.testing.assert_array_almost_equal(
+                    hp_stencil.run_steps(in_grid, 2, coefficients),
+                    compare_stencil.run_steps(in_grid, 2, coefficients))
+
+    def test_dtypes(self):
+        for dtype in [numpy.float64, numpy.int32]:
+            in_grid = (numpy.random.random([16, 16, 16]) * 100).astype(dtype)
+            result = LaplacianKernel(
+                backend=TestOclEndToEnd.backend_to_test)(in_grid)
+            self.assertEqual(result.dtype, dtype)
+            numpy.testing.assert_allclose(
+                result, LaplacianKernel(backend='numpy')(in_grid),
+                rtol=1e-6)
@@ -1,4 +1,5 @@
 __author__ = 'chickmarkley'
+import os
 import unittest
 
 import numpy
@@ -8,7 +9,9 @@ from nose.plugins.attrib import attr
 from stencil_code.library.better_bilateral_filter import BetterBilateralFilter
 from stencil_code.library.laplacian import LaplacianKernel
 from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
+from stencil_code.library.jacobi_stencil import Jacobi
 from stencil_code.library.two_d_heat import TwoDHeatFlow
+from stencil_code.stencil_exception import StencilException
 
 
 class TestOmpEndToEnd(unittest.TestCase):
@@ -58,3 +61,99 @@ class TestOmpEndToEnd(unittest.TestCase):
     def test_bilateral_filter(self):
         in_grid = numpy.random.random([64, 32]).astype(numpy.float32) * 255
         self._check(BetterBilateralFilter, in_grid)
+
+    @attr('omp')
+    def test_temporal_blocking(self):
+        in_grid = numpy.random.random([20, 16, 16]).astype(numpy.float32)
+        untiled = LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                                  boundary_handling='zero')
+        tiled = LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                                boundary_handling='zero', temporal_block=3,
+                                temporal_tile=2)
+        numpy.testing.assert_array_almost_equal(
+            tiled.run_steps(in_grid, 5), untiled.run_steps(in_grid, 5), decimal=2)
+
+    @attr('omp')
+    def test_shape_generic(self):
+        generic = LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                                  boundary_handling='zero', shape_generic=True)
+        for shape in [[16, 16, 16], [10, 12, 14]]:
+            in_grid = numpy.random.random(shape).astype(numpy.float32)
+            fixed = LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                                    boundary_handling='zero')
+            numpy.testing.assert_array_almost_equal(
+                generic.run_steps(in_grid, 3), fixed.run_steps(in_grid, 3))
+        self.assertEqual(len(generic.specializer.concrete_functions), 1)
+
+    @attr('omp')
+    def test_boundary_handling(self):
+        in_grid = numpy.random.random([13, 17, 19]).astype(numpy.float32)
+        for boundary_handling in ['clamp', 'zero', 'copy', 'wrap']:
+            hp_stencil = LaplacianKernel(
+                backend=TestOmpEndToEnd.backend_to_test,
+                boundary_handling=boundary_handling)
+            compare_stencil = LaplacianKernel(
+                backend=TestOmpEndToEnd.backend_to_compare,
+                boundary_handling=boundary_handling)
+            numpy.testing.assert_array_almost_equal(
+                hp_stencil(in_grid), compare_stencil(in_grid))
+
+    @attr('omp')
+    def test_omp_options(self):
+        in_grid = numpy.random.random([13, 17, 19]).astype(numpy.float32)
+        expected = LaplacianKernel(
+            backend=TestOmpEndToEnd.backend_to_compare)(in_grid)
+        for options in [dict(omp_collapse=3, simd=False),
+                        dict(omp_schedule=('dynamic', 2), num_threads=2),
+                        dict(omp_schedule='guided', should_cacheblock=True,
+                             block_size=4, unroll_factor=2)]:
+            stencil = LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                                      **options)
+            numpy.testing.assert_array_almost_equal(stencil(in_grid),
+                                                    expected)
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                            omp_schedule='fastest')
+        # simd keeps the innermost of the three loops out of the collapse
+        for options in [dict(omp_collapse=3), dict(omp_collapse=4, simd=False),
+                        dict(omp_collapse=0), dict(omp_collapse=2.0),
+                        dict(omp_collapse=True)]:
+            with self.assertRaises(StencilException):
+                LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                                **options)
+
+        in_grid = numpy.random.random([30, 40]).astype(numpy.float32)
+        numpy.testing.assert_array_almost_equal(
+            Jacobi(backend=TestOmpEndToEnd.backend_to_test)(in_grid),
+            Jacobi(backend=TestOmpEndToEnd.backend_to_compare)(in_grid))
+
+    @attr('omp')
+    def test_first_touch(self):
+        in_grid = numpy.random.random([20, 16, 16]).astype(numpy.float32)
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        expected = SpecializedLaplacian27(
+            backend=TestOmpEndToEnd.backend_to_test,
+            first_touch=False).run_steps(in_grid, 3, coefficients)
+        for options in [dict(), dict(first_touch_inputs=True),
+                        dict(proc_bind='spread', shape_generic=True)]:
+            stencil = SpecializedLaplacian27(
+                backend=TestOmpEndToEnd.backend_to_test, **options)
+            numpy.testing.assert_array_almost_equal(
+                stencil.run_steps(in_grid, 3, coefficients), expected)
+            out = numpy.ones_like(in_grid)
+            self.assertIs(stencil.run_steps(in_grid, 3, coefficients,
+                                            out=out), out)
+            numpy.testing.assert_array_almost_equal(out, expected)
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                            proc_bind='nearby')
+        # the places are left to the environment of the process
+        places = os.environ.get('OMP_PLACES')
+        if places is not None:
+            LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                            omp_places=places)
+        with self.assertRaises(StencilException):
+            LaplacianKernel(backend=TestOmpEndToEnd.backend_to_test,
+                            omp_places='{0}' if places != '{0}' else '{1}')
+        self.assertEqual(os.environ.get('OMP_PLACES'), places)
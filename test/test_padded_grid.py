@@ -0,0 +1,80 @@
+import unittest
+
+import numpy
+import numpy.testing
+
+from stencil_code.library.laplacian import LaplacianKernel
+from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
+from stencil_code.padded_grid import PaddedGrid
+from stencil_code.stencil_exception import StencilException
+
+
+class TestPaddedGrid(unittest.TestCase):
+    def test_fill_halo(self):
+        grid = numpy.random.random([4, 5]).astype(numpy.float32)
+        for boundary_handling, mode in [('clamp', 'edge'), ('wrap', 'wrap')]:
+            # wider than the grid along axis 0
+            padded = PaddedGrid.from_array(grid, (6, 2), boundary_handling)
+            self.assertEqual(padded.shape, grid.shape)
+            numpy.testing.assert_array_equal(
+                padded.data, numpy.pad(grid, [(6, 6), (2, 2)], mode=mode))
+        padded = PaddedGrid.from_array(grid, (1, 2), 'zero')
+        numpy.testing.assert_array_equal(
+            padded.data, numpy.pad(grid, [(1, 1), (2, 2)], mode='constant'))
+        numpy.testing.assert_array_equal(numpy.asarray(padded), grid)
+
+        copied = PaddedGrid(numpy.zeros([6, 9], numpy.float32), (1, 2),
+                            'copy')
+        copied.fill_halo(PaddedGrid(padded.data + 1, (1, 2), 'copy'))
+        halo = numpy.ones(copied.data.shape, dtype=bool)
+        halo[1:-1, 2:-2] = False
+        numpy.testing.assert_array_equal(copied.data[halo],
+                                         padded.data[halo] + 1)
+        self.assertFalse(copied.interior.any())
+
+        with self.assertRaises(StencilException):
+            PaddedGrid(numpy.zeros([4, 4]), (2, 1))
+        with self.assertRaises(StencilException):
+            PaddedGrid(numpy.zeros([4, 4]), (1, 1), 'reflect')
+
+    def test_matches_boundary_handling(self):
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        for shape in [[9, 7, 8], [1, 5, 3]]:
+            grid = numpy.random.random(shape).astype(numpy.float32)
+            for boundary_handling in ['clamp', 'wrap']:
+                stencil = SpecializedLaplacian27(backend='numpy')
+                expected = SpecializedLaplacian27(
+                    backend='numpy', boundary_handling=boundary_handling)
+                for ghost_depth in [(1, 1, 1), (2, 1, 3)]:
+                    padded = PaddedGrid.from_array(grid, ghost_depth,
+                                                   boundary_handling)
+                    result = stencil(padded, coefficients)
+                    self.assertIsInstance(result, PaddedGrid)
+                    numpy.testing.assert_array_almost_equal(
+                        result.get(), expected(grid, coefficients))
+                    numpy.testing.assert_array_almost_equal(
+                        stencil.run_steps(padded, 3, coefficients).get(),
+                        expected.run_steps(grid, 3, coefficients))
+
+    def test_copy_keeps_halo(self):
+        grid = numpy.random.random([9, 7, 8]).astype(numpy.float32)
+        for backend in ['python', 'numpy']:
+            # the outer ring of the array is the fixed halo
+            padded = PaddedGrid(grid.copy(), (1, 1, 1), 'copy')
+            out = padded.empty_like()
+            self.assertIs(LaplacianKernel(backend=backend).run_steps(
+                padded, 3, out=out), out)
+            numpy.testing.assert_array_almost_equal(
+                out.data, LaplacianKernel(
+                    backend='numpy', boundary_handling='copy').run_steps(
+                        grid, 3))
+
+    def test_errors(self):
+        stencil = LaplacianKernel(backend='numpy')
+        padded = PaddedGrid.from_array(numpy.zeros([6, 6, 6]), (1, 0, 1))
+        with self.assertRaises(StencilException):
+            stencil(padded)
+        padded = PaddedGrid.from_array(numpy.zeros([6, 6, 6]), (1, 1, 1))
+        with self.assertRaises(StencilException):
+            stencil(padded, out=numpy.zeros([8, 8, 8]))
@@ -1,4 +1,6 @@
 import unittest
+import numpy
+import numpy.testing
 from stencil_code.library.jacobi_stencil import Jacobi
 
 from stencil_code.stencil_exception import StencilException
@@ -57,3 +59,81 @@ class TestStencilKernel(unittest.TestCase):
 
 
 
+
+    def test_run_steps(self):
+        jacobi = Jacobi(backend='python')
+        in_grid = numpy.random.random([8, 8]).astype(numpy.float32)
+
+        expected = jacobi(jacobi(jacobi(in_grid)))
+        numpy.testing.assert_array_equal(jacobi.run_steps(in_grid, 3), expected)
+
+        with self.assertRaises(StencilException) as context:
+            jacobi.run_steps(in_grid, 0)
+
+        self.assertTrue("n_steps must be at least 1" in context.exception.args[0])
+
+        numpy.testing.assert_array_equal(jacobi(in_grid, n_steps=3), expected)
+
+    def test_bad_temporal_block(self):
+        with self.assertRaises(StencilException) as context:
+            Jacobi(backend='c', temporal_block=0)
+
+        self.assertTrue("temporal_block must be at least 1" in context.exception.args[0])
+
+        for temporal_tile in [(4, 5), 0, 2.5]:
+            with self.assertRaises(StencilException) as context:
+                Jacobi(backend='c', temporal_block=2, temporal_tile=temporal_tile)
+            self.assertTrue("temporal_tile" in context.exception.args[0])
+        Jacobi(backend='c', temporal_block=2, temporal_tile=4)
+
+    def test_out_argument(self):
+        jacobi = Jacobi(backend='python')
+        in_grid = numpy.random.random([8, 8]).astype(numpy.float32)
+
+        out = numpy.ones_like(in_grid)
+        self.assertIs(jacobi(in_grid, out=out), out)
+        numpy.testing.assert_array_equal(out, jacobi(in_grid))
+        self.assertIs(jacobi.run_steps(in_grid, 3, out=out), out)
+        numpy.testing.assert_array_equal(out, jacobi.run_steps(in_grid, 3))
+
+        for bad_out in [numpy.zeros([4, 4], numpy.float32),
+                        numpy.zeros([8, 8], numpy.float64),
+                        numpy.zeros([8, 16], numpy.float32)[:, ::2],
+                        in_grid]:
+            with self.assertRaises(StencilException):
+                jacobi(in_grid, out=bad_out)
+
+    def test_map(self):
+        jacobi = Jacobi(backend='python')
+        grids = [numpy.random.random([8 + index, 8]).astype(numpy.float32)
+                 for index in range(6)]
+        results = jacobi.map(grids, workers=3)
+        self.assertEqual(len(results), len(grids))
+        for result, grid in zip(results, grids):
+            numpy.testing.assert_array_equal(result, jacobi(grid))
+
+        # the other keywords are passed to every call
+        outs = [numpy.empty_like(grid) for grid in grids]
+        futures = jacobi.map(grids, workers=3, out=outs, n_steps=2,
+                             blocking=False)
+        for future, out, grid in zip(futures, outs, grids):
+            self.assertIs(future.result(), out)
+            numpy.testing.assert_array_equal(out, jacobi.run_steps(grid, 2))
+        with self.assertRaises(StencilException):
+            jacobi.map(grids, out=outs[:2])
+
+    def test_batched(self):
+        jacobi = Jacobi(backend='python', batched=True)
+        self.assertEqual(jacobi.dim, 3)
+        self.assertEqual(jacobi.ghost_depth, (0, 1, 1))
+        self.assertEqual(jacobi.interior_points_slice(),
+                         (slice(0, None), slice(1, -1), slice(1, -1)))
+        self.assertEqual(jacobi.distance((0, 1, 2), (5, 1, 4)), 2.0)
+
+        tiles = numpy.random.random([3, 8, 8]).astype(numpy.float32)
+        single = Jacobi(backend='python')
+        numpy.testing.assert_array_equal(
+            jacobi(tiles), numpy.array([single(tile) for tile in tiles]))
+
+        with self.assertRaises(StencilException):
+            Jacobi(backend='ocl', boundary_handling='copy', batched=True)
@@ -1,5 +1,6 @@
 import unittest
 
+from stencil_code.backend.omp import OmpCollapseClause, OmpLoop
 from stencil_code.optimizer import *
 from ctree.c.nodes import *
 from ctypes import c_int
@@ -7,33 +8,34 @@ from ctypes import c_int
 
 class TestUnroll(unittest.TestCase):
     def _check(self, actual, expected):
+        if isinstance(actual, list):
+            actual = "\n".join(str(statement) for statement in actual)
+        if isinstance(expected, list):
+            expected = "\n".join(str(statement) for statement in expected)
         self.assertEqual(str(actual), str(expected))
 
-    @unittest.skip("Optimizer broken by newcl branch")
     def test_simple_unroll(self):
         actual = For(Assign(SymbolRef('x', c_int()), Constant(0)),
-                     Lt(SymbolRef('x'), Constant(9)),
+                     Lt(SymbolRef('x'), Constant(8)),
                      PostInc(SymbolRef('x')),
-                     [Add(Constant(1), Constant(2))]
+                     [Add(SymbolRef('x'), Constant(2))]
                      )
         expected = For(Assign(SymbolRef('x', c_int()), Constant(0)),
-                       Lt(SymbolRef('x'), Constant(9)),
-                       AddAssign(SymbolRef('x'), 2),
+                       Lt(SymbolRef('x'), Constant(7)),
+                       AddAssign(SymbolRef('x'), Constant(2)),
                        [
-                           Add(Constant(1), Constant(2)),
-                           Add(Constant(1), Constant(2))
+                           Add(SymbolRef('x'), Constant(2)),
+                           Add(Add(SymbolRef('x'), Constant(1)), Constant(2))
                        ])
-        unroll(actual, actual, 2)
-        self._check(actual, expected)
+        self._check(unroll(actual, actual, 2), expected)
 
-    @unittest.skip("Optimizer broken by newcl branch")
     def test_leftover_unroll(self):
         actual = For(Assign(SymbolRef('y', c_int()), Constant(0)),
                      Lt(SymbolRef('y'), Constant(10)),
                      PostInc(SymbolRef('y')),
                      [
                          For(Assign(SymbolRef('x', c_int()), Constant(0)),
-                             Lt(SymbolRef('x'), Constant(10)),
+                             Lt(SymbolRef('x'), Constant(9)),
                              PostInc(SymbolRef('x')),
                              [Add(Constant(1), Constant(2))]
                              )
@@ -43,18 +45,100 @@ class TestUnroll(unittest.TestCase):
                        PostInc(SymbolRef('y')),
                        [
                            For(Assign(SymbolRef('x', c_int()), Constant(0)),
-                               Lt(SymbolRef('x'), Constant(9)),
-                               AddAssign(SymbolRef('x'), 2),
+                               Lt(SymbolRef('x'), Constant(8)),
+                               AddAssign(SymbolRef('x'), Constant(2)),
                                [
                                    Add(Constant(1), Constant(2)),
                                    Add(Constant(1), Constant(2))
                                ]),
-                           For(Assign(SymbolRef('x', c_int()), Constant(9)),
-                               Lt(SymbolRef('x'), Constant(10)),
+                           For(Assign(SymbolRef('x', c_int()), Constant(8)),
+                               Lt(SymbolRef('x'), Constant(9)),
                                PostInc(SymbolRef('x')),
                                [Add(Constant(1), Constant(2))]
                                )
                        ])
-        unroll(actual, FindInnerMostLoop().find(actual), 2)
-        self._check(actual, expected)
+        self._check(unroll(actual, FindInnerMostLoop().find(actual), 2),
+                    expected)
+
+    def test_unroll_and_jam(self):
+        actual = For(Assign(SymbolRef('y', c_int()), Constant(0)),
+                     LtE(SymbolRef('y'), Constant(3)),
+                     PostInc(SymbolRef('y')),
+                     [
+                         For(Assign(SymbolRef('x', c_int()), Constant(0)),
+                             LtE(SymbolRef('x'), Constant(3)),
+                             PostInc(SymbolRef('x')),
+                             [Add(SymbolRef('x'), SymbolRef('y'))]
+                             )
+                     ])
+        expected = For(Assign(SymbolRef('y', c_int()), Constant(0)),
+                       LtE(SymbolRef('y'), Constant(2)),
+                       AddAssign(SymbolRef('y'), Constant(2)),
+                       [
+                           For(Assign(SymbolRef('x', c_int()), Constant(0)),
+                               LtE(SymbolRef('x'), Constant(3)),
+                               PostInc(SymbolRef('x')),
+                               [
+                                   Add(SymbolRef('x'), SymbolRef('y')),
+                                   Add(SymbolRef('x'),
+                                       Add(SymbolRef('y'), Constant(1)))
+                               ])
+                       ])
+        self._check(optimize_loop_nest(actual, None, (2, 1)), [expected])
+
+
+class TestCacheBlock(unittest.TestCase):
+    def test_block_outer_dimension(self):
+        actual = For(Assign(SymbolRef('y', c_int()), Constant(0)),
+                     Lt(SymbolRef('y'), Constant(10)),
+                     PostInc(SymbolRef('y')),
+                     [
+                         For(Assign(SymbolRef('x', c_int()), Constant(0)),
+                             Lt(SymbolRef('x'), Constant(10)),
+                             PostInc(SymbolRef('x')),
+                             [Add(SymbolRef('x'), SymbolRef('y'))]
+                             )
+                     ])
+        result = optimize_loop_nest(actual, (4, 1), None)
+        self.assertEqual(len(result), 1)
+        outer = result[0]
+        self.assertEqual(outer.init.left.name, 'yy')
+        self.assertEqual(str(outer.incr), 'yy += 4')
+        inner = outer.body[0]
+        self.assertEqual(inner.init.left.name, 'y')
+        self.assertEqual(str(inner.test), 'y < min(yy + 4, 10)')
+        self.assertEqual(inner.body[0].init.left.name, 'x')
+
+    def test_no_factors_is_identity(self):
+        actual = For(Assign(SymbolRef('x', c_int()), Constant(0)),
+                     Lt(SymbolRef('x'), Constant(10)),
+                     PostInc(SymbolRef('x')),
+                     [Add(SymbolRef('x'), Constant(1))]
+                     )
+        expected = str(actual)
+        result = optimize_loop_nest(actual, (1,), (1,))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(str(result[0]), expected)
+
+
+class TestFitCollapse(unittest.TestCase):
+    def test_collapse_blocked_nest(self):
+        nest = For(Assign(SymbolRef('y', c_int()), Constant(0)),
+                   Lt(SymbolRef('y'), Constant(10)),
+                   PostInc(SymbolRef('y')),
+                   [
+                       For(Assign(SymbolRef('x', c_int()), Constant(0)),
+                           Lt(SymbolRef('x'), Constant(10)),
+                           PostInc(SymbolRef('x')),
+                           [Add(SymbolRef('x'), SymbolRef('y'))]
+                           )
+                   ])
+        pragma = OmpLoop("parallel for", [OmpCollapseClause(2)])
+        statements = [pragma, nest]
+        fit_collapse(statements)
+        self.assertEqual(str(pragma), "#pragma omp parallel for collapse(2)")
 
+        # the bounds of y depend on yy once y is blocked
+        statements = [pragma] + optimize_loop_nest(nest, (4, 1), None)
+        fit_collapse(statements)
+        self.assertEqual(str(pragma), "#pragma omp parallel for collapse(1)")
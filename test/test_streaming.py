@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import numpy.testing
+
+from stencil_code.library.laplacian import LaplacianKernel
+from stencil_code.library.laplacian_27pt import SpecializedLaplacian27
+from stencil_code.stencil_exception import StencilException
+from stencil_code.streaming import ChunkReader
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.grid = numpy.random.random([37, 10, 12]).astype(numpy.float32)
+        self.memmap = numpy.lib.format.open_memmap(
+            os.path.join(self.directory, 'in.npy'), mode='w+',
+            dtype=self.grid.dtype, shape=self.grid.shape)
+        self.memmap[...] = self.grid
+
+    def tearDown(self):
+        del self.memmap
+        shutil.rmtree(self.directory)
+
+    def test_slabs_match_whole_grid(self):
+        for boundary_handling in ['clamp', 'zero', 'copy', 'wrap']:
+            stencil = LaplacianKernel(backend='numpy',
+                                      boundary_handling=boundary_handling)
+            result = stencil.stream(
+                self.memmap, slab_rows=5,
+                filename=os.path.join(self.directory, 'out.npy'))
+            self.assertIsInstance(result, numpy.memmap)
+            numpy.testing.assert_array_almost_equal(result,
+                                                    stencil(self.grid))
+            numpy.testing.assert_array_almost_equal(
+                stencil.stream(self.memmap, slab_rows=6, n_steps=3),
+                stencil.run_steps(self.grid, 3))
+
+    def test_chunks(self):
+        stencil = LaplacianKernel(backend='numpy', boundary_handling='zero')
+        chunks = (self.grid[low:low + 7] for low in range(0, 37, 7))
+        out = numpy.empty_like(self.grid)
+        self.assertIs(stencil.stream(chunks, out=out, slab_rows=4), out)
+        numpy.testing.assert_array_almost_equal(out, stencil(self.grid))
+
+        with self.assertRaises(StencilException):
+            stencil.stream(iter([self.grid]))
+        with self.assertRaises(StencilException):
+            stencil.stream(iter([self.grid[:10]]), out=out)
+        reader = ChunkReader([self.grid[:3], self.grid[3:]])
+        reader.read(2, 5)
+        with self.assertRaises(StencilException):
+            reader.read(1, 4)
+
+    def test_grid_arguments(self):
+        coefficients = numpy.array([1.0, 0.5, 0.25, 0.125]).astype(
+            numpy.float32)
+        stencil = SpecializedLaplacian27(backend='numpy',
+                                         boundary_handling='copy')
+        numpy.testing.assert_array_almost_equal(
+            stencil.stream(self.memmap, coefficients, slab_rows=3),
+            stencil(self.grid, coefficients))
@@ -0,0 +1,126 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from stencil_code.tuning import TuningDatabase, TuningSearch, StencilTuningDriver
+
+
+class TestTuningDatabase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'nested', 'tuning.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing_database_is_empty(self):
+        database = TuningDatabase(self.path)
+        self.assertEqual(database.load(), {})
+        self.assertIsNone(database.lookup('anything'))
+
+    def test_store_and_lookup(self):
+        database = TuningDatabase(self.path)
+        database.store('a', {'block_factors': (8, 1), 'unroll_factors': (1, 2)})
+        database.store('b', {'local_size': (4, 4)})
+
+        reloaded = TuningDatabase(self.path)
+        self.assertEqual(reloaded.lookup('a'),
+                         {'block_factors': (8, 1), 'unroll_factors': (1, 2)})
+        self.assertEqual(reloaded.lookup('b'), {'local_size': (4, 4)})
+        # nothing but the database and its lock is left behind in its directory
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.path))),
+                         ['tuning.json', 'tuning.json.lock'])
+
+    def test_concurrent_stores_keep_every_entry(self):
+        # the workers are forked so they can run a local function
+        context = multiprocessing.get_context('fork') \
+            if hasattr(multiprocessing, 'get_context') else multiprocessing
+
+        def store(worker):
+            database = TuningDatabase(self.path)
+            for index in range(20):
+                database.store('{}-{}'.format(worker, index),
+                               {'local_size': (worker, index)})
+
+        processes = [context.Process(target=store, args=(worker,))
+                     for worker in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(len(TuningDatabase(self.path).load()), 80)
+
+    def test_corrupt_database_is_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as database_file:
+            database_file.write('{"a": ')
+        database = TuningDatabase(self.path)
+        self.assertIsNone(database.lookup('a'))
+        database.store('a', {'local_size': (2,)})
+        with open(self.path) as database_file:
+            self.assertEqual(json.load(database_file), {'a': {'local_size': [2]}})
+
+
+class TestTuningSearch(unittest.TestCase):
+    def test_fastest_candidate_wins(self):
+        search = TuningSearch(['slow', 'fast', 'medium'], trials=2)
+        times = {'slow': [3.0, 2.5], 'fast': [1.5, 0.5], 'medium': [1.0, 1.0]}
+        for _ in range(6):
+            self.assertFalse(search.done)
+            candidate = search.next_config()
+            search.report(times[candidate].pop(0))
+        self.assertTrue(search.done)
+        self.assertEqual(search.next_config(), 'fast')
+
+    def test_rejected_candidate_is_skipped(self):
+        search = TuningSearch(['broken', 'working'], trials=1)
+        self.assertFalse(search.reject())
+        self.assertEqual(search.next_config(), 'working')
+        self.assertTrue(search.report(1.0))
+        self.assertEqual(search.best, 'working')
+
+
+class TestStencilTuningDriver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = TuningDatabase(os.path.join(self.directory, 'tuning.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tunes_each_key_and_persists(self):
+        generated = []
+
+        def candidates(arg_config):
+            generated.append(arg_config)
+            return [{'local_size': (1,)}, {'local_size': (arg_config,)}]
+
+        driver = StencilTuningDriver(candidates, self.database, trials=1)
+        driver.select('small', 2)
+        self.assertTrue(driver.is_tuning())
+        self.assertEqual(next(driver.configs), {'local_size': (1,)})
+        driver.report(time=2.0)
+        self.assertEqual(next(driver.configs), {'local_size': (2,)})
+        driver.report(time=1.0)
+        self.assertFalse(driver.is_tuning())
+        self.assertEqual(next(driver.configs), {'local_size': (2,)})
+
+        driver.select('large', 8)
+        self.assertTrue(driver.is_tuning())
+        self.assertEqual(generated, [2, 8])
+
+        # a new driver starts from the database without generating candidates
+        fresh = StencilTuningDriver(candidates, self.database, trials=1)
+        fresh.select('small', 2)
+        self.assertFalse(fresh.is_tuning())
+        self.assertEqual(next(fresh.configs), {'local_size': (2,)})
+        self.assertEqual(generated, [2, 8])
+
+    def test_single_candidate_needs_no_tuning(self):
+        driver = StencilTuningDriver(lambda arg_config: [{'local_size': (4,)}])
+        driver.select('only', None)
+        self.assertFalse(driver.is_tuning())
+        self.assertEqual(next(driver.configs), {'local_size': (4,)})